@@ -54,6 +54,9 @@ from ckanext.knowledgehub.model.likes import setup as likes_setup
 from ckanext.knowledgehub.model.request_audit import (
     setup as request_audit_setup
 )
+from ckanext.knowledgehub.model.index_dependency import (
+    setup as index_dependency_setup
+)
 
 
 log = logging.getLogger(__name__)
@@ -94,6 +97,7 @@ def init_db():
         comments_setup()
         likes_setup()
         request_audit_setup()
+        index_dependency_setup()
     except Exception as e:
         error_shout(e)
     else:
@@ -16,8 +16,21 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 import click
+import random
+import time
+from datetime import datetime, timedelta
 from logging import getLogger
+from multiprocessing import Pool
+import ckan.model as ckan_model
 from ckan.lib.search import rebuild
+from ckanext.knowledgehub.lib.solr import (
+    CHUNK_SIZE,
+    connection_pool,
+    Index,
+    mapped,
+    mapped_date,
+    to_indexed_doc,
+)
 from ckanext.knowledgehub.model import (
     Dashboard,
     ResearchQuestion,
@@ -41,9 +54,37 @@ def _mock_translator():
 
 
 class CkanCoreIndex:
+    u'''Rebuilds the CKAN core (datasets) index in place.
+
+    A full ``ckan.lib.search.rebuild`` clears the whole site index first,
+    which would also remove the live generations of the extension document
+    types. Instead, the datasets are re-indexed over their current documents
+    and only the documents of the datasets that no longer exist are removed.
+    '''
+
+    doctype = 'package'
+
+    def __init__(self, index=None):
+        self.index = index or Index()
+
+    def _get_package_ids(self):
+        query = ckan_model.Session.query(ckan_model.Package.id).filter(
+            ckan_model.Package.state != 'deleted')
+        return set([row[0] for row in query])
 
     def rebuild_index(self):
-        rebuild()
+        rebuild(refresh=True, defer_commit=True)
+        self.index.commit()
+
+        package_ids = self._get_package_ids()
+        stale = [package_id
+                 for package_id in self.index.iter_ids(self.doctype, 'id')
+                 if package_id not in package_ids]
+        for i in range(0, len(stale), CHUNK_SIZE):
+            self.index.remove_ids(self.doctype, 'id',
+                                  stale[i:i + CHUNK_SIZE])
+        if stale:
+            self.index.commit()
 
 
 INDEX_EXECUTORS = {
@@ -60,7 +101,7 @@ def index():
     pass
 
 
-def rebuild_index_for(doctype):
+def _get_executor(doctype):
     executor = INDEX_EXECUTORS.get(doctype)
     if not executor:
         raise Exception('Invalid doctype \'{}\'. ' +
@@ -68,8 +109,159 @@ def rebuild_index_for(doctype):
                         doctype,
                         ', '.join(
                             sorted([k for k, _ in INDEX_EXECUTORS.items()])))
+    return executor
+
+
+def rebuild_index_for(doctype):
+    executor = _get_executor(doctype)
     logger.info('Rebuilding index for: %s', doctype)
-    executor.rebuild_index()
+    return executor.rebuild_index()
+
+
+def _init_rebuild_worker():
+    # The worker process is forked, so it must not reuse the Solr
+    # connections of the parent process.
+    connection_pool.reset()
+
+
+def _rebuild_task(task):
+    u'''Rebuilds one shard of the index for a document type, in a worker
+    process. The CKAN core index is rebuilt as a single task.
+    '''
+    doctype, generation, lower, upper = task
+    start = time.time()
+    try:
+        executor = _get_executor(doctype)
+        if generation is None:
+            executor.rebuild_index()
+            result = {'indexed': None, 'error': False}
+        else:
+            result = executor.rebuild_shard(generation, lower, upper)
+    except Exception as e:
+        logger.exception(e)
+        result = {'indexed': 0, 'error': True, 'failed': str(e)}
+    finally:
+        ckan_model.Session.remove()
+    result['elapsed'] = time.time() - start
+    return doctype, result
+
+
+def rebuild_index_parallel(types, workers):
+    u'''Rebuilds the index for the given document types in parallel, using
+    a pool of worker processes.
+
+    The document types are rebuilt concurrently, and the large document types
+    are split in id-range shards (at most one per worker) that are rebuilt in
+    parallel as well. Every shard is committed once. A document type becomes
+    live once all of its shards are rebuilt, and is discarded if any of the
+    shards failed.
+
+    The CKAN core index can not be sharded, so it is rebuilt in place as a
+    single task, before the shards of the other document types.
+
+    :param types: ``list`` of ``str``, the document types to rebuild.
+    :param workers: ``int``, the number of worker processes.
+
+    :returns: ``dict``, the rebuild summary for every document type.
+    '''
+    core_tasks = []
+    tasks = []
+    summary = {}
+    try:
+        for doctype in types:
+            executor = _get_executor(doctype)
+            if not hasattr(executor, 'rebuild_shard'):
+                core_tasks.append((doctype, None, None, None))
+                summary[doctype] = {'generation': None, 'shards': 1}
+                continue
+            generation = executor.start_rebuild()
+            summary[doctype] = {'generation': generation, 'shards': 0}
+            bounds = executor.get_shard_bounds(workers)
+            for lower, upper in bounds:
+                tasks.append((doctype, generation, lower, upper))
+            summary[doctype]['shards'] = len(bounds)
+    except Exception:
+        for doctype, stats in summary.items():
+            if stats['generation'] is not None:
+                _get_executor(doctype).abort_rebuild()
+        raise
+    for stats in summary.values():
+        stats.update({
+            'done': 0,
+            'indexed': 0,
+            'error': False,
+            'failed': False,
+            'start': time.time(),
+        })
+
+    # Release the database connections, so the forked workers do not share
+    # them with this process.
+    ckan_model.Session.remove()
+    ckan_model.meta.engine.dispose()
+
+    def _process_result(doctype, result):
+        stats = summary[doctype]
+        stats['done'] += 1
+        if result['indexed'] is None:
+            stats['indexed'] = None
+        else:
+            stats['indexed'] += result['indexed']
+        stats['error'] = stats['error'] or result['error']
+        stats['failed'] = stats['failed'] or bool(result.get('failed'))
+        click.echo(u'%s: shard %d/%d done in %.2fs' % (
+            doctype, stats['done'], stats['shards'], result['elapsed']))
+        if stats['done'] < stats['shards']:
+            return
+
+        stats['elapsed'] = time.time() - stats['start']
+        if stats['generation'] is None:
+            return
+        executor = _get_executor(doctype)
+        if stats['failed']:
+            executor.abort_rebuild()
+        else:
+            executor.finish_rebuild(stats['generation'])
+
+    pool = Pool(workers, initializer=_init_rebuild_worker)
+    try:
+        for doctype, result in pool.imap_unordered(_rebuild_task,
+                                                   core_tasks):
+            _process_result(doctype, result)
+        for doctype, result in pool.imap_unordered(_rebuild_task, tasks):
+            _process_result(doctype, result)
+    finally:
+        pool.close()
+        pool.join()
+    return summary
+
+
+def _print_rebuilt(doctype, indexed, elapsed):
+    if indexed is None:
+        click.secho(u'Rebuilt index for %s in %.2fs' % (doctype, elapsed),
+                    fg=u'green')
+        return
+    click.secho(u'Rebuilt index for %s: %d documents in %.2fs '
+                u'(%.2f docs/sec)' % (doctype,
+                                      indexed,
+                                      elapsed,
+                                      indexed / elapsed if elapsed else 0),
+                fg=u'green')
+
+
+def sync_index_for(doctype):
+    executor = INDEX_EXECUTORS.get(doctype)
+    if not executor or not hasattr(executor, 'sync_index'):
+        raise Exception('Invalid doctype \'{}\'. ' +
+                        'Available index document types: {}',
+                        doctype,
+                        ', '.join(_get_synced_doctypes()))
+    logger.info('Syncing index for: %s', doctype)
+    return executor.sync_index()
+
+
+def _get_synced_doctypes():
+    return sorted([k for k, executor in INDEX_EXECUTORS.items()
+                   if hasattr(executor, 'sync_index')])
 
 
 @index.command('rebuild', short_help='Rebuild the search index')
@@ -77,7 +269,13 @@ def rebuild_index_for(doctype):
               default='all',
               help='Rebuild index for specified model type. Available are: ' +
                    ','.join(sorted([k for k, _ in INDEX_EXECUTORS.items()])))
-def rebuild_index(model):
+@click.option('--workers',
+              default=1,
+              type=int,
+              help='Number of worker processes. With more than one worker, '
+                   'the model types (and the shards of the large ones) are '
+                   'rebuilt in parallel.')
+def rebuild_index(model, workers):
     _mock_translator()
     types = [model]
     if model == 'all':
@@ -85,5 +283,164 @@ def rebuild_index(model):
         types = sorted([k for k, _ in INDEX_EXECUTORS.items()])
         logger.info('Rebuilding search index for all models: %s', types)
 
+    if workers > 1:
+        start = time.time()
+        summary = rebuild_index_parallel(types, workers)
+        for doctype in types:
+            stats = summary[doctype]
+            if stats['failed']:
+                click.secho(u'Failed to rebuild index for %s. Check the log '
+                            u'for more details.' % doctype, fg=u'red')
+                continue
+            _print_rebuilt(doctype, stats['indexed'], stats['elapsed'])
+        click.secho(u'Rebuilt index for %d model types with %d workers in '
+                    u'%.2fs' % (len(types), workers, time.time() - start),
+                    fg=u'green')
+        return
+
+    for doctype in types:
+        start = time.time()
+        indexed = rebuild_index_for(doctype)
+        _print_rebuilt(doctype, indexed, time.time() - start)
+
+
+@index.command('sync', short_help='Sync the search index with the database')
+@click.option('--model',
+              default='all',
+              help='Sync index for specified model type. Available are: ' +
+                   ','.join(_get_synced_doctypes()))
+@click.option('--background',
+              is_flag=True,
+              default=False,
+              help='Schedule the sync as a background job.')
+def sync_index(model, background):
+    _mock_translator()
+    types = [model]
+    if model == 'all':
+        types = _get_synced_doctypes()
+
+    if background:
+        from ckanext.knowledgehub.logic.jobs import schedule_sync_index
+        schedule_sync_index([INDEX_EXECUTORS[doctype].doctype
+                             for doctype in types
+                             if doctype in INDEX_EXECUTORS])
+        click.secho(u'Scheduled index sync for: %s' % ', '.join(types),
+                    fg=u'green')
+        return
+
     for doctype in types:
-        rebuild_index_for(doctype)
+        start = time.time()
+        result = sync_index_for(doctype)
+        click.secho(u'Synced index for %s in %.2fs: %d updated, %d removed' %
+                    (doctype,
+                     time.time() - start,
+                     result['updated'],
+                     result['removed']),
+                    fg=u'green')
+
+
+BENCHMARK_DOCTYPE = 'benchmark'
+BENCHMARK_FIELDS = [
+    mapped('id', 'entity_id'),
+    'name',
+    'title',
+    mapped('tags', 'tags'),
+    mapped('groups', 'groups'),
+    mapped('organizations', 'organizations'),
+    mapped_date('created_at', 'khe_created'),
+    mapped_date('modified_at', 'khe_modified'),
+]
+BENCHMARK_QUERIES = [
+    ('facet', {'q': '*:*',
+               'rows': 1,
+               'facet': 'true',
+               'facet.field': ['organizations', 'groups', 'tags']}),
+    ('sort created', {'q': '*:*', 'rows': 20, 'sort': 'khe_created desc'}),
+    ('sort modified', {'q': '*:*', 'rows': 20, 'sort': 'khe_modified asc'}),
+    ('sort name', {'q': '*:*', 'rows': 20, 'sort': 'name asc'}),
+]
+
+
+def _generate_benchmark_docs(count, seed=0):
+    u'''Generates a synthetic corpus shaped like the extension documents:
+    a few organizations and groups, a long tail of tags and dates spread over
+    a couple of years.
+    '''
+    rnd = random.Random(seed)
+    organizations = ['organization-%d' % i for i in range(20)]
+    groups = ['group-%d' % i for i in range(50)]
+    tags = ['tag-%d' % i for i in range(1000)]
+    start = datetime(2018, 1, 1)
+    for i in range(count):
+        created_at = start + timedelta(minutes=rnd.randint(0, 1051200))
+        yield {
+            'id': 'benchmark-%d' % i,
+            'name': 'benchmark-%08d' % rnd.randint(0, 10 ** 8),
+            'title': 'Benchmark document %d' % i,
+            'organizations': rnd.sample(organizations, rnd.randint(1, 2)),
+            'groups': rnd.sample(groups, rnd.randint(0, 3)),
+            'tags': rnd.sample(tags, rnd.randint(1, 8)),
+            'created_at': created_at,
+            'modified_at': created_at + timedelta(
+                minutes=rnd.randint(0, 43200)),
+        }
+
+
+def _percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+
+def run_benchmark(docs_count, runs, chunk_size=1000):
+    u'''Indexes a synthetic corpus as a separate document type, measures the
+    latency of the facet and sort queries on it and removes the corpus from
+    the index.
+
+    :returns: ``list`` of ``tuple`` with the name of the query, the median
+        and the 95th percentile latency in milliseconds.
+    '''
+    index = Index()
+    index.remove_all(BENCHMARK_DOCTYPE)
+    try:
+        chunk = []
+        for data in _generate_benchmark_docs(docs_count):
+            chunk.append(to_indexed_doc(data, BENCHMARK_DOCTYPE,
+                                        BENCHMARK_FIELDS))
+            if len(chunk) >= chunk_size:
+                index.add_many(BENCHMARK_DOCTYPE, chunk)
+                chunk = []
+        index.add_many(BENCHMARK_DOCTYPE, chunk)
+        index.commit()
+
+        results = []
+        for name, query in BENCHMARK_QUERIES:
+            # The first run warms up the caches (and the field cache for the
+            # fields without docValues).
+            index.search(BENCHMARK_DOCTYPE, **dict(query))
+            timings = []
+            for _ in range(runs):
+                start = time.time()
+                index.search(BENCHMARK_DOCTYPE, **dict(query))
+                timings.append((time.time() - start) * 1000)
+            results.append((name,
+                            _percentile(timings, 50),
+                            _percentile(timings, 95)))
+        return results
+    finally:
+        index.remove_all(BENCHMARK_DOCTYPE)
+
+
+@index.command('benchmark',
+               short_help='Benchmark the facet and sort queries')
+@click.option('--docs',
+              default=10000,
+              type=int,
+              help='Number of synthetic documents to index.')
+@click.option('--runs',
+              default=50,
+              type=int,
+              help='Number of runs per query.')
+def benchmark(docs, runs):
+    for name, median, p95 in run_benchmark(docs, runs):
+        click.secho(u'%s: median %.1fms, p95 %.1fms' % (name, median, p95),
+                    fg=u'green')
@@ -33,7 +33,7 @@ from dateutil import parser
 from dateutil.tz import tzlocal
 from flask import Blueprint
 from urllib import urlencode
-from six import string_types, iteritems
+from six import string_types
 from enum import Enum
 from hdx.data.dataset import Dataset
 from werkzeug import UserAgent
@@ -927,7 +927,8 @@ def get_searched_rqs(query):
     search_query = {
         'text': query,
         'page': int(request.params.get('page', 1)),
-        'facet': True
+        'facet': True,
+        'projection': 'card',
     }
     sort = _get_sort()
     facets = _get_facets()
@@ -947,63 +948,28 @@ def get_searched_rqs(query):
 
 
 def get_searched_dashboards(query):
-    page = int(request.params.get('page', 1))
-    limit = int(config.get('ckan.datasets_per_page', 20))
-    offset = (page - 1) * limit
-    list_dash_searched = {
-        'count': 0,
-        'limit': limit,
-        'stats': {},
-        'search_facets': {},
-        'results': []
+    context = _get_context()
+    search_query = {
+        'text': query,
+        'page': int(request.params.get('page', 1)),
+        'facet': True,
+        'projection': 'card',
     }
-
-    def result_iter(page=1):
-        search_query = {
-            'text': query,
-            'facet': True
-        }
-        sort = _get_sort()
-        facets = _get_facets()
-        if sort:
-            search_query['sort'] = sort
-        if facets:
-            search_query['fq'] = facets
-        while True:
-            search_query['page'] = page
-            dashboards = toolkit.get_action('search_dashboards')(
-                _get_context(),
-                search_query)
-
-            results = dashboards.get('results', [])
-            if not results:
-                break
-
-            for k, v in iteritems(dashboards.get('search_facets', {})):
-                if list_dash_searched.get('search_facets').get(k):
-                    list_dash_searched['search_facets'][k].update(v)
-                else:
-                    list_dash_searched['search_facets'][k] = v
-
-            for r in results:
-                yield r
-            page += 1
-
-    dashboards = []
-    for dashboard in result_iter():
-        try:
-            toolkit.check_access(
-                'dashboard_show',
-                _get_context(),
-                {'name': dashboard.get('name')})
-        except toolkit.NotAuthorized:
-            continue
-
-        dashboards.append(dashboard)
-
-    list_dash_searched['count'] = len(dashboards)
-    list_dash_searched['results'] = dashboards[offset:offset+limit]
-    list_dash_searched['pager'] = _get_pager(list_dash_searched, 'dashboards')
+    sort = _get_sort()
+    facets = _get_facets()
+    if sort:
+        search_query['sort'] = sort
+    if facets:
+        search_query['fq'] = facets
+    # The search returns only the dashboards the user has access to (see
+    # the 'dashboard_show' auth function), so there is no need to check the
+    # access to every dashboard.
+    list_dash_searched = toolkit.get_action(
+        'search_dashboards')(
+            context,
+            search_query)
+    list_dash_searched['pager'] = _get_pager(list_dash_searched,
+                                             'dashboards')
 
     c.search_facets = list_dash_searched['search_facets']
     return list_dash_searched
@@ -1014,7 +980,9 @@ def get_searched_visuals(query):
     search_query = {
         'text': query,
         'page': int(request.params.get('page', 1)),
-        'facet': True
+        'facet': True,
+        # the visualizations are loaded from the database
+        'projection': 'ids',
     }
     sort = _get_sort()
     facets = _get_facets()
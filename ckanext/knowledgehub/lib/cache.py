@@ -0,0 +1,604 @@
+"""
+Copyright (c) 2018 Keitaro AB
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+'''Search results, tag keywords, groups and permission labels caches.
+'''
+import hashlib
+import json
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from six.moves import cPickle as pickle
+from sqlalchemy import or_, and_
+from ckan.common import config
+from ckan.lib.redis import connect_to_redis
+from ckan.plugins.toolkit import asbool
+from logging import getLogger
+
+
+log = getLogger(__name__)
+
+
+class LRUCache:
+    '''Thread-safe, in-process, least recently used cache with expiring
+    entries.
+
+    :param size: `int`, the maximal number of entries kept in the cache.
+    :param timeout: `int`, number of seconds after which an entry expires.
+    '''
+
+    def __init__(self, size=512, timeout=60):
+        self.size = size
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        '''Returns the cached value for the key, or `None` if there is no
+        such (valid) entry in the cache.
+        '''
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.time():
+                return None
+            # re-insert to mark it as the most recently used entry
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value):
+        '''Stores the value in the cache, evicting the least recently used
+        entries if the cache is full.
+        '''
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.timeout, value)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SearchResultsCache:
+    '''Two-tier (in-process LRU and Redis) cache for the search results of
+    the indexed document types.
+
+    The results are cached under a key derived from the document type, the
+    normalized Solr query arguments and the permission labels of the user.
+    Every document type has a generation counter (kept in Redis) that is part
+    of the key as well. The counter is bumped whenever the index for the
+    document type changes, which makes all cached results for that document
+    type unreachable - they just expire from the cache. When the change is
+    committed to the index with a delay (`commitWithin`), the results for the
+    document type are not cached until the change becomes visible.
+
+    The results are stored serialized, so every cache hit returns a fresh
+    copy that can be freely modified by the caller.
+
+    :param redis: The redis connection factory. If ommited, the default CKAN
+        Redis connection will be used.
+    :param local: `LRUCache`, the in-process cache tier. If ommited, one is
+        created based on the configuration.
+    '''
+
+    CACHE_PREFIX = 'ckanext.knowledgehub.search.cache'
+
+    def __init__(self, redis=None, local=None):
+        self.redis = redis or connect_to_redis
+        self._local = local
+        self._lock = threading.Lock()
+        self._stats = {
+            'local_hits': 0,
+            'redis_hits': 0,
+            'misses': 0,
+            'errors': 0,
+        }
+
+    def _connect(self):
+        return self.redis()
+
+    def _get_key(self, suffix, value):
+        return '%s.%s:%s' % (SearchResultsCache.CACHE_PREFIX, suffix, value)
+
+    def get_timeout(self):
+        return int(config.get('ckanext.knowledgehub.search.cache_timeout',
+                              60))
+
+    def get_local(self):
+        if self._local is None:
+            self._local = LRUCache(
+                size=int(config.get('ckanext.knowledgehub.search.cache_size',
+                                    512)),
+                timeout=self.get_timeout())
+        return self._local
+
+    def is_enabled(self):
+        return asbool(config.get('ckanext.knowledgehub.search.cache', True))
+
+    def _count(self, stat):
+        with self._lock:
+            self._stats[stat] += 1
+
+    def get_generation(self, doctype):
+        '''Returns the current generation of the cached results for the
+        document type.
+        '''
+        return self._connect().get(self._get_key('generation', doctype)) or '0'
+
+    def _get_generation_state(self, doctype):
+        generation, settling = self._connect().mget([
+            self._get_key('generation', doctype),
+            self._get_key('settling', doctype),
+        ])
+        return generation or '0', bool(settling)
+
+    def bump_generation(self, doctype, commit_within=None):
+        '''Invalidates all cached results for the document type.
+
+        :param doctype: `str`, the document type.
+        :param commit_within: `int`, optional, the number of milliseconds
+            within which the change is committed to the index. The results
+            are not cached for that long, as the searches may still return
+            the results from before the change.
+        '''
+        if not self.is_enabled():
+            return
+        try:
+            conn = self._connect()
+            if commit_within:
+                conn.setex(self._get_key('settling', doctype), '1',
+                           int(math.ceil(commit_within / 1000.0)) + 1)
+            conn.incr(self._get_key('generation', doctype))
+        except Exception as e:
+            log.warning('Failed to invalidate the search cache for %s. '
+                        'Error: %s', doctype, str(e))
+
+    def get_cache_key(self, doctype, generation, args, permission_labels):
+        '''Builds the cache key for the search.
+
+        :param doctype: `str`, the document type.
+        :param generation: `str`, the cache generation for the document type.
+        :param args: `dict`, the Solr query arguments.
+        :param permission_labels: `list`, the permission labels of the user,
+            or `None` if the search is not restricted by permissions.
+        '''
+        normalized = {}
+        for name, value in args.items():
+            if isinstance(value, (list, tuple, set)):
+                value = sorted(value)
+            normalized[name] = value
+        if permission_labels is not None:
+            permission_labels = sorted(set(permission_labels))
+        key = json.dumps({
+            'args': normalized,
+            'permission_labels': permission_labels,
+        }, sort_keys=True, default=str)
+        return self._get_key(
+            'results',
+            '%s:%s:%s' % (doctype, generation, hashlib.md5(key).hexdigest()))
+
+    def get_or_search(self, doctype, args, permission_labels, search):
+        '''Returns the cached search results, or performs the search and
+        caches the results.
+
+        :param doctype: `str`, the document type.
+        :param args: `dict`, the Solr query arguments.
+        :param permission_labels: `list`, the permission labels of the user,
+            or `None` if the search is not restricted by permissions.
+        :param search: `function`, performs the actual search. Called with no
+            arguments, it must return picklable search results.
+
+        :returns: the search results.
+        '''
+        if not self.is_enabled():
+            return search()
+        try:
+            generation, settling = self._get_generation_state(doctype)
+            if settling:
+                # The index has uncommitted changes.
+                self._count('misses')
+                return search()
+            key = self.get_cache_key(doctype, generation, args,
+                                     permission_labels)
+            local = self.get_local()
+            value = local.get(key)
+            if value is not None:
+                self._count('local_hits')
+                return pickle.loads(value)
+            value = self._connect().get(key)
+            if value is not None:
+                self._count('redis_hits')
+                local.set(key, value)
+                return pickle.loads(value)
+        except Exception as e:
+            self._count('errors')
+            log.warning('Failed to read from the search cache. Error: %s',
+                        str(e))
+            return search()
+
+        self._count('misses')
+        results = search()
+        try:
+            value = pickle.dumps(results, pickle.HIGHEST_PROTOCOL)
+            self._connect().setex(key, value, self.get_timeout())
+            local.set(key, value)
+        except Exception as e:
+            self._count('errors')
+            log.warning('Failed to store the search results in the cache. '
+                        'Error: %s', str(e))
+        return results
+
+    def stats(self):
+        '''Returns the usage counters of the cache.
+
+        :returns: `dict`, the number of `local_hits`, `redis_hits`, `misses`
+            and `errors`, the overall `hit_rate` and the number of entries in
+            the local tier (`local_size`).
+        '''
+        with self._lock:
+            stats = dict(self._stats)
+        total = stats['local_hits'] + stats['redis_hits'] + stats['misses']
+        stats['hit_rate'] = (
+            float(stats['local_hits'] + stats['redis_hits']) / total
+            if total else 0.0)
+        stats['local_size'] = len(self._local) if self._local else 0
+        return stats
+
+
+class VersionedMap:
+    '''Base for the in-memory maps of rarely changing data, shared between
+    the processes through a version kept in Redis.
+
+    The map is loaded (with ``_load``) on first use and kept in memory. The
+    version of the map is bumped (with ``invalidate``) whenever the data
+    changes. The version is checked at most once every `check_interval`
+    seconds and the map is reloaded when the version changes, so every
+    process picks up the changes made by the others.
+
+    :param redis: The redis connection factory. If ommited, the default CKAN
+        Redis connection will be used.
+    :param check_interval: `int`, number of seconds between two checks of the
+        map version.
+    '''
+
+    VERSION_KEY = None
+
+    def __init__(self, redis=None, check_interval=1):
+        self.redis = redis or connect_to_redis
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._maps = None
+        self._version = None
+        self._checked = 0
+
+    def _connect(self):
+        return self.redis()
+
+    def _get_version(self):
+        try:
+            return self._connect().get(self.VERSION_KEY) or '0'
+        except Exception as e:
+            log.warning('Failed to check the version of %s. Error: %s',
+                        self.VERSION_KEY, str(e))
+        return None
+
+    def _load(self):
+        raise NotImplementedError()
+
+    def _get_maps(self):
+        with self._lock:
+            now = time.time()
+            if self._maps is not None and \
+                    now - self._checked < self.check_interval:
+                return self._maps
+            self._checked = now
+            version = self._get_version()
+            if self._maps is None or version is None or \
+                    version != self._version:
+                self._maps = self._load()
+                self._version = version
+            return self._maps
+
+    def invalidate(self):
+        '''Discards the map in all processes. Must be called whenever the
+        data in the map changes.
+        '''
+        with self._lock:
+            self._maps = None
+        try:
+            self._connect().incr(self.VERSION_KEY)
+        except Exception as e:
+            log.warning('Failed to invalidate %s. Error: %s',
+                        self.VERSION_KEY, str(e))
+
+
+class TagKeywordMap(VersionedMap):
+    '''In-memory map of the tags (by id and by name) and their keywords.
+
+    The map is built from the (extended) tag table joined with the keywords
+    table, with a single query. It is invalidated whenever a tag or a keyword
+    changes.
+
+    :param redis: The redis connection factory. If ommited, the default CKAN
+        Redis connection will be used.
+    :param check_interval: `int`, number of seconds between two checks of the
+        map version.
+    :param missing_timeout: `int`, number of seconds for which a tag that is
+        not found is not looked up again.
+    '''
+
+    VERSION_KEY = 'ckanext.knowledgehub.tag_keywords.version'
+
+    def __init__(self, redis=None, check_interval=1, missing_timeout=60):
+        VersionedMap.__init__(self, redis=redis,
+                              check_interval=check_interval)
+        self.missing_timeout = missing_timeout
+
+    def _load(self, tag_ref=None):
+        '''Loads the map of all tags and keywords, or just the tag referenced
+        by `tag_ref` (and its keyword).
+        '''
+        from ckan.model import Session, tag_table
+        from ckanext.knowledgehub.model.keyword import keyword_table
+
+        tags = {}
+        keywords = {}
+        query = Session.query(
+            tag_table.c.id,
+            tag_table.c.name,
+            tag_table.c.vocabulary_id,
+            keyword_table.c.id,
+            keyword_table.c.name,
+        ).select_from(tag_table.outerjoin(
+            keyword_table,
+            keyword_table.c.id == tag_table.c.keyword_id,
+            full=tag_ref is None))
+        if tag_ref is not None:
+            query = query.filter(or_(
+                tag_table.c.id == tag_ref,
+                and_(tag_table.c.name == tag_ref,
+                     tag_table.c.vocabulary_id == None)))  # noqa: E711
+        for tag_id, tag_name, vocabulary_id, kwd_id, kwd_name in query:
+            if kwd_id:
+                keywords[kwd_id] = {
+                    'id': kwd_id,
+                    'name': kwd_name,
+                }
+            if not tag_id:
+                # keyword without tags
+                continue
+            tag = {
+                'id': tag_id,
+                'name': tag_name,
+                'keyword_id': kwd_id,
+            }
+            tags[tag_id] = tag
+            if vocabulary_id is None:
+                tags.setdefault(tag_name, tag)
+        return {
+            'tags': tags,
+            'keywords': keywords,
+        }
+
+    def get_tag(self, tag_ref):
+        '''Returns the tag referenced by id or name.
+
+        :returns: `dict`, the tag `id`, `name` and `keyword_id`, or `None` if
+            there is no such tag.
+        '''
+        maps = self._get_maps()
+        tag = maps['tags'].get(tag_ref)
+        if tag is None and tag_ref:
+            # The tags are also created by CKAN (with the datasets) without
+            # invalidating the map, so the tags missing from the map are
+            # looked up in the database. The tags that are not found (e.g.
+            # deleted tags still referenced by a dashboard) are not looked up
+            # again until the map is reloaded or the miss expires.
+            missing = maps.setdefault('missing', {})
+            if missing.get(tag_ref, 0) > time.time():
+                return None
+            found = self._load(tag_ref)
+            tag = found['tags'].get(tag_ref)
+            with self._lock:
+                maps['tags'].update(found['tags'])
+                maps['keywords'].update(found['keywords'])
+                if tag is None:
+                    missing[tag_ref] = time.time() + self.missing_timeout
+        return tag
+
+    def get_keyword(self, keyword_id):
+        '''Returns the keyword with the given id.
+
+        :returns: `dict`, the keyword `id` and `name`, or `None` if there is
+            no such keyword.
+        '''
+        return self._get_maps()['keywords'].get(keyword_id)
+
+    def get_tag_keywords(self, tag_refs):
+        '''Returns the keywords of the tags referenced by id or name.
+
+        :param tag_refs: `list` of `str`, the ids or names of the tags.
+
+        :returns: `list` of `dict`, the distinct keywords (`id` and `name`) of
+            the tags.
+        '''
+        keywords = []
+        for tag_ref in tag_refs:
+            tag = self.get_tag(tag_ref)
+            if not tag or not tag['keyword_id']:
+                continue
+            keyword = self.get_keyword(tag['keyword_id'])
+            if keyword and keyword not in keywords:
+                keywords.append(keyword)
+        return keywords
+
+
+class GroupMap(VersionedMap):
+    '''In-memory map of the active groups and organizations, by name.
+
+    The map is loaded with a single query and is invalidated whenever a group
+    or an organization is created, updated or deleted.
+    '''
+
+    VERSION_KEY = 'ckanext.knowledgehub.groups.version'
+
+    def _load(self):
+        from ckan.model import Session, Group
+
+        groups = OrderedDict()
+        query = Session.query(Group).filter(Group.state == 'active')
+        for group in query.order_by(Group.name):
+            groups[group.name] = {
+                'id': group.id,
+                'name': group.name,
+                'title': group.title,
+                'image_url': group.image_url,
+                'is_organization': group.is_organization,
+            }
+        return groups
+
+    def find(self, names=None):
+        '''Returns the active groups and organizations.
+
+        :param names: `list` of `str`, the names of the groups to return. If
+            ommited, all groups and organizations are returned.
+
+        :returns: `list` of `dict`, the groups (`id`, `name`, `title`,
+            `image_url` and `is_organization`), ordered by name.
+        '''
+        groups = self._get_maps()
+        if names is None:
+            return list(groups.values())
+        return [groups[name] for name in sorted(set(names))
+                if name in groups]
+
+    def get_titles(self, names):
+        '''Returns the titles of the groups and organizations with the given
+        names.
+
+        :param names: `list` of `str`, the names of the groups.
+
+        :returns: `dict`, the name of every found group mapped to its title.
+        '''
+        return dict([(group['name'], group['title'])
+                     for group in self.find(names)])
+
+
+class PermissionLabelsCache:
+    '''Two-tier (in-process LRU and Redis) cache of the permission labels
+    derived from the memberships of the users in groups and organizations.
+
+    The labels are cached under a key derived from the user id and the
+    membership version - a counter kept in Redis that is bumped (with
+    ``bump_version``) whenever a membership, or a group or organization,
+    changes. The cached labels of all users become unreachable then and just
+    expire from the cache.
+
+    :param redis: The redis connection factory. If ommited, the default CKAN
+        Redis connection will be used.
+    :param local: `LRUCache`, the in-process cache tier. If ommited, one is
+        created based on the configuration.
+    '''
+
+    CACHE_PREFIX = 'ckanext.knowledgehub.permission_labels'
+
+    def __init__(self, redis=None, local=None):
+        self.redis = redis or connect_to_redis
+        self._local = local
+
+    def _connect(self):
+        return self.redis()
+
+    def _get_key(self, suffix, value=None):
+        if value is None:
+            return '%s.%s' % (PermissionLabelsCache.CACHE_PREFIX, suffix)
+        return '%s.%s:%s' % (PermissionLabelsCache.CACHE_PREFIX, suffix,
+                             value)
+
+    def get_timeout(self):
+        return int(config.get(
+            'ckanext.knowledgehub.permission_labels.cache_timeout', 300))
+
+    def get_local(self):
+        if self._local is None:
+            self._local = LRUCache(size=1024, timeout=self.get_timeout())
+        return self._local
+
+    def get_version(self):
+        '''Returns the current membership version.'''
+        return self._connect().get(self._get_key('version')) or '0'
+
+    def bump_version(self):
+        '''Invalidates the cached labels of all users.'''
+        try:
+            self._connect().incr(self._get_key('version'))
+        except Exception as e:
+            log.warning('Failed to invalidate the permission labels cache. '
+                        'Error: %s', str(e))
+
+    def get_or_load(self, user_id, load):
+        '''Returns the cached labels of the user, or loads them and caches
+        them.
+
+        :param user_id: `str`, the id of the user.
+        :param load: `function`, called with no arguments to load the labels
+            of the user. It must return a `list` of `str`.
+
+        :returns: `list` of `str`, the labels of the user.
+        '''
+        try:
+            key = self._get_key('labels', '%s:%s' % (user_id,
+                                                     self.get_version()))
+            local = self.get_local()
+            labels = local.get(key)
+            if labels is None:
+                value = self._connect().get(key)
+                if value is not None:
+                    labels = json.loads(value)
+                    local.set(key, labels)
+            if labels is not None:
+                return list(labels)
+        except Exception as e:
+            log.warning('Failed to read from the permission labels cache. '
+                        'Error: %s', str(e))
+            return load()
+
+        labels = load()
+        try:
+            self._connect().setex(key, json.dumps(labels), self.get_timeout())
+            local.set(key, labels)
+        except Exception as e:
+            log.warning('Failed to store the permission labels in the cache. '
+                        'Error: %s', str(e))
+        return list(labels)
+
+
+search_results_cache = SearchResultsCache()
+tag_keyword_map = TagKeywordMap()
+group_map = GroupMap()
+permission_labels_cache = PermissionLabelsCache()
@@ -0,0 +1,354 @@
+"""
+Copyright (c) 2018 Keitaro AB
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+'''Batching loader for the entities referenced by the indexed documents.
+'''
+import threading
+from contextlib import contextmanager
+
+from sqlalchemy import or_, and_
+
+from ckan import model
+from logging import getLogger
+
+
+log = getLogger(__name__)
+
+_scope = threading.local()
+
+
+def split_refs(value):
+    '''Splits a comma separated string of references (ids or names) into a
+    list of stripped, non-empty references. Lists are returned as they are.
+    '''
+    if not value:
+        return []
+    if isinstance(value, (list, tuple, set)):
+        return list(value)
+    return [ref.strip() for ref in value.split(',') if ref and ref.strip()]
+
+
+def _match(refs, entities, *attrs):
+    '''Maps every reference to the entity it references.
+
+    The references are matched against the attributes of the entities in the
+    given order of precedence - for example, a reference that matches both the
+    id of one entity and the name of another, references the first one.
+    '''
+    refs = set(refs)
+    matched = {}
+    for attr in reversed(attrs):
+        for entity in entities:
+            value = entity.get(attr)
+            if value in refs:
+                matched[value] = entity
+    return matched
+
+
+def _group_dict(group):
+    return {
+        'id': group.id,
+        'name': group.name,
+        'title': group.title,
+        'type': group.type,
+        'state': group.state,
+        'is_organization': group.is_organization,
+    }
+
+
+def _load_packages(refs):
+    packages = model.Session.query(model.Package).filter(
+        or_(model.Package.id.in_(refs),
+            model.Package.name.in_(refs))
+    ).all()
+    if not packages:
+        return {}
+    package_ids = [pkg.id for pkg in packages]
+
+    extras = {}
+    query = model.Session.query(model.PackageExtra).filter(
+        model.PackageExtra.package_id.in_(package_ids),
+        model.PackageExtra.state == 'active',
+    )
+    for extra in query:
+        extras.setdefault(extra.package_id, {})[extra.key] = extra.value
+
+    organizations = {}
+    org_ids = set([pkg.owner_org for pkg in packages if pkg.owner_org])
+    if org_ids:
+        query = model.Session.query(model.Group).filter(
+            model.Group.id.in_(org_ids))
+        for org in query:
+            organizations[org.id] = _group_dict(org)
+
+    groups = {}
+    query = model.Session.query(model.Member.table_id, model.Group).join(
+        model.Group, model.Group.id == model.Member.group_id
+    ).filter(
+        model.Member.table_name == 'package',
+        model.Member.table_id.in_(package_ids),
+        model.Member.state == 'active',
+        model.Group.is_organization == False,  # noqa: E712
+        model.Group.state == 'active',
+    )
+    for package_id, group in query:
+        groups.setdefault(package_id, []).append(_group_dict(group))
+
+    tags = {}
+    query = model.Session.query(model.PackageTag.package_id, model.Tag).join(
+        model.Tag, model.Tag.id == model.PackageTag.tag_id
+    ).filter(
+        model.PackageTag.package_id.in_(package_ids),
+        model.PackageTag.state == 'active',
+        model.Tag.vocabulary_id == None,  # noqa: E711
+    )
+    for package_id, tag in query:
+        tags.setdefault(package_id, []).append({
+            'id': tag.id,
+            'name': tag.name,
+        })
+
+    results = []
+    for pkg in packages:
+        pkg_dict = dict(extras.get(pkg.id, {}))
+        pkg_dict.update({
+            'id': pkg.id,
+            'name': pkg.name,
+            'title': pkg.title,
+            'type': pkg.type,
+            'state': pkg.state,
+            'private': pkg.private,
+            'owner_org': pkg.owner_org,
+            'organization': organizations.get(pkg.owner_org),
+            'groups': groups.get(pkg.id, []),
+            'tags': tags.get(pkg.id, []),
+        })
+        results.append(pkg_dict)
+    return _match(refs, results, 'id', 'name')
+
+
+def _load_groups(refs):
+    groups = model.Session.query(model.Group).filter(
+        or_(model.Group.id.in_(refs),
+            model.Group.name.in_(refs))
+    ).all()
+    return _match(refs, [_group_dict(group) for group in groups],
+                  'id', 'name')
+
+
+def _load_users(refs):
+    users = model.Session.query(model.User).filter(
+        or_(model.User.id.in_(refs),
+            model.User.name.in_(refs))
+    ).all()
+    return _match(refs, [{
+        'id': user.id,
+        'name': user.name,
+        'state': user.state,
+    } for user in users], 'id', 'name')
+
+
+def _load_tags(refs):
+    from ckanext.knowledgehub.model import ExtendedTag
+
+    tags = model.Session.query(ExtendedTag).filter(
+        or_(model.tag_table.c.id.in_(refs),
+            and_(model.tag_table.c.name.in_(refs),
+                 model.tag_table.c.vocabulary_id == None))  # noqa: E711
+    ).all()
+    return _match(refs, [{
+        'id': tag.id,
+        'name': tag.name,
+        'vocabulary_id': tag.vocabulary_id,
+        'keyword_id': tag.keyword_id,
+    } for tag in tags], 'id', 'name')
+
+
+def _load_keywords(refs):
+    from ckanext.knowledgehub.model import Keyword
+
+    keywords = model.Session.query(Keyword).filter(
+        or_(Keyword.id.in_(refs),
+            Keyword.name.in_(refs))
+    ).all()
+    return _match(refs, [{
+        'id': keyword.id,
+        'name': keyword.name,
+    } for keyword in keywords], 'id', 'name')
+
+
+def _load_research_questions(refs):
+    from ckanext.knowledgehub.model import ResearchQuestion
+
+    research_questions = model.Session.query(ResearchQuestion).filter(
+        or_(ResearchQuestion.id.in_(refs),
+            ResearchQuestion.name.in_(refs),
+            ResearchQuestion.title.in_(refs))
+    ).all()
+    return _match(refs, [rq.as_dict() for rq in research_questions],
+                  'id', 'name', 'title')
+
+
+def _load_resource_views(refs):
+    query = model.Session.query(
+        model.ResourceView,
+        model.Resource.package_id,
+    ).join(
+        model.Resource, model.Resource.id == model.ResourceView.resource_id
+    ).filter(model.ResourceView.id.in_(refs))
+
+    resource_views = []
+    for resource_view, package_id in query:
+        # the same as resource_view_show
+        rv_dict = dict(resource_view.as_dict())
+        rv_dict.pop('order', None)
+        rv_dict.update(rv_dict.pop('config', None) or {})
+        rv_dict['package_id'] = package_id
+        resource_views.append(rv_dict)
+    return _match(refs, resource_views, 'id')
+
+
+def _load_dashboards(refs):
+    from ckanext.knowledgehub.model import Dashboard
+
+    dashboards = model.Session.query(Dashboard).filter(
+        or_(Dashboard.id.in_(refs),
+            Dashboard.name.in_(refs))
+    ).all()
+    return _match(refs, [dict(dashboard.as_dict())
+                         for dashboard in dashboards], 'id', 'name')
+
+
+class EntityLoader:
+    '''Loads the entities referenced by the indexed documents (packages,
+    tags, research questions etc) in bulk, and memoizes them.
+
+    The references (ids or names, and titles for research questions) are
+    first queued with ``prime``. When an entity is requested with ``load`` or
+    ``load_many``, all of the queued references for that entity type are
+    resolved at once, so the entities referenced by a whole chunk of documents
+    are loaded with a single round of queries per entity type. Every entity is
+    loaded at most once - the results, including the references to missing
+    entities, are kept for the lifetime of the loader.
+
+    The loaded entities are plain dicts, shared between all callers, and must
+    not be modified.
+
+    Supported entity types: `package`, `group` (groups and organizations),
+    `user`, `tag`, `keyword`, `research_question`, `resource_view` and
+    `dashboard`.
+    '''
+
+    batch_loaders = {
+        'package': _load_packages,
+        'group': _load_groups,
+        'user': _load_users,
+        'tag': _load_tags,
+        'keyword': _load_keywords,
+        'research_question': _load_research_questions,
+        'resource_view': _load_resource_views,
+        'dashboard': _load_dashboards,
+    }
+
+    def __init__(self):
+        self._loaded = {}
+        self._queued = {}
+
+    def prime(self, entity_type, refs):
+        '''Queues the references to be loaded with the next batch for the
+        entity type.
+
+        :param entity_type: `str`, the type of the entities.
+        :param refs: `list` of references (ids or names) to the entities.
+        '''
+        if entity_type not in self.batch_loaders:
+            raise ValueError('Unknown entity type: %s' % entity_type)
+        loaded = self._loaded.setdefault(entity_type, {})
+        queued = self._queued.setdefault(entity_type, set())
+        for ref in refs:
+            if ref and ref not in loaded:
+                queued.add(ref)
+
+    def load_many(self, entity_type, refs):
+        '''Loads the referenced entities, together with all of the queued
+        references for that entity type.
+
+        :param entity_type: `str`, the type of the entities.
+        :param refs: `list` of references (ids or names) to the entities.
+
+        :returns: `list` of `dict`, the entities in the order of the
+            references. Missing entities are returned as `None`.
+        '''
+        refs = [ref for ref in refs if ref]
+        self.prime(entity_type, refs)
+        queued = self._queued.pop(entity_type, None)
+        loaded = self._loaded[entity_type]
+        if queued:
+            found = self.batch_loaders[entity_type](list(queued))
+            missing = []
+            for ref in queued:
+                loaded[ref] = found.get(ref)
+                if loaded[ref] is None:
+                    missing.append(ref)
+            # the entities can be referenced later by the id as well
+            for entity in found.values():
+                loaded.setdefault(entity['id'], entity)
+            if missing:
+                log.warning('Referenced %s not found: %s',
+                            entity_type, ', '.join(sorted(missing)))
+        return [loaded[ref] for ref in refs]
+
+    def load(self, entity_type, ref):
+        '''Loads a single referenced entity, together with all of the queued
+        references for that entity type.
+
+        :returns: `dict`, the entity or `None` if there is no such entity.
+        '''
+        if not ref:
+            return None
+        return self.load_many(entity_type, [ref])[0]
+
+    def clear(self):
+        self._loaded.clear()
+        self._queued.clear()
+
+
+def get_entity_loader():
+    '''Returns the entity loader for the current scope (see
+    ``entity_loader_scope``). If there is no active scope, a new loader is
+    returned.
+    '''
+    return getattr(_scope, 'loader', None) or EntityLoader()
+
+
+@contextmanager
+def entity_loader_scope():
+    '''Opens a scope in which all calls to ``get_entity_loader`` (in the
+    current thread) return the same loader, so the loaded entities are shared
+    for the duration of the scope - for example for a whole index rebuild.
+
+    Nested scopes share the loader of the outermost scope.
+    '''
+    loader = getattr(_scope, 'loader', None)
+    if loader is not None:
+        yield loader
+        return
+    _scope.loader = EntityLoader()
+    try:
+        yield _scope.loader
+    finally:
+        _scope.loader = None
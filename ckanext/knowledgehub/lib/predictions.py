@@ -0,0 +1,271 @@
+"""
+Copyright (c) 2018 Keitaro AB
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+'''In-memory prefix index of the Knowledge Hub data used for the predictive
+search.
+'''
+import bisect
+import heapq
+import threading
+import time
+
+from ckan.common import config
+from ckan.lib.redis import connect_to_redis
+from logging import getLogger
+
+
+log = getLogger(__name__)
+
+# The number of (last) words of the query matched against the index.
+MAX_QUERY_WORDS = 3
+
+
+def normalize_text(text):
+    '''Lowercases the text and collapses the whitespace.'''
+    return u' '.join((text or u'').lower().split())
+
+
+def get_completion(text, start):
+    '''Returns the continuation of the text at the given position - an
+    optional leading space (when the text continues with a new word) and the
+    alphanumeric characters up to the next word boundary.
+    '''
+    completion = u''
+    for i, ch in enumerate(text[start:]):
+        if ch.isalnum() or (i == 0 and ch == u' '):
+            completion += ch
+        else:
+            break
+    return completion
+
+
+class PredictionIndex:
+    '''In-process prefix index of the titles and descriptions in the
+    Knowledge Hub data (`kwh_data`), that completes the search queries.
+
+    Every text is indexed as the (sorted) list of its suffixes that start at
+    a word, up to ``MAX_QUERY_WORDS`` + 1 words long, with the number of
+    occurrences of every suffix. The completions of a query are found with a
+    binary search for the last words of the query, and are ranked by the
+    number of occurrences.
+
+    The index is built on first use and refreshed at most once every
+    `check_interval` seconds: the rows created since the last refresh are
+    added to the index. The index is rebuilt when the data is changed or
+    removed (see ``invalidate``), in any process, and every
+    `rebuild_interval` seconds.
+
+    :param redis: The redis connection factory. If ommited, the default CKAN
+        Redis connection will be used.
+    :param check_interval: `int`, number of seconds between two refreshes.
+        If not given, `ckanext.knowledgehub.predictions.check_interval` is
+        used.
+    :param rebuild_interval: `int`, number of seconds between two rebuilds.
+        If not given, `ckanext.knowledgehub.predictions.rebuild_interval` is
+        used.
+    :param max_scan: `int`, the maximal number of indexed suffixes scanned
+        for a query.
+    '''
+
+    VERSION_KEY = 'ckanext.knowledgehub.predictions.version'
+
+    def __init__(self, redis=None, check_interval=None,
+                 rebuild_interval=None, max_scan=5000):
+        self.redis = redis or connect_to_redis
+        self.check_interval = check_interval
+        self.rebuild_interval = rebuild_interval
+        self.max_scan = max_scan
+        self._refresh_lock = threading.Lock()
+        self._suffixes = None
+        self._counts = {}
+        self._watermark = None
+        self._watermark_ids = set()
+        self._version = None
+        self._checked = 0
+        self._built = 0
+
+    def _connect(self):
+        return self.redis()
+
+    def get_check_interval(self):
+        if self.check_interval is not None:
+            return self.check_interval
+        return int(config.get(
+            'ckanext.knowledgehub.predictions.check_interval', 10))
+
+    def get_rebuild_interval(self):
+        if self.rebuild_interval is not None:
+            return self.rebuild_interval
+        return int(config.get(
+            'ckanext.knowledgehub.predictions.rebuild_interval', 3600))
+
+    def _get_version(self):
+        try:
+            return self._connect().get(self.VERSION_KEY) or '0'
+        except Exception as e:
+            log.warning('Failed to check the version of %s. Error: %s',
+                        self.VERSION_KEY, str(e))
+        return None
+
+    def _query_rows(self, since=None):
+        # Delay the loading of the model
+        from ckan.model import Session
+        from ckanext.knowledgehub.model import KWHData
+
+        query = Session.query(KWHData.id,
+                              KWHData.title,
+                              KWHData.description,
+                              KWHData.created_at)
+        if since is not None:
+            query = query.filter(KWHData.created_at >= since)
+        return query.order_by(KWHData.created_at).all()
+
+    def _index_rows(self, rows, counts, watermark, watermark_ids):
+        '''Counts the suffixes of the texts in the rows.
+
+        :returns: `tuple` of the `list` of the suffixes that were not in the
+            counts before, and the new watermark and watermark ids.
+        '''
+        new_suffixes = []
+        for row_id, title, description, created_at in rows:
+            if created_at is not None and watermark is not None:
+                if created_at < watermark or (created_at == watermark and
+                                              row_id in watermark_ids):
+                    # already indexed
+                    continue
+            for text in [title, description]:
+                words = normalize_text(text).split(u' ')
+                for i in range(len(words)):
+                    suffix = u' '.join(words[i:i + MAX_QUERY_WORDS + 1])
+                    if not suffix:
+                        continue
+                    if suffix not in counts:
+                        counts[suffix] = 0
+                        new_suffixes.append(suffix)
+                    counts[suffix] += 1
+            if created_at is None:
+                continue
+            if watermark is None or created_at > watermark:
+                watermark = created_at
+                watermark_ids = set()
+            watermark_ids.add(row_id)
+        return new_suffixes, watermark, watermark_ids
+
+    def _rebuild(self):
+        counts = {}
+        suffixes, watermark, watermark_ids = self._index_rows(
+            self._query_rows(), counts, None, set())
+        suffixes.sort()
+        self._counts = counts
+        self._suffixes = suffixes
+        self._watermark = watermark
+        self._watermark_ids = watermark_ids
+        self._built = time.time()
+        log.debug('Built the predictions index: %d suffixes.', len(suffixes))
+
+    def _refresh(self):
+        new_suffixes, watermark, watermark_ids = self._index_rows(
+            self._query_rows(since=self._watermark),
+            self._counts,
+            self._watermark,
+            set(self._watermark_ids))
+        if new_suffixes:
+            self._suffixes = list(heapq.merge(self._suffixes,
+                                              sorted(new_suffixes)))
+        self._watermark = watermark
+        self._watermark_ids = watermark_ids
+
+    def _ensure_fresh(self):
+        if self._suffixes is not None and \
+                time.time() - self._checked < self.get_check_interval():
+            return
+        with self._refresh_lock:
+            now = time.time()
+            if self._suffixes is not None and \
+                    now - self._checked < self.get_check_interval():
+                # refreshed by another thread
+                return
+            self._checked = now
+            version = self._get_version()
+            try:
+                if self._suffixes is None or \
+                        (version is not None and version != self._version) \
+                        or now - self._built >= self.get_rebuild_interval():
+                    self._rebuild()
+                    self._version = version
+                else:
+                    self._refresh()
+            except Exception as e:
+                log.warning('Failed to refresh the predictions index. '
+                            'Error: %s', str(e))
+
+    def complete(self, query, limit=3):
+        '''Completes the last word of the query, or predicts the next word if
+        the query ends with a whitespace.
+
+        :param query: `str`, the search query.
+        :param limit: `int`, the maximal number of completions.
+
+        :returns: `list` of the completions, the most frequent first.
+        '''
+        self._ensure_fresh()
+        suffixes, counts = self._suffixes, self._counts
+        if not suffixes or not query:
+            return []
+        if isinstance(query, str):
+            query = query.decode('utf-8')
+
+        prefix = u' '.join(query.lower().split()[-MAX_QUERY_WORDS:])
+        if not prefix:
+            return []
+        if query[-1].isspace():
+            prefix += u' '
+
+        completions = {}
+        start = bisect.bisect_left(suffixes, prefix)
+        for i in range(start, min(len(suffixes), start + self.max_scan)):
+            suffix = suffixes[i]
+            if not suffix.startswith(prefix):
+                break
+            completion = get_completion(suffix, len(prefix))
+            if completion.strip():
+                completions[completion] = completions.get(completion, 0) + \
+                    counts.get(suffix, 0)
+
+        ranked = sorted(completions.items(),
+                        key=lambda item: (-item[1], item[0]))
+        return [completion for completion, _ in ranked[:limit]]
+
+    def mark_stale(self):
+        '''Refreshes the index of this process on the next query. Called when
+        new data is created, so it can be predicted right away.
+        '''
+        self._checked = 0
+
+    def invalidate(self):
+        '''Rebuilds the index in all processes. Must be called whenever the
+        indexed data is changed or removed.
+        '''
+        self._checked = 0
+        try:
+            self._connect().incr(self.VERSION_KEY)
+        except Exception as e:
+            log.warning('Failed to invalidate %s. Error: %s',
+                        self.VERSION_KEY, str(e))
+
+
+prediction_index = PredictionIndex()
@@ -26,6 +26,7 @@ from ckan.lib.dictization import table_dictize
 
 from ckanext.knowledgehub.model.user_profile import UserProfile
 from ckanext.knowledgehub.model.query import UserQueryResult
+from ckanext.knowledgehub.lib.cache import tag_keyword_map
 from logging import getLogger
 
 
@@ -44,6 +45,8 @@ class UserProfileService:
         user profile data
     :param user_ques_result: `UserQueryResult`, model to be used for accessing
         the relevant user queries.
+    :param tag_keywords: `TagKeywordMap`, the map used to resolve the tags and
+        their keywords.
     '''
 
     PROFILE_CACHE_PREFIX = 'ckanext.knowledgehub.user.profile'
@@ -52,10 +55,12 @@ class UserProfileService:
     RELEVANT_SEARCHES = config.get('ckanext.knowledgehub.relevant_searches', 5)
 
     def __init__(self, redis=None, user_profile=UserProfile,
-                 user_query_result=UserQueryResult):
+                 user_query_result=UserQueryResult,
+                 tag_keywords=tag_keyword_map):
         self.redis = redis or connect_to_redis
         self.user_profile = user_profile
         self.user_query_result = user_query_result
+        self.tag_keywords = tag_keywords
 
     def _get_key(self, user_id, suffix=None):
         if suffix:
@@ -216,22 +221,14 @@ class UserProfileService:
             })
             if dashboard and dashboard.get('tags'):
                 for tag in dashboard['tags'].split(','):
-                    tag = _action('tag_show', {
-                        'ignore_auth': True
-                    }, {
-                        'id': tag
-                    })
+                    tag = self.tag_keywords.get_tag(tag)
                     if tag:
                         relevant['tags'].add(tag['name'])
-                        if tag.get('keyword_id') is not None:
+                        if tag['keyword_id'] is not None:
                             keywords.add(tag['keyword_id'])
 
         for keyword in keywords:
-            keyword = _action('keyword_show', {
-                'ignore_auth': True
-            }, {
-                'id': keyword
-            })
+            keyword = self.tag_keywords.get_keyword(keyword)
             if keyword:
                 relevant['keywords'].add(keyword['name'])
 
@@ -41,6 +41,10 @@ class PredictiveSearchConfig(object):
             u'ckanext.knowledgehub.rnn.model_network',
             './keras_model_network.h5'
         )
+        self.vocabulary_path = config.get(
+            u'ckanext.knowledgehub.rnn.model_vocabulary',
+            './keras_model_vocabulary.json'
+        )
         self.history_path = config.get(
             u'ckanext.knowledgehub.rnn.history',
             './history.p'
@@ -55,3 +59,9 @@ class PredictiveSearchConfig(object):
                 3
             )
         )
+        self.beam_width = int(
+            config.get(
+                u'ckanext.knowledgehub.rnn.beam_width',
+                5
+            )
+        )
@@ -15,8 +15,10 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import json
 import logging
 import os
+import threading
 
 import heapq
 import numpy as np
@@ -28,6 +30,182 @@ from ckanext.knowledgehub.lib.rnn.data_manager import DataManager
 from ckanext.knowledgehub.lib.rnn.config import PredictiveSearchConfig
 
 
+log = logging.getLogger('ckanext.PredictiveSearchModel')
+
+
+class LoadedModel(object):
+    ''' A trained model loaded in its own TensorFlow graph and session,
+    together with the character vocabulary and the sequence length it was
+    trained with.
+
+    The predictions that use the model hold a reference to it (see
+    ``acquire`` and ``release``). Once the model is replaced by a newer one
+    (``retire``), its session is closed as soon as the last prediction that
+    uses it finishes.
+    '''
+
+    def __init__(self, version, graph, session, model, vocabulary):
+        self.version = version
+        self.graph = graph
+        self.session = session
+        self.model = model
+        self.metadata = vocabulary
+        self.sequence_length = int(vocabulary['sequence_length'])
+        self.unique_chars, self.char_indices, self.indices_char = \
+            DataManager.prepare_corpus(vocabulary['chars'])
+        self._lock = threading.Lock()
+        self._users = 0
+        self._retired = False
+        self.closed = False
+
+    def acquire(self):
+        ''' Marks the model as used by a prediction.
+
+        :returns: ``False`` if the model is already closed and can not be
+            used.
+        '''
+        with self._lock:
+            if self.closed:
+                return False
+            self._users += 1
+            return True
+
+    def release(self):
+        ''' Marks the prediction that used the model as finished. '''
+        with self._lock:
+            self._users -= 1
+            close = self._retired and self._users <= 0
+        if close:
+            self._close()
+
+    def retire(self):
+        ''' Closes the model once it is no longer used by any prediction. '''
+        with self._lock:
+            self._retired = True
+            close = self._users <= 0
+        if close:
+            self._close()
+
+    def _close(self):
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+        try:
+            self.session.close()
+        except Exception as e:
+            log.warning('Failed to close the predictive search model '
+                        '(version: %s). Error: %s', str(self.version), str(e))
+        # Release the graph and the weights.
+        self.model = None
+        self.graph = None
+        self.session = None
+
+
+class PredictiveModelHolder(object):
+    ''' Keeps the trained model loaded for the lifetime of the process.
+
+    The model is loaded the first time it is needed and reused by all of the
+    predictions. The version of the loaded model is the modification time of
+    the model files (network, weights and vocabulary), so when the worker
+    saves a newly trained model, the next prediction loads it and swaps it
+    in. The predictions that are running while the new model is loaded keep
+    using the previous one, which is closed when they finish.
+    '''
+
+    def __init__(self):
+        self._loaded = None
+        self._load_lock = threading.Lock()
+
+    def _get_version(self, config):
+        try:
+            return (os.path.getmtime(config.network_path),
+                    os.path.getmtime(config.weights_path),
+                    os.path.getmtime(config.vocabulary_path))
+        except OSError:
+            return None
+
+    def _load(self, config):
+        # Acquire the locks in the same order as the worker when it saves
+        # the model.
+        lock_model_network = FileLock('%s.lock' % config.network_path)
+        lock_model_weigths = FileLock('%s.lock' % config.weights_path)
+
+        with lock_model_network.acquire(timeout=1000):
+            with lock_model_weigths.acquire(timeout=1000):
+                version = self._get_version(config)
+                graph = tf.Graph()
+                with graph.as_default():
+                    session = tf.Session()
+                    with session.as_default():
+                        with open(config.network_path, 'r') as json_file:
+                            model = model_from_json(json_file.read())
+                        model.load_weights(config.weights_path)
+                        # Build the predict function up front, so the model
+                        # can be used from multiple threads.
+                        model._make_predict_function()
+                with open(config.vocabulary_path, 'r') as vocabulary_file:
+                    vocabulary = json.load(vocabulary_file)
+
+        log.info('Loaded predictive search model (version: %s, trained at: '
+                 '%s).', str(version), vocabulary.get('created_at'))
+        return LoadedModel(version, graph, session, model, vocabulary)
+
+    def get(self, config):
+        ''' Returns the loaded model, loading it first if there is no model
+        loaded yet or the model files have changed.
+
+        :param config: ``PredictiveSearchConfig``, the paths to the model
+            files.
+
+        :returns: ``LoadedModel`` or ``None`` if there is no trained model.
+        '''
+        version = self._get_version(config)
+        if version is None:
+            return None
+        loaded = self._loaded
+        if loaded is not None and loaded.version == version:
+            return loaded
+
+        if not self._load_lock.acquire(False):
+            if loaded is not None:
+                # Another thread is loading the new version.
+                return loaded
+            self._load_lock.acquire()
+        try:
+            if self._loaded is None or self._loaded.version != version:
+                previous = self._loaded
+                self._loaded = self._load(config)
+                if previous is not None:
+                    previous.retire()
+            return self._loaded
+        finally:
+            self._load_lock.release()
+
+    def acquire(self, config):
+        ''' Returns the loaded model (see ``get``), marked as used. The
+        caller must call ``release`` on the model once done with it.
+
+        :param config: ``PredictiveSearchConfig``, the paths to the model
+            files.
+
+        :returns: ``LoadedModel`` or ``None`` if there is no trained model.
+        '''
+        while True:
+            loaded = self.get(config)
+            if loaded is None or loaded.acquire():
+                return loaded
+            # The model was replaced and closed in the meantime.
+
+    def clear(self):
+        loaded, self._loaded = self._loaded, None
+        if loaded is not None:
+            loaded.retire()
+
+
+model_holder = PredictiveModelHolder()
+
+
 class PredictiveSearchModel(PredictiveSearchConfig):
     ''' Use the machine learning model trained by the worker.
 
@@ -43,9 +221,14 @@ class PredictiveSearchModel(PredictiveSearchConfig):
         self.logger = logging.getLogger('ckanext.PredictiveSearchModel')
 
     def prepare_input(self, text):
-        x = np.zeros((1, self.sequence_length, len(self.unique_chars)))
-        for t, char in enumerate(text):
-            x[0, t, self.char_indices[char]] = 1.
+        return self.prepare_input_batch([text])
+
+    def prepare_input_batch(self, texts):
+        x = np.zeros((len(texts), self.sequence_length,
+                      len(self.unique_chars)))
+        for i, text in enumerate(texts):
+            for t, char in enumerate(text):
+                x[i, t, self.char_indices[char]] = 1.
 
         return x
 
@@ -57,70 +240,115 @@ class PredictiveSearchModel(PredictiveSearchConfig):
 
         return heapq.nlargest(top_n, range(len(preds)), preds.take)
 
-    def predict_completion(self, text):
-        completion = ''
-        while True:
-            x = self.prepare_input(text)
-            preds = self.model.predict(x, verbose=0)[0]
-            next_index = self.sample(preds, top_n=1)[0]
-            next_char = self.indices_char[next_index]
-            if not next_char.isalnum():
-                return completion
+    def predict_completions(self, text, top_n=3):
+        ''' Completes the text with beam search.
+
+        All of the beams are extended with a single (batched) forward pass
+        per step. The first predicted character may start a new word, after
+        that a completion ends on the first character that is not
+        alphanumeric (a word boundary). The search stops early once none of
+        the beams can score better than the completions found so far.
+
+        :param text: the text to complete, `sequence_length` characters long
+        :param top_n: the number of completions to return
+
+        :returns: a list of (completion, probability) tuples, the most
+            probable completion first
+        '''
+        beam_width = max(self.beam_width, top_n)
+        beams = [('', 0.0)]
+        finished = {}
+
+        def _finish(completion, score):
+            if completion.strip() and \
+                    score > finished.get(completion, float('-inf')):
+                finished[completion] = score
+
+        for step in range(self.sequence_length):
+            x = self.prepare_input_batch([
+                (text + completion)[-self.sequence_length:]
+                for completion, _ in beams])
+            preds = self.model.predict(x, batch_size=len(beams), verbose=0)
+            log_preds = np.log(np.maximum(
+                np.asarray(preds).astype('float64'), 1e-12))
+
+            candidates = []
+            for (completion, score), row in zip(beams, log_preds):
+                for idx in np.argsort(row)[::-1][:beam_width]:
+                    next_char = self.indices_char[idx]
+                    next_score = score + row[idx]
+                    if step > 0 and not next_char.isalnum():
+                        _finish(completion, next_score)
+                    else:
+                        candidates.append((completion + next_char,
+                                           next_score))
 
-            text = text[1:] + next_char
+            beams = heapq.nlargest(beam_width, candidates,
+                                   key=lambda beam: beam[1])
+            if not beams:
+                break
+            # The scores only decrease as the beams are extended.
+            if len(finished) >= top_n and \
+                    beams[0][1] <= sorted(finished.values())[-top_n]:
+                beams = []
+                break
 
-            completion += next_char
-            if (len(text + completion) + 2 > len(text) and next_char == ' '):
-                return completion
+        # The beams that reached the maximal length are complete as well.
+        for completion, score in beams:
+            _finish(completion, score)
+
+        completions = heapq.nlargest(top_n, finished.items(),
+                                     key=lambda item: item[1])
+        return [(completion, float(np.exp(score)))
+                for completion, score in completions]
 
     def predict(self, search_text):
-        self.unique_chars, self.char_indices, self.indices_char = \
-            DataManager.prepare_corpus(DataManager.get_last_corpus())
+        ''' Returns the most probable completions of the search text. '''
+        return [completion
+                for completion, _ in self.predict_scored(search_text)]
 
-        text = search_text[-self.sequence_length:].lower()
-        unique_chars_text = sorted(list(set(text)))
-        for char in unique_chars_text:
-            if char not in self.unique_chars:
-                return []
+    def predict_scored(self, search_text):
+        ''' Returns the most probable completions of the search text
+        together with their probabilities (see `predict_completions`).
+        '''
+        try:
+            loaded = model_holder.acquire(self)
+        except Exception as e:
+            self.logger.debug('Error while loading the model: %s' % str(e))
+            return []
+        if loaded is None:
+            self.logger.debug('Model network %s, weights %s or vocabulary %s '
+                              'does not exist!' % (self.network_path,
+                                                   self.weights_path,
+                                                   self.vocabulary_path))
+            return []
 
+        try:
+            return self._predict_with(loaded, search_text)
+        finally:
+            loaded.release()
+
+    def _predict_with(self, loaded, search_text):
+        # The input of the model is shaped by the training parameters.
+        self.sequence_length = loaded.sequence_length
+        text = search_text[-self.sequence_length:].lower()
         if self.sequence_length > len(text):
             return []
 
-        if not os.path.isfile(self.weights_path):
-            self.logger.debug(
-                'Model weights %s does not exist!' % self.weights_path)
-            return []
-        if not os.path.isfile(self.network_path):
-            self.logger.debug(
-                'Model network does not exist!' % self.network_path)
-            return []
+        self.model = loaded.model
+        self.unique_chars = loaded.unique_chars
+        self.char_indices = loaded.char_indices
+        self.indices_char = loaded.indices_char
+
+        for char in set(text):
+            if char not in self.char_indices:
+                return []
 
         try:
-            lock_model_network = FileLock('%s.lock' % self.weights_path)
-            lock_model_weigths = FileLock('%s.lock' % self.network_path)
-
-            with lock_model_network.acquire(timeout=1000):
-                with lock_model_weigths.acquire(timeout=1000):
-                    graph = tf.Graph()
-                    with graph.as_default():
-                        session = tf.Session()
-                        with session.as_default():
-                            with open(self.network_path, 'r') as json_file:
-                                loaded_model_json = json_file.read()
-
-                            self.model = model_from_json(loaded_model_json)
-                            self.model.load_weights(self.weights_path)
-
-                            x = self.prepare_input(text)
-                            preds = self.model.predict(x, verbose=0)[0]
-                            next_indices = self.sample(
-                                preds, self.number_predictions)
-
-                            return [
-                                self.indices_char[idx] +
-                                self.predict_completion(
-                                    text[1:] + self.indices_char[idx]
-                                ) for idx in next_indices]
+            with loaded.graph.as_default():
+                with loaded.session.as_default():
+                    return self.predict_completions(
+                        text, self.number_predictions)
         except Exception as e:
             self.logger.debug('Error while prediction: %s' % str(e))
             return []
@@ -15,10 +15,12 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import json
 import logging
 import os
 import pickle
 import time
+from datetime import datetime
 
 import numpy as np
 import tensorflow as tf
@@ -29,6 +31,7 @@ from keras.layers import LSTM, Activation
 from keras.layers.core import Dense, Activation
 from keras.optimizers import RMSprop
 from keras.callbacks import EarlyStopping, ModelCheckpoint, ReduceLROnPlateau
+from keras.utils import Sequence
 
 from ckanext.knowledgehub.lib.rnn.data_manager import DataManager
 from ckanext.knowledgehub.lib.rnn.config import PredictiveSearchConfig
@@ -40,6 +43,56 @@ np.random.seed(42)
 tf.set_random_seed(42)
 
 
+class OneHotSequence(Sequence):
+    ''' Generates the one-hot encoded training batches on the fly from the
+    integer encoded corpus, so the memory needed for the training depends on
+    the size of the batch, not on the size of the corpus.
+
+    :param encoded: `numpy.ndarray`, the indices of the characters of the
+        corpus.
+    :param offsets: `numpy.ndarray`, the start positions of the training
+        sequences in the corpus.
+    :param sequence_length: `int`, the length of the input sequence.
+    :param num_chars: `int`, the number of unique characters.
+    :param batch_size: `int`, the number of sequences in a batch.
+    :param shuffle: `bool`, whether to shuffle the sequences after every
+        epoch.
+    '''
+
+    def __init__(self, encoded, offsets, sequence_length, num_chars,
+                 batch_size=128, shuffle=False):
+        self.encoded = encoded
+        self.offsets = np.array(offsets)
+        self.sequence_length = int(sequence_length)
+        self.num_chars = num_chars
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        if self.shuffle:
+            np.random.shuffle(self.offsets)
+
+    def __len__(self):
+        return int(np.ceil(len(self.offsets) / float(self.batch_size)))
+
+    def __getitem__(self, index):
+        offsets = self.offsets[index * self.batch_size:
+                               (index + 1) * self.batch_size]
+        rows = np.arange(len(offsets))
+        positions = offsets[:, None] + np.arange(self.sequence_length)
+
+        x = np.zeros((len(offsets), self.sequence_length, self.num_chars),
+                     dtype=np.bool)
+        y = np.zeros((len(offsets), self.num_chars), dtype=np.bool)
+        x[rows[:, None],
+          np.arange(self.sequence_length)[None, :],
+          self.encoded[positions]] = 1
+        y[rows, self.encoded[offsets + self.sequence_length]] = 1
+        return x, y
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            np.random.shuffle(self.offsets)
+
+
 class PredictiveSearchWorker(PredictiveSearchConfig):
     ''' A worker that gets the kwh data, create corpus(training data),
     prepare the data for training, traing the model and save it.
@@ -53,8 +106,8 @@ class PredictiveSearchWorker(PredictiveSearchConfig):
         self.training_data = None
         self.unique_chars = None
         self.char_indices = None
-        self.x = None
-        self.y = None
+        self.training_sequence = None
+        self.validation_sequence = None
         self.logger = logging.getLogger('ckanext.PredictiveSearchWorker')
 
     def __check_if_paths_exist(self):
@@ -67,6 +120,9 @@ class PredictiveSearchWorker(PredictiveSearchConfig):
         history_dir = os.path.dirname(self.history_path)
         if not os.path.exists(history_dir):
             os.makedirs(history_dir)
+        vocabulary_dir = os.path.dirname(self.vocabulary_path)
+        if not os.path.exists(vocabulary_dir):
+            os.makedirs(vocabulary_dir)
 
         return self
 
@@ -101,27 +157,30 @@ class PredictiveSearchWorker(PredictiveSearchConfig):
         return self
 
     def __set_x_y(self):
-        sentences = []
-        next_chars = []
-        for i in range(
-                0, len(self.training_data) - self.sequence_length, self.step):
-            sentences.append(self.training_data[i: i + self.sequence_length])
-            next_chars.append(self.training_data[i + self.sequence_length])
-
-        self.logger.info('Number of training examples: %d ' % len(sentences))
-
-        self.x = np.zeros((
-            len(sentences),
+        encoded = np.array(
+            [self.char_indices[char] for char in self.training_data],
+            dtype=np.int32)
+        offsets = np.arange(
+            0, len(self.training_data) - self.sequence_length, self.step)
+
+        self.logger.info('Number of training examples: %d ' % len(offsets))
+
+        # The last 5% of the sequences are used for validation, the same as
+        # fit(validation_split=0.05).
+        split_at = int(len(offsets) * (1. - 0.05))
+        self.training_sequence = OneHotSequence(
+            encoded,
+            offsets[:split_at],
             self.sequence_length,
-            len(self.unique_chars)),
-            dtype=np.bool
-        )
-        self.y = np.zeros(
-            (len(sentences), len(self.unique_chars)), dtype=np.bool)
-        for i, sentence in enumerate(sentences):
-            for t, char in enumerate(sentence):
-                self.x[i, t, self.char_indices[char]] = 1
-            self.y[i, self.char_indices[next_chars[i]]] = 1
+            len(self.unique_chars),
+            batch_size=128,
+            shuffle=True)
+        self.validation_sequence = OneHotSequence(
+            encoded,
+            offsets[split_at:],
+            self.sequence_length,
+            len(self.unique_chars),
+            batch_size=128)
         return self
 
     def __prepare_model(self):
@@ -162,11 +221,9 @@ class PredictiveSearchWorker(PredictiveSearchConfig):
         )
 
         try:
-            self.history = self.model.fit(
-                self.x,
-                self.y,
-                validation_split=0.05,
-                batch_size=128,
+            self.history = self.model.fit_generator(
+                self.training_sequence,
+                validation_data=self.validation_sequence,
                 epochs=self.epochs,
                 shuffle=True,
                 callbacks=[
@@ -196,6 +253,17 @@ class PredictiveSearchWorker(PredictiveSearchConfig):
                         model_json = self.model.to_json()
                         json_file.write(model_json)
 
+                    # The vocabulary and the training parameters are saved
+                    # with the model, so the model can be used without
+                    # rebuilding the corpus.
+                    with open(self.vocabulary_path, "w") as vocabulary_file:
+                        json.dump({
+                            'chars': self.unique_chars,
+                            'sequence_length': int(self.sequence_length),
+                            'corpus_length': len(self.training_data),
+                            'created_at': datetime.utcnow().isoformat(),
+                        }, vocabulary_file)
+
                     DataManager.create_corpus(self.training_data)
         except Exception as e:
             self.logger.debug('Error while saving RNN model: %s' % str(e))
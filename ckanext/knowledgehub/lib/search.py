@@ -20,11 +20,15 @@ entity types: package, dashboard, visualization etc.
 '''
 
 from ckan.lib.search.query import PackageSearchQuery, VALID_SOLR_PARAMETERS
-from ckan.lib.search.common import make_connection, SearchError
+from ckan.lib.search.common import SearchError
 from ckan.common import config
 
 from ckanext.knowledgehub.lib.profile import user_profile_service
-from ckanext.knowledgehub.lib.solr import boost_solr_params
+from ckanext.knowledgehub.lib.solr import (
+    boost_solr_params,
+    connection_pool,
+    PooledConnection,
+)
 
 import pysolr
 import logging
@@ -51,7 +55,7 @@ class KnowledgeHubPackageSearchQuery(PackageSearchQuery):
         except KeyError:
             pass
 
-        conn = make_connection(decode_dates=False)
+        conn = PooledConnection(connection_pool, decode_dates=False)
         log.debug('Package query: %r' % query)
         try:
             solr_response = conn.search(**query)
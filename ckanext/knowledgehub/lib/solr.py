@@ -16,10 +16,25 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 import hashlib
+import json
+import threading
+import time
+from datetime import datetime
 from uuid import uuid4
+from six.moves import queue
+from sqlalchemy import or_
+import pysolr
+import requests
+import ckan.lib.jobs as jobs
 from ckan.common import config, _ as translate
+from ckan.lib.redis import connect_to_redis
 from ckan.lib.search.common import make_connection
-from ckan.plugins.toolkit import ValidationError
+from ckan.plugins.toolkit import ValidationError, asbool
+from ckanext.knowledgehub.lib.cache import search_results_cache
+from ckanext.knowledgehub.lib.loader import (
+    get_entity_loader,
+    entity_loader_scope,
+)
 from logging import getLogger
 
 
@@ -33,6 +48,20 @@ MAX_RESULTS = 500
 VALID_SOLR_ARGS = {'q', 'fq', 'rows', 'start', 'sort', 'fl', 'df', 'facet',
                    'bq', 'defType', 'boost', 'facet.field'}
 DEFAULT_FACET_NAMES = u'organizations groups tags'
+DEFAULT_PROJECTIONS = {
+    'ids': ['id'],
+}
+GENERATION_FIELD = 'index_generation'
+GENERATION_KEY_PREFIX = 'ckanext.knowledgehub.index.generation'
+WATERMARK_KEY_PREFIX = 'ckanext.knowledgehub.index.watermark'
+WATERMARK_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+ISO_DATE_FORMATS = ['%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d']
+QUEUE_KEY_PREFIX = 'ckanext.knowledgehub.index.queue'
+QUEUE_FLUSH_TIMEOUT = 60
+MATCH_GROUP_SETS_KEY = 'ckanext.knowledgehub.index.match_group_sets'
+# The binary collation used to order the ids. The name must be quoted, as
+# Postgres folds the unquoted name to lowercase ("c" does not exist).
+BINARY_COLLATION = '"C"'
 
 
 class DontIndexException(Exception):
@@ -127,6 +156,456 @@ def ckan_params_to_solr_args(data_dict):
     return solr_args
 
 
+class IndexGenerations:
+    u'''Keeps track of the generations of the indexed documents for every
+    document type.
+
+    Every document written in the index is tagged with a generation value
+    (stored in the `index_generation` field). The searches are performed only
+    on the *live* generation. While the index for a document type is being
+    rebuilt, the new documents are written with a new (*building*) generation
+    that is not visible to the searches. Once the rebuild finishes, the
+    building generation becomes the live one with a single write in Redis.
+
+    :param redis: The redis connection factory. If ommited, the default CKAN
+        Redis connection will be used.
+    '''
+
+    def __init__(self, redis=None):
+        self.redis = redis or connect_to_redis
+
+    def _get_key(self, doctype, suffix):
+        return '%s.%s:%s' % (GENERATION_KEY_PREFIX, suffix, doctype)
+
+    def _connect(self):
+        return self.redis()
+
+    def get_live(self, doctype):
+        u'''Returns the live generation for the document type, or ``None``
+        if the document type has never been rebuilt with generations.
+        '''
+        return self._connect().get(self._get_key(doctype, 'live'))
+
+    def get_building(self, doctype):
+        u'''Returns the generation that is currently being built for the
+        document type, or ``None`` if there is no rebuild in progress.
+        '''
+        return self._connect().get(self._get_key(doctype, 'building'))
+
+    def start_building(self, doctype):
+        u'''Creates new generation for the document type and marks it as
+        the generation that is being built.
+
+        :returns: ``str``, the new generation.
+        '''
+        generation = '%d' % int(time.time() * 1000)
+        self._connect().set(self._get_key(doctype, 'building'), generation)
+        return generation
+
+    def abort_building(self, doctype):
+        u'''Discards the generation that is being built for the document
+        type.
+        '''
+        self._connect().delete(self._get_key(doctype, 'building'))
+
+    def publish(self, doctype, generation):
+        u'''Atomically makes the given generation the live generation for
+        the document type.
+        '''
+        pipe = self._connect().pipeline()
+        pipe.set(self._get_key(doctype, 'live'), generation)
+        pipe.delete(self._get_key(doctype, 'building'))
+        pipe.execute()
+
+
+class IndexWatermarks:
+    u'''Keeps the sync watermark for every document type - the time of the
+    last successful synchronization of the index with the database.
+
+    :param redis: The redis connection factory. If ommited, the default CKAN
+        Redis connection will be used.
+    '''
+
+    def __init__(self, redis=None):
+        self.redis = redis or connect_to_redis
+
+    def _get_key(self, doctype):
+        return '%s:%s' % (WATERMARK_KEY_PREFIX, doctype)
+
+    def _connect(self):
+        return self.redis()
+
+    def get(self, doctype):
+        u'''Returns the watermark (``datetime``) for the document type, or
+        ``None`` if the index for this document type has never been synced.
+        '''
+        value = self._connect().get(self._get_key(doctype))
+        if not value:
+            return None
+        return datetime.strptime(value, WATERMARK_FORMAT)
+
+    def set(self, doctype, value):
+        u'''Sets the watermark (``datetime``) for the document type.
+        '''
+        self._connect().set(self._get_key(doctype),
+                            value.strftime(WATERMARK_FORMAT))
+
+
+class IndexUpdateQueue:
+    u'''Write-behind queue of index updates, kept in Redis.
+
+    The updates are keyed by the document type and the entity id, so
+    repeated updates of the same entity collapse into a single entry. The
+    first update pushed in the queue opens a coalescing window and signals
+    that a flush should be scheduled. The flush waits for the window to
+    close and then takes all pending updates from the queue at once.
+
+    The queue is enabled with `ckanext.knowledgehub.search.index_queue`, and
+    the length of the window (in seconds) is set with
+    `ckanext.knowledgehub.search.index_queue.window`.
+
+    :param redis: The redis connection factory. If ommited, the default CKAN
+        Redis connection will be used.
+    '''
+
+    def __init__(self, redis=None):
+        self.redis = redis or connect_to_redis
+
+    def _get_key(self, suffix):
+        return '%s.%s' % (QUEUE_KEY_PREFIX, suffix)
+
+    def _connect(self):
+        return self.redis()
+
+    def is_enabled(self):
+        u'''Whether the index updates should go through the queue.
+        '''
+        return asbool(
+            config.get('ckanext.knowledgehub.search.index_queue', False))
+
+    def get_window(self):
+        u'''Returns the length of the coalescing window in seconds.
+        '''
+        return float(
+            config.get('ckanext.knowledgehub.search.index_queue.window', 2))
+
+    def push(self, doctype, entity_id):
+        u'''Adds an update for the entity to the queue.
+
+        :param doctype: ``str``, the document type of the entity.
+        :param entity_id: ``str``, the id of the entity.
+
+        :returns: ``bool``, ``True`` if this update opened a new coalescing
+            window and a flush should be scheduled.
+        '''
+        pipe = self._connect().pipeline()
+        pipe.sadd(self._get_key('pending'), '%s:%s' % (doctype, entity_id))
+        # The flag expires in case the scheduled flush never runs, so the
+        # next update can schedule a new one.
+        pipe.set(self._get_key('scheduled'), '%f' % time.time(), nx=True,
+                 ex=int(self.get_window()) + QUEUE_FLUSH_TIMEOUT)
+        _, scheduled = pipe.execute()
+        return bool(scheduled)
+
+    def wait(self):
+        u'''Blocks until the current coalescing window is closed.
+        '''
+        opened = self._connect().get(self._get_key('scheduled'))
+        if not opened:
+            return
+        remaining = float(opened) + self.get_window() - time.time()
+        if remaining > 0:
+            time.sleep(remaining)
+
+    def pop(self):
+        u'''Takes all pending updates from the queue and closes the
+        coalescing window, so the next update schedules a new flush.
+
+        :returns: ``dict``, the document type mapped to a sorted ``list`` of
+            ids of the entities to be updated.
+        '''
+        pipe = self._connect().pipeline()
+        pipe.delete(self._get_key('scheduled'))
+        pipe.smembers(self._get_key('pending'))
+        pipe.delete(self._get_key('pending'))
+        _, pending, _ = pipe.execute()
+
+        updates = {}
+        for entry in pending or []:
+            doctype, entity_id = entry.split(':', 1)
+            updates.setdefault(doctype, []).append(entity_id)
+        for ids in updates.values():
+            ids.sort()
+        return updates
+
+
+class MatchGroupSetCounts:
+    u'''Keeps the numbers of group sets required for the implicit access to
+    the indexed dashboards (see ``get_fq_dashboard_permission_labels``), so
+    the dashboard searches evaluate as many group sets as the indexed
+    dashboards require.
+
+    :param redis: The redis connection factory. If ommited, the default CKAN
+        Redis connection will be used.
+    '''
+
+    def __init__(self, redis=None):
+        self.redis = redis or connect_to_redis
+
+    def _connect(self):
+        return self.redis()
+
+    def record(self, count):
+        u'''Records the number of group sets required by an indexed
+        dashboard.
+
+        :param count: ``int``, the number of group sets.
+        '''
+        if count <= 0:
+            return
+        try:
+            self._connect().sadd(MATCH_GROUP_SETS_KEY, count)
+        except Exception as e:
+            logger.warning('Failed to record the number of group sets. '
+                           'Error: %s', str(e))
+
+    def get_max(self):
+        u'''Returns the largest number of group sets required by an indexed
+        dashboard, or ``None`` if none is recorded or Redis is not available.
+        '''
+        try:
+            counts = self._connect().smembers(MATCH_GROUP_SETS_KEY)
+        except Exception as e:
+            logger.warning('Failed to get the number of group sets. '
+                           'Error: %s', str(e))
+            return None
+        if not counts:
+            return None
+        return max([int(count) for count in counts])
+
+
+class SolrConnectionPool:
+    u'''Thread-safe pool of persistent (keep-alive) connections to Solr.
+
+    The connections are created lazily, up to the size of the pool, and are
+    reused between requests, so the requests do not have to set up a new HTTP
+    session every time. When all connections are in use, the caller waits for
+    a connection to be released.
+
+    A request that fails because of a connection problem (the server cannot
+    be reached or the request timed out) is retried with exponential backoff
+    on a fresh connection.
+
+    The pool is configured with the following options (read on first use):
+
+        * `ckanext.knowledgehub.search.pool_size` - the maximal number of
+            connections in the pool. Default is 10.
+        * `ckanext.knowledgehub.search.pool_timeout` - seconds to wait for a
+            free connection. Default is 10.
+        * `ckanext.knowledgehub.search.timeout` - the timeout (in seconds) for
+            the requests to Solr. Default is 60.
+        * `ckanext.knowledgehub.search.retries` - how many times to retry a
+            request that failed because of a connection problem. Default is 2.
+        * `ckanext.knowledgehub.search.retry_backoff` - the initial backoff
+            (in seconds) before retrying a request. Default is 0.1.
+
+    :param connection_factory: `function`, optional, creates new raw
+        connection to Solr. Defaults to CKAN's `make_connection`.
+    '''
+
+    def __init__(self, connection_factory=None):
+        self.connection_factory = connection_factory or make_connection
+        self._lock = threading.Lock()
+        self._idle = queue.Queue()
+        self._settings = None
+        self._plain_decoder = json.JSONDecoder()
+        self.created = 0
+        self.in_use = 0
+        self.waits = 0
+        self.reconnects = 0
+        self.errors = 0
+
+    def _get_settings(self):
+        if self._settings is None:
+            self._settings = {
+                'size': int(config.get(
+                    'ckanext.knowledgehub.search.pool_size', 10)),
+                'pool_timeout': float(config.get(
+                    'ckanext.knowledgehub.search.pool_timeout', 10)),
+                'timeout': float(config.get(
+                    'ckanext.knowledgehub.search.timeout', 60)),
+                'retries': int(config.get(
+                    'ckanext.knowledgehub.search.retries', 2)),
+                'retry_backoff': float(config.get(
+                    'ckanext.knowledgehub.search.retry_backoff', 0.1)),
+            }
+        return self._settings
+
+    def _create(self):
+        conn = self.connection_factory()
+        conn.timeout = self._get_settings()['timeout']
+        return conn
+
+    def _acquire(self):
+        settings = self._get_settings()
+        conn = None
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            create = False
+            with self._lock:
+                if self.created < settings['size']:
+                    self.created += 1
+                    create = True
+                else:
+                    self.waits += 1
+            if create:
+                try:
+                    conn = self._create()
+                except Exception:
+                    with self._lock:
+                        self.created -= 1
+                    raise
+            else:
+                try:
+                    conn = self._idle.get(timeout=settings['pool_timeout'])
+                except queue.Empty:
+                    raise pysolr.SolrError('Timed out while waiting for a '
+                                           'free connection to Solr.')
+        with self._lock:
+            self.in_use += 1
+        return conn
+
+    def _release(self, conn):
+        with self._lock:
+            self.in_use -= 1
+        self._idle.put(conn)
+
+    def reset(self):
+        u'''Forgets all pooled connections, without closing them.
+
+        Must be called in a forked (child) process, so it does not share the
+        open connections with the parent process.
+        '''
+        self._lock = threading.Lock()
+        self._idle = queue.Queue()
+        self.created = 0
+        self.in_use = 0
+
+    def _discard(self, conn):
+        with self._lock:
+            self.in_use -= 1
+            self.created -= 1
+        try:
+            session = getattr(conn, 'session', None)
+            if session is not None:
+                session.close()
+        except Exception as e:
+            logger.debug('Failed to close Solr session. Error: %s', str(e))
+
+    def _is_connection_error(self, error):
+        if isinstance(error, requests.exceptions.RequestException):
+            return True
+        if isinstance(error, pysolr.SolrError):
+            # pysolr raises SolrError for both connection problems and error
+            # responses from Solr. Only the connection problems are retried.
+            return not str(error).startswith('Solr responded with an error')
+        return False
+
+    def execute(self, method, *args, **kwargs):
+        u'''Calls the method of a pooled pysolr connection with the given
+        arguments.
+
+        :param method: ``str``, the name of the ``pysolr.Solr`` method, for
+            example `search`, `add`, `delete` or `commit`.
+        :param decode_dates: ``bool``, optional, whether to decode the dates
+            in the response to ``datetime``. Default is ``True``.
+
+        :returns: the result of the method call.
+        '''
+        decode_dates = kwargs.pop('decode_dates', True)
+        settings = self._get_settings()
+        attempt = 0
+        while True:
+            conn = self._acquire()
+            decoder = conn.decoder
+            try:
+                if not decode_dates:
+                    conn.decoder = self._plain_decoder
+                result = getattr(conn, method)(*args, **kwargs)
+            except Exception as e:
+                conn.decoder = decoder
+                if not self._is_connection_error(e):
+                    self._release(conn)
+                    raise
+                with self._lock:
+                    self.errors += 1
+                self._discard(conn)
+                if attempt >= settings['retries']:
+                    raise
+                backoff = settings['retry_backoff'] * (2 ** attempt)
+                attempt += 1
+                with self._lock:
+                    self.reconnects += 1
+                logger.warning('Solr request failed, retrying in %.2fs '
+                               '(attempt %d of %d). Error: %s', backoff,
+                               attempt, settings['retries'], str(e))
+                time.sleep(backoff)
+                continue
+            conn.decoder = decoder
+            self._release(conn)
+            return result
+
+    def stats(self):
+        u'''Returns the usage counters for this pool.
+
+        :returns: ``dict`` with the pool `size`, the number of `created`
+            connections, connections currently `in_use` and `idle`, the number
+            of times a caller had to `wait` for a free connection, the number
+            of `reconnects` and the number of connection `errors`.
+        '''
+        with self._lock:
+            return {
+                'size': self._get_settings()['size'],
+                'created': self.created,
+                'in_use': self.in_use,
+                'idle': self._idle.qsize(),
+                'waits': self.waits,
+                'reconnects': self.reconnects,
+                'errors': self.errors,
+            }
+
+
+class PooledConnection:
+    u'''Exposes the subset of the ``pysolr.Solr`` API used by the extension,
+    executing every call on a connection borrowed from the pool.
+
+    :param pool: ``SolrConnectionPool``, the connection pool.
+    :param decode_dates: ``bool``, whether to decode the dates in the search
+        results to ``datetime``.
+    '''
+
+    def __init__(self, pool, decode_dates=True):
+        self.pool = pool
+        self.decode_dates = decode_dates
+
+    def search(self, *args, **kwargs):
+        kwargs['decode_dates'] = self.decode_dates
+        return self.pool.execute('search', *args, **kwargs)
+
+    def add(self, *args, **kwargs):
+        return self.pool.execute('add', *args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        return self.pool.execute('delete', *args, **kwargs)
+
+    def commit(self, *args, **kwargs):
+        return self.pool.execute('commit', *args, **kwargs)
+
+
+connection_pool = SolrConnectionPool()
+
+
 class Index:
     u'''Index is an abstraction over the raw indexer connection provided by
     CKAN.
@@ -134,17 +613,55 @@ class Index:
     It takes into consideration the document type because the extra entities
     that are indexed in Solr are recorded as a separate document type (instead
     of the standard CKAN's `entity_type=package`).
+
+    :param generations: ``IndexGenerations``, optional, tracks the live and
+        building generations of the documents. If not given, the generations
+        are kept in the default CKAN Redis.
+    :param watermarks: ``IndexWatermarks``, optional, keeps the sync
+        watermarks for the document types. If not given, the watermarks are
+        kept in the default CKAN Redis.
+    :param pool: ``SolrConnectionPool``, optional, the pool of connections to
+        Solr. If not given, the shared connection pool is used.
     '''
+
+    def __init__(self, generations=None, watermarks=None, pool=None):
+        self.generations = generations or IndexGenerations()
+        self.watermarks = watermarks or IndexWatermarks()
+        self.pool = pool or connection_pool
+
     def get_connection(self):
-        u'''Creates new raw connection to Solr.
+        u'''Returns a connection to Solr backed by the connection pool.
         '''
-        return make_connection()
+        return PooledConnection(self.pool)
+
+    def get_pool_stats(self):
+        u'''Returns the usage counters of the Solr connection pool.
+        '''
+        return self.pool.stats()
+
+    def _get_generation_fq(self, doctype):
+        try:
+            live = self.generations.get_live(doctype)
+            if live:
+                return '+%s:%s' % (GENERATION_FIELD, live)
+            building = self.generations.get_building(doctype)
+            if building:
+                # This document type has not been rebuilt with generations
+                # yet, so just hide the documents that are being built.
+                return '-%s:%s' % (GENERATION_FIELD, building)
+        except Exception as e:
+            logger.warning('Failed to get the index generation for %s. '
+                           'Error: %s', doctype, str(e))
+        return None
 
     def _to_solr_args(self, doctype, query):
         solr_args = {}
         solr_args.update(query)
         solr_args = _prepare_search_query(solr_args)
         solr_args['fq'].append('entity_type:'+doctype)
+        generation_fq = self._get_generation_fq(doctype)
+        if generation_fq:
+            solr_args['fq'].append(generation_fq)
         facet = solr_args.pop('facet', None)
         if facet:
             solr_args['facet'] = 'true'
@@ -170,6 +687,45 @@ class Index:
         return self.get_connection().search(
             **self._to_solr_args(doctype, query))
 
+    def iter_search(self, doctype, **query):
+        u'''Iterates over all documents of the given document type that match
+        the query, without the `MAX_RESULTS` limit of ``search``.
+
+        The documents are fetched page by page using Solr's cursor (deep
+        paging), so the memory used does not depend on the number of matching
+        documents. The sort is made stable by adding the `index_id` (the
+        unique key) as a tie-breaker.
+
+        :param doctype: ``str``, the document type to search for.
+        :param query: ``dict`` or kwargs, extra parameters to be passed down to
+            Solr. The parameter `rows` sets the size of the pages (up to
+            `MAX_RESULTS`), and `start` is ignored.
+
+        :returns: generator of ``dict`` documents.
+        '''
+        query = dict(query)
+        query.pop('start', None)
+        rows = min(int(query.pop('rows', None) or MAX_RESULTS), MAX_RESULTS)
+        sort = query.pop('sort', None)
+        if not sort:
+            sort = 'index_id asc'
+        elif 'index_id' not in sort:
+            sort = '%s,index_id asc' % sort
+
+        cursor = '*'
+        while True:
+            results = self.search(doctype,
+                                  rows=rows,
+                                  sort=sort,
+                                  cursorMark=cursor,
+                                  **query)
+            for doc in results.docs:
+                yield doc
+            next_cursor = getattr(results, 'nextCursorMark', None)
+            if not next_cursor or next_cursor == cursor:
+                break
+            cursor = next_cursor
+
     def add(self, doctype, data):
         u'''Adds new document to the index with the given document type.
 
@@ -184,6 +740,40 @@ class Index:
         solr_data['entity_type'] = doctype
         self.get_connection().add([solr_data], commit=True)
 
+    def add_many(self, doctype, docs, commit=False, commit_within=None):
+        u'''Adds multiple documents to the index in a single request.
+
+        Unlike `add`, this method does not perform a hard commit by default.
+        The caller is expected to call `commit` once all documents have been
+        sent, or to pass `commit_within` to let Solr commit the documents on
+        its own within the given time.
+
+        :param doctype: ``str``, the document type.
+        :param docs: ``list`` of ``dict``, the documents to be added.
+        :param commit: ``bool``, whether to perform a hard commit after the
+            documents are added. Default is ``False``.
+        :param commit_within: ``int``, optional, number of milliseconds within
+            which Solr should commit the added documents.
+        '''
+        solr_docs = []
+        for data in docs:
+            solr_data = {}
+            solr_data.update(data)
+            solr_data['entity_type'] = doctype
+            solr_docs.append(solr_data)
+        if not solr_docs:
+            return
+        kwargs = {'commit': commit}
+        if commit_within is not None:
+            kwargs['commitWithin'] = int(commit_within)
+        self.get_connection().add(solr_docs, **kwargs)
+
+    def commit(self):
+        u'''Performs a hard commit on the index, making all pending changes
+        visible to searches.
+        '''
+        self.get_connection().commit()
+
     def remove(self, doctype, **query):
         u'''Removes documents from the index for the given document type.
 
@@ -210,9 +800,155 @@ class Index:
         '''
         self.get_connection().delete(commit=True, q='entity_type:' + doctype)
 
+    def remove_ids(self, doctype, id_field, ids, commit=False):
+        u'''Removes the documents with the given ids from the index in a
+        single request.
+
+        :param doctype: ``str``, the document type.
+        :param id_field: ``str``, the name of the id field in the index.
+        :param ids: ``list`` of ``str``, the ids of the documents to remove.
+        :param commit: ``bool``, whether to perform a hard commit after the
+            documents are removed. Default is ``False``.
+        '''
+        if not ids:
+            return
+        q = 'entity_type:%s AND %s:(%s)' % (
+            doctype,
+            id_field,
+            ' OR '.join([escape_str(_id) for _id in ids]))
+        logger.debug('Delete documents q=%s', q)
+        self.get_connection().delete(commit=commit, q=q)
+
+    def iter_ids(self, doctype, id_field):
+        u'''Iterates over the ids of all documents of the given document
+        type, sorted in ascending order.
+
+        The ids are fetched page by page using Solr's cursor, so the memory
+        used does not depend on the number of documents in the index.
+
+        :param doctype: ``str``, the document type.
+        :param id_field: ``str``, the name of the id field in the index.
+
+        :returns: generator of ``str`` ids.
+        '''
+        for doc in self.iter_search(doctype,
+                                    q='*:*',
+                                    fl=id_field,
+                                    sort='%s asc' % id_field):
+            if doc.get(id_field):
+                yield doc[id_field]
+
+    def get_watermark(self, doctype):
+        u'''Returns the time of the last sync of the index for the given
+        document type, or ``None`` if it has never been synced.
+
+        :param doctype: ``str``, the document type.
+        '''
+        return self.watermarks.get(doctype)
+
+    def set_watermark(self, doctype, value):
+        u'''Sets the time of the last sync of the index for the given
+        document type.
+
+        :param doctype: ``str``, the document type.
+        :param value: ``datetime``, the time of the sync.
+        '''
+        self.watermarks.set(doctype, value)
+
+    def get_write_generations(self, doctype):
+        u'''Returns the generations to which a document of the given type
+        must be written.
+
+        This is the live generation and, while the index is being rebuilt,
+        the generation that is being built, so the changes are not lost once
+        the rebuilt generation becomes live.
+
+        :param doctype: ``str``, the document type.
+
+        :returns: ``list`` of generations. A ``None`` generation means that
+            the document should not be tagged with a generation.
+        '''
+        try:
+            live = self.generations.get_live(doctype)
+            building = self.generations.get_building(doctype)
+        except Exception as e:
+            logger.warning('Failed to get the index generations for %s. '
+                           'Error: %s', doctype, str(e))
+            return [None]
+        return [live] + ([building] if building else [])
+
+    def new_generation(self, doctype):
+        u'''Starts building new generation of documents for the given
+        document type. The documents of the new generation will not show up in
+        the searches until the generation is published.
+
+        :param doctype: ``str``, the document type.
+
+        :returns: ``str``, the new generation.
+        '''
+        return self.generations.start_building(doctype)
+
+    def abort_generation(self, doctype):
+        u'''Discards the generation that is being built for the given
+        document type.
+
+        :param doctype: ``str``, the document type.
+        '''
+        self.generations.abort_building(doctype)
+
+    def publish_generation(self, doctype, generation):
+        u'''Makes the generation the live generation for the document type.
+        From this point on, the searches return only the documents tagged
+        with this generation.
+
+        :param doctype: ``str``, the document type.
+        :param generation: ``str``, the generation to be published.
+        '''
+        self.generations.publish(doctype, generation)
+
+    def remove_stale(self, doctype, generation):
+        u'''Removes all documents of the given document type that do not
+        belong to the given generation.
+
+        :param doctype: ``str``, the document type.
+        :param generation: ``str``, the generation to keep.
+        '''
+        q = 'entity_type:%s AND -%s:%s' % (doctype, GENERATION_FIELD,
+                                           generation)
+        logger.debug('Delete stale documents q=%s', q)
+        self.get_connection().delete(commit=True, q=q)
+
+    def schedule_remove_stale(self, doctype, generation):
+        u'''Schedules a background job to remove the documents of the given
+        document type that do not belong to the given generation.
+
+        If the job cannot be scheduled, the documents are removed right away.
+
+        :param doctype: ``str``, the document type.
+        :param generation: ``str``, the generation to keep.
+        '''
+        try:
+            jobs.enqueue(remove_stale_generations, [doctype, generation])
+            return
+        except Exception as e:
+            logger.warning('Failed to schedule removal of stale documents '
+                           'for %s. Removing now. Error: %s', doctype, str(e))
+        self.remove_stale(doctype, generation)
+
 
 # Exported
 index = Index()
+index_update_queue = IndexUpdateQueue()
+match_group_set_counts = MatchGroupSetCounts()
+
+
+def remove_stale_generations(doctype, generation):
+    u'''Background job that removes the documents of the given document type
+    that do not belong to the given (live) generation.
+    '''
+    index.remove_stale(doctype, generation)
+    logger.info('Removed stale documents for %s (live generation: %s).',
+                doctype, generation)
 
 
 # Helpers for models
@@ -232,6 +968,59 @@ def unprefixed(name):
     return mapped(name, name)
 
 
+def mapped_date(name, _as):
+    u'''Map a date/time field of the model to a date field in the index.
+
+    The value is stored as a Solr date (UTC, with millisecond precision), so
+    the field can be sorted and range-queried on its docValues, and is mapped
+    back to an ISO 8601 string when the document is fetched from the index.
+    '''
+    field = mapped(name, _as)
+    field['type'] = 'date'
+    return field
+
+
+def _parse_iso_date(value):
+    value = value.strip()
+    if value.endswith('Z'):
+        value = value[:-1]
+    for date_format in ISO_DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            continue
+    raise ValueError('Invalid date: %s' % value)
+
+
+def to_solr_date(value):
+    u'''Formats a date as a Solr date.
+
+    :param value: ``datetime`` or ``str``, the date or an ISO 8601 string.
+
+    :returns: ``str``, the date in the Solr date format, for example
+        `2020-05-01T10:20:30.123Z`.
+    '''
+    if not isinstance(value, datetime):
+        value = _parse_iso_date(value)
+    return '%s.%03dZ' % (value.strftime('%Y-%m-%dT%H:%M:%S'),
+                         value.microsecond // 1000)
+
+
+def from_solr_date(value):
+    u'''Formats a date fetched from the index (a Solr date string, or a
+    ``datetime`` if the dates were decoded) as an ISO 8601 string - the same
+    format used for the dates in the data dicts.
+    '''
+    if not isinstance(value, datetime):
+        value = _parse_iso_date(value)
+    return value.isoformat()
+
+
+def _get_date_fields(fields):
+    return set([field['field'] for field in fields
+                if isinstance(field, dict) and field.get('type') == 'date'])
+
+
 def _get_fields_mapping(fields):
     mapping = {}
     for field in fields:
@@ -258,12 +1047,14 @@ def _add_required_fields(data):
     if not data.get('index_id'):
         entity_id = data.get('entity_id', data['id'])
         doctype = data['entity_type']
-        data['index_id'] = hashlib.md5(
-            '%s:%s' % (doctype, entity_id)).hexdigest()
+        index_key = '%s:%s' % (doctype, entity_id)
+        if data.get(GENERATION_FIELD):
+            index_key = '%s:%s' % (index_key, data[GENERATION_FIELD])
+        data['index_id'] = hashlib.md5(index_key).hexdigest()
     return data
 
 
-def to_indexed_doc(data, doctype, fields):
+def to_indexed_doc(data, doctype, fields, generation=None):
     u'''Maps raw document data to a document that will be stored in the index.
 
     The mapping is done based on the provided fields definitions. The indexed
@@ -282,10 +1073,16 @@ def to_indexed_doc(data, doctype, fields):
                 "as": "stored_field_name"
             }
 
+    Date fields (see `mapped_date`) additionally have `"type": "date"` and
+    their values are stored as Solr dates.
+
     Additional fields that are required by Solr index will be added to the
     document if they are not present. Required fields are: `id`, `site_id` and
     `index_id`.
     The field `entity_type` is added to all documents.
+    If a generation is given, the document is tagged with it (in the
+    `index_generation` field) and the generation becomes part of the
+    `index_id`, so the same entity can be present once in every generation.
 
     An example of field mapping:
 
@@ -326,15 +1123,28 @@ def to_indexed_doc(data, doctype, fields):
     :param data: ``dict``, the original document to be stored in the index.
     :param doctype: ``str``, the document type.
     :param fields: ``list``, fields mapping.
+    :param generation: ``str``, optional, the index generation of the
+        document.
 
     :returns: ``dict``, the mapped document ready to be stored in the index.
     '''
     indexed_doc = {
         'entity_type': doctype,
     }
+    if generation:
+        indexed_doc[GENERATION_FIELD] = generation
+    date_fields = _get_date_fields(fields)
     for name, index_field in _get_fields_mapping(fields).items():
         if data.get(name):
-            indexed_doc[index_field] = data[name]
+            value = data[name]
+            if name in date_fields:
+                try:
+                    value = to_solr_date(value)
+                except ValueError as e:
+                    logger.warning('Not indexing the date field %s of %s. '
+                                   'Error: %s', name, data.get('id'), str(e))
+                    continue
+            indexed_doc[index_field] = value
 
     return _add_required_fields(indexed_doc)
 
@@ -351,9 +1161,12 @@ def indexed_doc_to_data_dict(doc, fields):
     :returns: ``dict``, a document, mapped to the original structure.
     '''
     data = {}
+    date_fields = _get_date_fields(fields)
     for name, index_field in _get_fields_mapping(fields).items():
         if doc.get(index_field):
             data[name] = doc[index_field]
+            if name in date_fields:
+                data[name] = from_solr_date(data[name])
 
     return data
 
@@ -376,6 +1189,10 @@ class Indexed:
             If not given, an error will be raised.
         * `index` - ``Index``, optional, the instance of the ``Index`` to be
             used. Usefull for providing mock index in unit tests.
+        * `update_queue` - ``IndexUpdateQueue``, optional, the queue for
+            the write-behind index updates.
+        * `search_cache` - ``SearchResultsCache``, optional, the cache of the
+            search results that is invalidated when the index changes.
         * `before_index` - `function`, optional, a callback function that is
             called before the entity is stored in the index to provide a way to
             modify, transform, validate or enrich the data before it goes in
@@ -389,6 +1206,33 @@ class Indexed:
 
             The callback receives the document data (as ``dict``) and expects a
             ``dict`` as a return value - the transformed document.
+            The related entities needed to enrich the document should be
+            loaded with the ``EntityLoader`` returned by
+            ``get_entity_loader``.
+        * `prefetch_related` - `function`, optional, called with the
+            ``EntityLoader`` and the ``list`` of documents data (before
+            ``before_index`` is called for them) when a chunk of documents is
+            indexed. Used to queue the related entities referenced by all of
+            the documents in the chunk, so they get loaded in bulk.
+        * `index_dependencies` - `function`, optional, called with the
+            document data (as returned by ``before_index``) to get the
+            related entities the document was enriched from - a ``dict`` of
+            the type of the related entity (`dataset`, `research_question`,
+            `tag`, `keyword`, `group` etc) mapped to a ``list`` of references.
+            The dependencies are recorded when the document is indexed, so
+            the document can be reindexed when any of them changes.
+        * `dependency_store` - optional, the store of the recorded
+            dependencies (``IndexDependency`` by default).
+        * `watermark_columns` - ``list`` of ``str``, optional, the names of
+            the timestamp columns (like `created_at` and `modified_at`) used
+            to find the entities changed since the last sync of the index.
+        * `index_filter` - ``list``, optional, SQLAlchemy criteria that select
+            which rows of the model are stored in the index.
+        * `projections` - ``dict``, optional, named projections - the name
+            mapped to the ``list`` of fields to be fetched from the index
+            when searching with that projection (for example the fields
+            needed to render a search result card). The projection `ids` is
+            always available.
 
     A usage example:
 
@@ -426,12 +1270,111 @@ class Indexed:
             return cls.index
         return index
 
+    @classmethod
+    def get_update_queue(cls):
+        u'''Returns a reference to the ``IndexUpdateQueue`` used to defer the
+        index updates for this model.
+        '''
+        if hasattr(cls, 'update_queue'):
+            return cls.update_queue
+        return index_update_queue
+
+    @classmethod
+    def get_search_cache(cls):
+        u'''Returns a reference to the ``SearchResultsCache`` that keeps the
+        search results for this model.
+        '''
+        if hasattr(cls, 'search_cache'):
+            return cls.search_cache
+        return search_results_cache
+
+    @classmethod
+    def _invalidate_search_cache(cls, commit_within=None):
+        if commit_within is None:
+            cls.get_search_cache().bump_generation(cls._get_doctype())
+        else:
+            cls.get_search_cache().bump_generation(
+                cls._get_doctype(), commit_within=commit_within)
+
+    @classmethod
+    def get_dependency_store(cls):
+        u'''Returns a reference to the store of the dependencies recorded for
+        the documents of this model.
+        '''
+        if hasattr(cls, 'dependency_store'):
+            return cls.dependency_store
+        # Delay the loading of the model
+        from ckanext.knowledgehub.model.index_dependency import (
+            IndexDependency,
+        )
+        return IndexDependency
+
+    @classmethod
+    def _record_dependencies(cls, items):
+        u'''Records the related entities the documents were enriched from
+        (see `index_dependencies`).
+
+        :param items: ``list`` of ``dict``, the documents data as returned by
+            ``before_index``.
+        '''
+        if not items or not hasattr(cls, 'index_dependencies'):
+            return
+        try:
+            cls.get_dependency_store().set_dependencies(
+                cls._get_doctype(),
+                dict([(data['id'], cls.index_dependencies(data))
+                      for data in items]))
+        except Exception as e:
+            logger.warning('Failed to record the index dependencies for %s. '
+                           'Error: %s', cls._get_doctype(), str(e))
+
+    @classmethod
+    def _remove_dependencies(cls, ids):
+        u'''Removes the dependencies recorded for the documents that were
+        removed from the index.
+        '''
+        if not ids or not hasattr(cls, 'index_dependencies'):
+            return
+        try:
+            cls.get_dependency_store().remove_dependencies(
+                cls._get_doctype(), ids)
+        except Exception as e:
+            logger.warning('Failed to remove the index dependencies for %s. '
+                           'Error: %s', cls._get_doctype(), str(e))
+
     @classmethod
     def _get_indexed_fields(cls):
         if hasattr(cls, 'indexed'):
             return cls.indexed
         return [field for field in COMMON_FIELDS]
 
+    @classmethod
+    def get_projection_fl(cls, projection=None):
+        u'''Returns the Solr field list (`fl`) for the given projection.
+
+        :param projection: ``str``, the name of a projection defined in the
+            `projections` of the model (or `ids`), or ``list`` of the names of
+            the fields to fetch. If not given, all indexed fields are fetched.
+
+        :returns: ``str``, the comma separated list of index fields.
+        '''
+        mapping = _get_fields_mapping(cls._get_indexed_fields())
+        if projection is None:
+            names = mapping.keys()
+        elif isinstance(projection, str) or isinstance(projection, unicode):
+            projections = {}
+            projections.update(DEFAULT_PROJECTIONS)
+            projections.update(getattr(cls, 'projections', {}))
+            if projection not in projections:
+                raise ValidationError({
+                    'projection': translate('Unknown projection'),
+                })
+            names = projections[projection]
+        else:
+            names = projection
+        return ','.join(sorted(set([mapping.get(name, name)
+                                    for name in names])))
+
     @classmethod
     def _get_doctype(cls):
         if hasattr(cls, 'doctype'):
@@ -456,106 +1399,469 @@ class Indexed:
         return _noop
 
     @classmethod
-    def rebuild_index(cls):
-        u'''Performs a full rebuild of the index for the documents of this
-        type.
+    def _prefetch_related(cls, items):
+        u'''Queues the related entities referenced by the documents data in
+        the entity loader of the current scope, so they are loaded in bulk
+        when the documents are enriched by ``before_index``.
+        '''
+        if not items or not hasattr(cls, 'prefetch_related'):
+            return
+        try:
+            cls.prefetch_related(get_entity_loader(), items)
+        except Exception as e:
+            logger.warning('Failed to prefetch the related entities for %s. '
+                           'Error: %s', cls._get_doctype(), str(e))
 
-        It collects the data from the database for this model, transforms and
-        inserts the documents into the index. First all documents of this type
-        are deleted in the index (to clean-up stale documents), then all of the
-        documents are collected from database and re-instered into the index.
+    @classmethod
+    def _get_watermark_columns(cls):
+        if hasattr(cls, 'watermark_columns'):
+            return cls.watermark_columns
+        return []
+
+    @classmethod
+    def _get_indexable_query(cls, *entities):
+        query = cls._get_session().query(*(entities or [cls]))
+        if hasattr(cls, 'index_filter'):
+            query = query.filter(*cls.index_filter)
+        return query
+
+    @classmethod
+    def _get_sorted_id_column(cls):
+        u'''Returns the id column compared in binary order, so the id
+        ranges of the shards do not depend on the database locale.
+        '''
+        return cls.id.collate(BINARY_COLLATION)
+
+    @classmethod
+    def _iter_db_ids(cls):
+        u'''Iterates over the ids of all entities that should be present in
+        the index, in ascending (binary) order.
+        '''
+        query = cls._get_indexable_query(cls.id)
+        query = query.order_by(cls._get_sorted_id_column())
+        for row in query.yield_per(CHUNK_SIZE):
+            yield row[0]
+
+    @classmethod
+    def _iter_modified_ids(cls, since=None):
+        u'''Iterates over the ids of the entities created or modified after
+        the given time. If no time is given, all ids are returned.
+        '''
+        columns = cls._get_watermark_columns()
+        if not columns:
+            return
+        query = cls._get_indexable_query(cls.id)
+        if since:
+            query = query.filter(or_(*[getattr(cls, column) > since
+                                       for column in columns]))
+        for row in query.yield_per(CHUNK_SIZE):
+            yield row[0]
+
+    @classmethod
+    def _get_by_ids(cls, ids):
+        return cls._get_indexable_query().filter(cls.id.in_(ids)).all()
+
+    @classmethod
+    def _to_indexed_docs(cls, index, data):
+        u'''Maps the data to one indexed document for every generation that
+        is currently written in the index.
+        '''
+        doctype = cls._get_doctype()
+        fields = cls._get_indexed_fields()
+        return [to_indexed_doc(data, doctype, fields, generation=generation)
+                for generation in index.get_write_generations(doctype)]
+
+    @classmethod
+    def start_rebuild(cls):
+        u'''Starts a rebuild of the index for this model by creating a new
+        generation of documents. The documents of the new generation are not
+        visible to the searches until the rebuild is finished.
+
+        :returns: ``str``, the new generation.
+        '''
+        doctype = cls._get_doctype()
+        generation = cls.get_index().new_generation(doctype)
+        logger.info('Building generation %s of the index for %s.',
+                    generation, doctype)
+        return generation
+
+    @classmethod
+    def get_shard_bounds(cls, shards):
+        u'''Splits the entities of this model into (at most) the given number
+        of id ranges (shards) of roughly the same size, so the index can be
+        rebuilt in parallel. A shard has at least `CHUNK_SIZE` entities.
+
+        :param shards: ``int``, the number of shards.
+
+        :returns: ``list`` of ``tuple`` - the lower (inclusive) and upper
+            (exclusive) id of every shard. ``None`` means no bound.
+        '''
+        if shards <= 1:
+            return [(None, None)]
+        query = cls._get_indexable_query(cls.id)
+        total = query.count()
+        shards = min(shards, total // CHUNK_SIZE)
+        if shards <= 1:
+            return [(None, None)]
+        query = query.order_by(cls._get_sorted_id_column())
+        bounds = [query.offset(total * i // shards).limit(1).scalar()
+                  for i in range(1, shards)]
+        return list(zip([None] + bounds, bounds + [None]))
+
+    @classmethod
+    def rebuild_shard(cls, generation, lower=None, upper=None):
+        u'''Indexes the entities with ids in the given range as documents of
+        the given generation.
+
+        The entities are read in chunks of `CHUNK_SIZE` rows (ordered by id),
+        and each chunk is sent to the index with a single request. A single
+        commit is issued once the whole shard has been indexed.
+
+        :param generation: ``str``, the generation being built.
+        :param lower: ``str``, optional, the lowest id (inclusive).
+        :param upper: ``str``, optional, the highest id (exclusive).
+
+        :returns: ``dict``, the number of `indexed` documents and whether
+            there was an `error` while indexing.
         '''
         index = cls.get_index()
         fields = cls._get_indexed_fields()
         doctype = cls._get_doctype()
-        error = False
-
-        def _generate_index():
-            offset = 0
-
-            def _next_chunk():
-                count = 0
-                for result in (cls._get_session()
-                               .query(cls)
-                               .offset(offset)
-                               .limit(CHUNK_SIZE)
-                               .all()):
+        state = {
+            'error': False,
+            'indexed': 0,
+        }
+        id_column = cls._get_sorted_id_column()
+        query = cls._get_indexable_query()
+        if lower is not None:
+            query = query.filter(id_column >= lower)
+        if upper is not None:
+            query = query.filter(id_column < upper)
+
+        # the related entities are shared by all chunks of the shard
+        with entity_loader_scope():
+            last_id = None
+            while True:
+                chunk_query = query
+                if last_id is not None:
+                    chunk_query = chunk_query.filter(id_column > last_id)
+                results = chunk_query.order_by(id_column).limit(
+                    CHUNK_SIZE).all()
+                if not results:
+                    break
+                last_id = results[-1].id
+                cls._prefetch_related([result.__dict__
+                                       for result in results])
+
+                docs = []
+                indexed = []
+                for result in results:
                     try:
                         data = cls._get_before_index()(result.__dict__)
-                        index.add(doctype,
-                                  to_indexed_doc(data, doctype, fields))
+                        docs.append(to_indexed_doc(data, doctype, fields,
+                                                   generation=generation))
+                        indexed.append(data)
                     except DontIndexException as e:
                         logger.debug('Should not index this resource %s.',
                                      str(e))
                     except Exception as e:
                         logger.exception(e)
-                        logger.error('Failed to build index for %s. Error: %s',
-                                     result,
+                        logger.error('Failed to build index for %s. '
+                                     'Error: %s', result, e)
+                        state['error'] = True
+                if docs:
+                    try:
+                        index.add_many(doctype, docs)
+                        state['indexed'] += len(docs)
+                        cls._record_dependencies(indexed)
+                    except Exception as e:
+                        logger.exception(e)
+                        logger.error('Failed to add %d documents to the '
+                                     'index for %s. Error: %s',
+                                     len(docs),
+                                     doctype,
                                      e)
-                        error = True
-                    count += 1
-                return count
+                        state['error'] = True
 
-            while True:
-                count = _next_chunk()
-                if not count:
-                    break
-                offset += CHUNK_SIZE
+        # make all of the added documents available with a single commit
+        index.commit()
+        return state
+
+    @classmethod
+    def finish_rebuild(cls, generation):
+        u'''Finishes the rebuild - the new generation becomes live and the
+        documents from the previous generations are removed in the background.
 
-        # clear all documents of this type from the index
-        index.remove_all(doctype)
-        # now regenerate the index
-        _generate_index()
-        if error:
+        :param generation: ``str``, the generation that was built.
+        '''
+        index = cls.get_index()
+        doctype = cls._get_doctype()
+        # switch the searches to the new generation
+        index.publish_generation(doctype, generation)
+        cls._invalidate_search_cache()
+        # clean-up the stale documents from the previous generations
+        index.schedule_remove_stale(doctype, generation)
+
+    @classmethod
+    def abort_rebuild(cls):
+        u'''Discards the generation that is being built for this model.
+        '''
+        cls.get_index().abort_generation(cls._get_doctype())
+
+    @classmethod
+    def rebuild_index(cls):
+        u'''Performs a full rebuild of the index for the documents of this
+        type.
+
+        It collects the data from the database for this model, transforms and
+        inserts the documents into the index. The documents are inserted as a
+        new generation that is not visible to the searches while the rebuild
+        is in progress - the searches keep using the current (live) documents.
+        Once all documents are inserted, the new generation becomes live and
+        the documents from the previous generations are removed in the
+        background.
+
+        The documents are sent to the index in bulk - one request per chunk of
+        `CHUNK_SIZE` rows, and a single commit is issued at the end, once all
+        chunks have been sent.
+
+        To rebuild the index in parallel, use ``start_rebuild``,
+        ``get_shard_bounds``, ``rebuild_shard`` (for every shard) and
+        ``finish_rebuild`` instead.
+
+        :returns: ``int``, the number of documents added to the index.
+        '''
+        doctype = cls._get_doctype()
+        generation = cls.start_rebuild()
+        try:
+            state = cls.rebuild_shard(generation)
+        except Exception:
+            cls.abort_rebuild()
+            raise
+        cls.finish_rebuild(generation)
+        if state['error']:
             logger.error('Rebuilding of index for %s finished with error. ' +
                          'Check the log for more details.', doctype)
-        logger.info('Rebuilt index for %s.', doctype)
+        logger.info('Rebuilt index for %s. Indexed %d documents.',
+                    doctype, state['indexed'])
+        return state['indexed']
+
+    @classmethod
+    def sync_index(cls):
+        u'''Synchronizes the index for the documents of this type with the
+        database, without rebuilding the whole index.
+
+        The entities that were created or modified since the last sync (the
+        watermark) are re-indexed. The ids of all entities in the database and
+        all documents in the index are compared (as two sorted streams) to find
+        the entities that are missing from the index - these are indexed as
+        well, and the documents for entities that no longer exist - these are
+        removed from the index.
+
+        :returns: ``dict``, the number of `updated` and `removed` documents.
+        '''
+        index = cls.get_index()
+        doctype = cls._get_doctype()
+        id_key = _get_fields_mapping(cls._get_indexed_fields()).get('id', 'id')
+        started = datetime.utcnow()
+        watermark = index.get_watermark(doctype)
+
+        to_update = set(cls._iter_modified_ids(watermark))
+        to_remove = []
+        for entity_id, in_db, in_index in _merge_sorted_ids(
+                cls._iter_db_ids(),
+                index.iter_ids(doctype, id_key)):
+            if in_db and not in_index:
+                to_update.add(entity_id)
+            elif in_index and not in_db:
+                to_remove.append(entity_id)
+
+        to_update = sorted(to_update)
+        updated = 0
+        with entity_loader_scope():
+            for i in range(0, len(to_update), CHUNK_SIZE):
+                count, _ = cls._index_chunk(index,
+                                            to_update[i:i + CHUNK_SIZE])
+                updated += count
+
+        for i in range(0, len(to_remove), CHUNK_SIZE):
+            index.remove_ids(doctype, id_key, to_remove[i:i + CHUNK_SIZE])
+            cls._remove_dependencies(to_remove[i:i + CHUNK_SIZE])
+
+        if updated or to_remove:
+            index.commit()
+            cls._invalidate_search_cache()
+        index.set_watermark(doctype, started)
+        logger.info('Synced index for %s. Updated %d, removed %d documents.',
+                    doctype, updated, len(to_remove))
+        return {
+            'updated': updated,
+            'removed': len(to_remove),
+        }
+
+    @classmethod
+    def _index_chunk(cls, index, ids):
+        u'''Loads the entities with the given ids from the database and adds
+        them to the index with a single request, without a commit.
+
+        :returns: ``tuple``, the number of documents added to the index and
+            the ``set`` of ids of the entities that should be kept in the
+            index.
+        '''
+        docs = []
+        indexed = []
+        found = set()
+        results = cls._get_by_ids(ids)
+        cls._prefetch_related([result.__dict__ for result in results])
+        for result in results:
+            found.add(result.id)
+            try:
+                data = cls._get_before_index()(result.__dict__)
+                docs.extend(cls._to_indexed_docs(index, data))
+                indexed.append(data)
+            except DontIndexException as e:
+                logger.debug('Should not index this resource %s.', str(e))
+                found.discard(result.id)
+            except Exception as e:
+                logger.exception(e)
+                logger.error('Failed to build index for %s. Error: %s',
+                             result,
+                             e)
+        if docs:
+            index.add_many(cls._get_doctype(), docs)
+            cls._record_dependencies(indexed)
+        return len(docs), found
 
     @classmethod
-    def add_to_index(cls, data):
+    def index_by_ids(cls, ids):
+        u'''Brings the index up to date for the entities with the given ids.
+
+        The entities are loaded from the database and indexed in bulk, with a
+        single commit at the end. The documents for the entities that no
+        longer exist (or should not be indexed) are removed from the index.
+
+        :param ids: ``list`` of ``str``, the ids of the entities.
+
+        :returns: ``dict``, the number of `updated` and `removed` documents.
+        '''
+        index = cls.get_index()
+        doctype = cls._get_doctype()
+        id_key = _get_fields_mapping(cls._get_indexed_fields()).get('id', 'id')
+        ids = sorted(set(ids))
+        updated = 0
+        to_remove = []
+        with entity_loader_scope():
+            for i in range(0, len(ids), CHUNK_SIZE):
+                chunk = ids[i:i + CHUNK_SIZE]
+                count, found = cls._index_chunk(index, chunk)
+                updated += count
+                to_remove.extend([entity_id for entity_id in chunk
+                                  if entity_id not in found])
+        if to_remove:
+            index.remove_ids(doctype, id_key, to_remove)
+            cls._remove_dependencies(to_remove)
+
+        if updated or to_remove:
+            index.commit()
+            cls._invalidate_search_cache()
+        return {
+            'updated': updated,
+            'removed': len(to_remove),
+        }
+
+    @classmethod
+    def _queue_index_update(cls, entity_id):
+        u'''Pushes an update for the entity to the write-behind queue, if the
+        queue is enabled, and schedules a flush of the queue when needed.
+
+        :returns: ``bool``, ``True`` if the update was queued, ``False`` if
+            the index should be updated right away.
+        '''
+        queue = cls.get_update_queue()
+        if not queue.is_enabled():
+            return False
+        try:
+            if queue.push(cls._get_doctype(), entity_id):
+                # Delay the loading of the jobs module
+                from ckanext.knowledgehub.logic.jobs import (
+                    schedule_flush_index_queue
+                )
+                schedule_flush_index_queue()
+            return True
+        except Exception as e:
+            logger.warning('Failed to queue index update for %s. '
+                           'Updating the index directly. Error: %s',
+                           entity_id, str(e))
+            return False
+
+    @classmethod
+    def add_to_index(cls, data, commit_within=None):
         u'''Adds new document to the index.
 
         :param data: ``dict``, the document data.
+        :param commit_within: ``int``, optional, number of milliseconds within
+            which Solr should commit the document. If not given, the value of
+            `ckanext.knowledgehub.search.commit_within` is used, and if that is
+            not set either, the document is committed right away.
+
+        If the index update queue is enabled, the entity is only queued for
+        indexing.
         '''
-        doctype = cls._get_doctype()
-        fields = cls._get_indexed_fields()
+        if data.get('id') and cls._queue_index_update(data['id']):
+            return
+        index = cls.get_index()
+        if commit_within is None:
+            commit_within = _get_commit_within()
         try:
-            doc = to_indexed_doc(cls._get_before_index()(data),
-                                 doctype, fields)
-            cls.get_index().add(cls._get_doctype(), doc)
+            data = cls._get_before_index()(data)
+            index.add_many(cls._get_doctype(),
+                           cls._to_indexed_docs(index, data),
+                           commit=commit_within is None,
+                           commit_within=commit_within)
+            cls._invalidate_search_cache(commit_within)
+            cls._record_dependencies([data])
         except DontIndexException as e:
             logger.debug('Signaled to not index this resource %s.', str(e))
 
     @classmethod
-    def update_index_doc(cls, data):
+    def update_index_doc(cls, data, commit_within=None):
         u'''Updates an exiting document in the index.
 
+        The `index_id` (the unique key in the index) of the document is
+        derived from the document type and the entity id, so the existing
+        document is overwritten by adding the new version of the document -
+        with a single request to the index.
+
         :param data: ``dict``, the document to be updated. It must contain an
             `id` so the system can locate and update the document in the index.
+        :param commit_within: ``int``, optional, number of milliseconds within
+            which Solr should commit the document. If not given, the value of
+            `ckanext.knowledgehub.search.commit_within` is used, and if that is
+            not set either, the document is committed right away.
+
+        If the index update queue is enabled, the entity is only queued for
+        indexing.
         '''
-        index = cls.get_index()
-        fields = cls._get_indexed_fields()
-        fields_mapping = _get_fields_mapping(fields)
         entity_id = data['id']
-        id_key = fields_mapping.get('id', 'id')
-        indexed = index.search(cls._get_doctype(),
-                               q='%s:%s' % (id_key, entity_id))
-        doc = None
-        for d in indexed:
-            doc = d
-            break
-        if doc:
-            idarg = {id_key: doc[id_key]}
-            index.remove(cls._get_doctype(), **idarg)
+        if cls._queue_index_update(entity_id):
+            return
+        index = cls.get_index()
+        if commit_within is None:
+            commit_within = _get_commit_within()
         try:
-            index.add(cls._get_doctype(),
-                      to_indexed_doc(
-                        cls._get_before_index()(data),
-                        cls._get_doctype(),
-                        fields
-                      ))
+            data = cls._get_before_index()(data)
+            docs = cls._to_indexed_docs(index, data)
         except DontIndexException as e:
             logger.debug('Signaled to not index this resource %s.', str(e))
+            # The entity should no longer be in the index.
+            cls.delete_from_index(entity_id)
+            return
+        index.add_many(cls._get_doctype(),
+                       docs,
+                       commit=commit_within is None,
+                       commit_within=commit_within)
+        cls._invalidate_search_cache(commit_within)
+        cls._record_dependencies([data])
 
     @staticmethod
     def validate_solr_args(args):
@@ -573,8 +1879,13 @@ class Indexed:
         u'''Performs a search in the index for documents of this type.
 
         The query arguments are going to be translated into valid Solr query
-        parameters.
+        parameters. Only the indexed fields of the model are fetched from the
+        index, or the fields of the `projection` if one is given (see
+        ``get_projection_fl``). An explicit `fl` takes precedence.
         '''
+        projection = query.pop('projection', None)
+        if not query.get('fl'):
+            query['fl'] = cls.get_projection_fl(projection)
 
         if query.get('boost_for'):
             # Delay the loading of the user_profile service
@@ -594,6 +1905,25 @@ class Indexed:
         index_results.docs = results
         return index_results
 
+    @classmethod
+    def iter_search_index(cls, **query):
+        u'''Iterates over all documents of this type that match the query.
+
+        Unlike ``search_index``, the number of results is not limited - the
+        documents are streamed from the index page by page (see
+        ``Index.iter_search``), so this is the method to be used by the bulk
+        consumers of the index.
+
+        :returns: generator of ``dict``, the documents data.
+        '''
+        projection = query.pop('projection', None)
+        if not query.get('fl'):
+            query['fl'] = cls.get_projection_fl(projection)
+        Indexed.validate_solr_args(query)
+        fields = cls._get_indexed_fields()
+        for doc in cls.get_index().iter_search(cls._get_doctype(), **query):
+            yield indexed_doc_to_data_dict(doc, fields)
+
     @classmethod
     def delete_from_index(cls, data):
         u'''Deletes a document from the index.
@@ -612,6 +1942,37 @@ class Indexed:
         args = {}
         args[id_key] = doc_id
         cls.get_index().remove(doctype, **args)
+        cls._invalidate_search_cache()
+        cls._remove_dependencies([doc_id])
+
+
+def _get_commit_within():
+    commit_within = config.get('ckanext.knowledgehub.search.commit_within')
+    if not commit_within:
+        return None
+    return int(commit_within)
+
+
+def _merge_sorted_ids(db_ids, index_ids):
+    u'''Merges two sorted streams of ids.
+
+    Yields a tuple ``(id, in_db, in_index)`` for every distinct id found in
+    any of the streams.
+    '''
+    _end = object()
+    db_id = next(db_ids, _end)
+    index_id = next(index_ids, _end)
+    while db_id is not _end or index_id is not _end:
+        if index_id is _end or (db_id is not _end and db_id < index_id):
+            yield db_id, True, False
+            db_id = next(db_ids, _end)
+        elif db_id is _end or index_id < db_id:
+            yield index_id, False, True
+            index_id = next(index_ids, _end)
+        else:
+            yield db_id, True, True
+            db_id = next(db_ids, _end)
+            index_id = next(index_ids, _end)
 
 
 def boost_solr_params(values):
@@ -649,6 +2010,100 @@ def get_fq_permission_labels(permission_labels):
     return fq
 
 
+def get_max_match_group_sets():
+    u'''Returns the number of group sets (required for the implicit access to
+    a dashboard) that are evaluated by the dashboard searches - the largest
+    number of group sets required by an indexed dashboard.
+
+    Until it is recorded (the dashboards are indexed), or when Redis is not
+    available, `ckanext.knowledgehub.dashboards.max_match_group_sets` is
+    used.
+    '''
+    recorded = match_group_set_counts.get_max()
+    if recorded is not None:
+        return recorded
+    return int(config.get(
+        'ckanext.knowledgehub.dashboards.max_match_group_sets', 20))
+
+
+def _get_member_group_ids(permission_labels):
+    # The labels of the memberships in multiple groups (or organizations)
+    # contain the sorted ids joined with '-' (member-<id1>-<id2>), so they
+    # start with the label of the first group.
+    ids = set([label[len('member-'):] for label in permission_labels
+               if label.startswith('member-')])
+    return sorted([group_id for group_id in ids
+                   if not any([group_id.startswith(other + '-')
+                               for other in ids])])
+
+
+def get_fq_dashboard_permission_labels(permission_labels, max_sets=None):
+    u'''Builds the filter query for the dashboards the user has access to.
+
+    The user has explicit access to a dashboard when any of the dashboard
+    permission labels matches the user permission labels. The user has
+    implicit access to a dashboard when the user is a member of at least one
+    group (or organization) of every group set the dashboard requires. The
+    group sets are indexed in `idx_match_groups` as `<set index>:<group id>`
+    and their number in `match_groups_count`, so the implicit access is
+    evaluated by Solr with a function query that counts the group sets the
+    user belongs to.
+
+    :param permission_labels: ``list``, the user permission labels.
+    :param max_sets: ``int``, the number of group sets to evaluate. Defaults
+        to the largest number of group sets required by an indexed dashboard
+        (see ``get_max_match_group_sets``).
+
+    :returns: ``str``, the filter query.
+    '''
+    group_ids = _get_member_group_ids(permission_labels)
+    if not group_ids:
+        return get_fq_permission_labels(permission_labels)
+    if max_sets is None:
+        max_sets = get_max_match_group_sets()
+
+    matched_sets = []
+    for set_index in range(max_sets):
+        terms = ["termfreq(idx_match_groups,'%d:%s')" % (set_index, group_id)
+                 for group_id in group_ids]
+        if len(terms) == 1:
+            matched_sets.append(terms[0])
+        else:
+            matched_sets.append('min(1,sum(%s))' % ','.join(terms))
+
+    explicit = get_fq_permission_labels(permission_labels)[1:]
+    implicit = ('match_groups_count:[1 TO *] AND '
+                '_query_:"{!frange l=0 u=0}sub(match_groups_count,sum(%s))"'
+                % ','.join(matched_sets))
+    return '+(%s OR (%s))' % (explicit, implicit)
+
+
+def check_dashboard_access(data, permission_labels):
+    u'''Checks whether the user has access to the dashboard the same way the
+    filter query built by ``get_fq_dashboard_permission_labels`` does, but
+    on the dashboard data instead of the indexed document.
+
+    :param data: ``dict``, the dashboard data, as prepared for indexing
+        (see ``Dashboard.before_index``).
+    :param permission_labels: ``list``, the user permission labels.
+
+    :returns: ``bool``, ``True`` if the user has explicit or implicit access
+        to the dashboard.
+    '''
+    if set(permission_labels) & set(data.get('permission_labels') or []):
+        return True
+    count = data.get('match_groups_count') or 0
+    if not count:
+        return False
+    group_ids = set(_get_member_group_ids(permission_labels))
+    matched_sets = set()
+    for entry in data.get('idx_match_groups') or []:
+        set_index, group_id = entry.split(':', 1)
+        if group_id in group_ids:
+            matched_sets.add(set_index)
+    return len(matched_sets) == count
+
+
 def get_sort_string(model_cls, sort_str):
     sort_by = _parse_sort_str(sort_str)
     if not sort_by:
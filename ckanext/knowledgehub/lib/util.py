@@ -17,6 +17,14 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 '''Utitlities used accross the extension.
 '''
+from logging import getLogger
+
+from sqlalchemy import event
+
+
+log = getLogger(__name__)
+
+_AFTER_COMMIT_KEY = 'ckanext.knowledgehub.after_commit'
 
 
 class monkey_patch:
@@ -136,3 +144,39 @@ def get_as_list(prop, data):
         return map(lambda v: v.strip(),
                    filter(lambda v: v and v.strip(), value.split(',')))
     return []
+
+
+def _run_after_commit(session):
+    callbacks = session.info.get(_AFTER_COMMIT_KEY) or []
+    session.info[_AFTER_COMMIT_KEY] = []
+    for callback in callbacks:
+        try:
+            callback()
+        except Exception as e:
+            log.warning('Failed to run a callback after commit. Error: %s',
+                        str(e))
+            log.exception(e)
+
+
+def _discard_after_commit(session, transaction):
+    # Called after the callbacks have run when the transaction is committed,
+    # and discards them when it is rolled back or closed.
+    if transaction.parent is None:
+        session.info[_AFTER_COMMIT_KEY] = []
+
+
+def after_commit(session, callback):
+    '''Calls the callback once the current transaction of the session is
+    committed, so the changes are visible to the other processes when the
+    callback runs. The callback is discarded if the transaction is rolled
+    back or closed without a commit.
+
+    :param session: the SQLAlchemy session (not the scoped session).
+    :param callback: `function`, called without arguments.
+    '''
+    if _AFTER_COMMIT_KEY not in session.info:
+        event.listen(session, 'after_commit', _run_after_commit)
+        event.listen(session, 'after_transaction_end',
+                     _discard_after_commit)
+        session.info[_AFTER_COMMIT_KEY] = []
+    session.info[_AFTER_COMMIT_KEY].append(callback)
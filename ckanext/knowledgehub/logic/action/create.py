@@ -75,6 +75,11 @@ from ckanext.knowledgehub.lib.writer import WriterService
 from ckanext.knowledgehub import helpers as plugin_helpers
 from ckanext.knowledgehub.lib.profile import user_profile_service
 from ckanext.knowledgehub.lib.util import get_as_list
+from ckanext.knowledgehub.lib.predictions import prediction_index
+from ckanext.knowledgehub.lib.cache import (
+    tag_keyword_map,
+    permission_labels_cache,
+)
 from ckanext.knowledgehub.logic.jobs import (
     schedule_update_index,
     schedule_notification_email,
@@ -849,6 +854,7 @@ def kwh_data_create(context, data_dict):
     if not kwh_data:
         kwh_data = KWHData(**data)
         kwh_data.save()
+        prediction_index.mark_stale()
 
     return kwh_data.as_dict()
 
@@ -1210,6 +1216,9 @@ def member_create(context, data_dict=None):
     model.Session.add(member)
     model.repo.commit()
 
+    if obj_type == 'user':
+        permission_labels_cache.bump_version()
+
     if obj_type == 'package':
         plugin_helpers.views_dashboards_groups_update(data_dict.get('object'))
 
@@ -1253,6 +1262,7 @@ def tag_create(context, data_dict):
 
     if not context.get('defer_commit'):
         model.repo.commit()
+        tag_keyword_map.invalidate()
 
     log.debug("Created tag '%s' " % tag)
     tag.__class__ = ExtendedTag
@@ -1303,7 +1313,13 @@ def keyword_create(context, data_dict):
         tag_dict = _table_dictize(db_tag, context)
         kwd_dict['tags'].append(tag_dict)
 
-        schedule_update_index(tag_dict['name'])
+    tag_keyword_map.invalidate()
+    if kwd_dict['tags']:
+        # The documents reference the tags either by id or by name.
+        schedule_update_index({
+            'tag': [tag['id'] for tag in kwd_dict['tags']] +
+                   [tag['name'] for tag in kwd_dict['tags']],
+        })
 
     return kwd_dict
 
@@ -50,6 +50,11 @@ from ckanext.knowledgehub.model import (
     LikesRef,
 )
 from ckanext.knowledgehub.logic.jobs import schedule_update_index
+from ckanext.knowledgehub.lib.predictions import prediction_index
+from ckanext.knowledgehub.lib.cache import (
+    tag_keyword_map,
+    permission_labels_cache,
+)
 
 
 log = logging.getLogger(__name__)
@@ -245,6 +250,9 @@ def member_delete(context, data_dict=None):
         member.delete()
         model.repo.commit()
 
+    if obj_type == 'user':
+        permission_labels_cache.bump_version()
+
     if obj_type == 'package':
         plugin_helpers.views_dashboards_groups_update(data_dict.get('object'))
 
@@ -269,8 +277,9 @@ def keyword_delete(context, data_dict):
 
     Session.delete(Keyword.get(keyword['id']))
     Session.commit()
+    tag_keyword_map.invalidate()
 
-    schedule_update_index(keyword['name'])
+    schedule_update_index({'keyword': [keyword['id'], keyword['name']]})
 
 
 def tag_delete_by_name(context, data_dict):
@@ -295,6 +304,7 @@ def tag_delete_by_name(context, data_dict):
 
     tag_obj.delete()
     model.repo.commit()
+    tag_keyword_map.invalidate()
 
 
 def delete_tag_in_rq(context, data_dict):
@@ -499,6 +509,7 @@ def tag_delete(context, data_dict):
 
     tag_obj.delete()
     model.repo.commit()
+    tag_keyword_map.invalidate()
 
     return {"message": _('The tag is deleted.')}
 
@@ -531,6 +542,7 @@ def package_delete(context, data_dict):
     ckan_package_delete(context, data_dict)
     try:
         KWHData.delete({'dataset': data_dict['id']})
+        prediction_index.invalidate()
     except Exception as e:
         log.debug('Cannot remove dataset from kwh data %s' % str(e))
 
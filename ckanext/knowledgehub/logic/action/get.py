@@ -16,7 +16,6 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 import logging
-import re
 import os
 import json
 from six import string_types, iteritems
@@ -58,9 +57,16 @@ from ckanext.knowledgehub.model import (
 )
 from ckanext.knowledgehub import helpers as kh_helpers
 from ckanext.knowledgehub.lib.rnn import PredictiveSearchModel
+from ckanext.knowledgehub.lib.predictions import prediction_index
+from ckanext.knowledgehub.lib.cache import (
+    search_results_cache,
+    group_map,
+)
 from ckanext.knowledgehub.lib.solr import (
     ckan_params_to_solr_args,
+    connection_pool,
     get_fq_permission_labels,
+    get_fq_dashboard_permission_labels,
     get_sort_string,
     escape_str as solr_escape_str,
 )
@@ -552,8 +558,7 @@ def dashboard_list(context, data_dict):
     if not (sysadmin_user or ignore_auth):
         if not ignore_permissions:
             permission_labels = get_user_permission_labels(context)
-            query = _get_dashboard_search_args(Dashboard, query,
-                                               permission_labels)
+            query = _get_dashboard_search_args(query, permission_labels)
 
     docs = Dashboard.search_index(**query)
 
@@ -854,50 +859,7 @@ def _get_predictions_from_db(query):
         )
     )
 
-    text = ' '.join(query.split()[-3:])
-    data_dict = {
-        'q': text,
-        'limit': 10,
-        'order_by': 'created_at desc'
-    }
-    kwh_data = toolkit.get_action('kwh_data_list')({}, data_dict)
-
-    def _get_predict(text, query, index):
-        predict = ''
-        if index != -1:
-            index = index + len(query)
-            for i, ch in enumerate(text[index:]):
-                if ch.isalnum() or (i == 0 and ch == ' '):
-                    predict += ch
-                else:
-                    break
-
-        return predict
-
-    def _findall(pattern, text):
-        return [
-            match.start(0) for match in re.finditer(pattern, text)
-        ]
-
-    predictions = []
-    for data in kwh_data.get('data', []):
-        if len(predictions) >= number_predictions:
-            break
-
-        title = data.get('title').lower()
-        for index in _findall(query, title):
-            predict = _get_predict(title, query, index)
-            if predict != '' and predict not in predictions:
-                predictions.append(predict)
-
-        if data.get('description'):
-            description = data.get('description').lower()
-            for index in _findall(query, description):
-                predict = _get_predict(description, query, index)
-                if predict != '' and predict not in predictions:
-                    predictions.append(predict)
-
-    return predictions[:number_predictions]
+    return prediction_index.complete(query, number_predictions)
 
 
 @toolkit.side_effect_free
@@ -932,8 +894,6 @@ def get_predictions(context, data_dict):
 
 
 def _search_entity(index, ctx, data_dict):
-    model = ctx['model']
-    session = ctx['session']
     ignore_permissions = data_dict.pop('ignore_permissions', False)
     ignore_auth = ctx.get('ignore_auth')
     user = ctx.get('auth_user_obj')
@@ -955,6 +915,8 @@ def _search_entity(index, ctx, data_dict):
     data_dict['rows'] = page_size
     data_dict['start'] = (page - 1) * page_size
 
+    projection = data_dict.pop('projection', None)
+
     text = data_dict.get('text')
     if not text:
         raise ValidationError({'text': _('Missing value')})
@@ -962,6 +924,9 @@ def _search_entity(index, ctx, data_dict):
     _save_user_query(ctx, text, index.doctype)
 
     args = ckan_params_to_solr_args(data_dict)
+    if projection:
+        args['projection'] = projection
+    permission_labels = None
 
     if ctx.get('auth_user_obj'):
         args['boost_for'] = ctx['auth_user_obj'].id
@@ -974,28 +939,40 @@ def _search_entity(index, ctx, data_dict):
         use_permissions = not ignore_permissions
         if use_permissions and regular_access:
             permission_labels = get_user_permission_labels(ctx)
-            if permission_labels:
-                fq = args.get('fq', [])
-                if isinstance(fq, str) or isinstance(fq, unicode):
-                    fq = [fq]
-                if index.doctype == 'dashboard':
-                    # In the case of dashboards, we must first execute a query
-                    # to obtain possible hits for the dashboards and then
-                    # decide which dashboards the user has access to based on
-                    # the user permission labels.
-                    args = _get_dashboard_search_args(index, args,
-                                                      permission_labels)
-                else:
-                    fq.append(get_fq_permission_labels(permission_labels))
-                    args['fq'] = fq
 
-    results = index.search_index(**args)
+    def _search():
+        search_args = dict(args)
+        if permission_labels:
+            fq = search_args.get('fq', [])
+            if isinstance(fq, str) or isinstance(fq, unicode):
+                fq = [fq]
+            # copy, so the cached query arguments are not modified
+            fq = list(fq)
+            if index.doctype == 'dashboard':
+                if 'fq' in search_args:
+                    search_args['fq'] = fq
+                # The dashboards can also be accessed implicitly, through
+                # the access to the datasets that provide the data.
+                search_args = _get_dashboard_search_args(search_args,
+                                                         permission_labels)
+            else:
+                fq.append(get_fq_permission_labels(permission_labels))
+                search_args['fq'] = fq
+        results = index.search_index(**search_args)
+        return {
+            'hits': results.hits,
+            'docs': results.docs,
+            'facets': results.facets,
+            'stats': results.stats,
+        }
 
-    results.page = page
-    results.page_size = page_size
+    # The results are cached per normalized query and set of permission
+    # labels, so the repeated searches do not hit Solr.
+    results = search_results_cache.get_or_search(index.doctype, args,
+                                                 permission_labels, _search)
 
     # get facets and convert facets list to a dict
-    facets = results.facets.get('facet_fields', {})
+    facets = results['facets'].get('facet_fields', {})
     for field, values in iteritems(facets):
         facets[field] = dict(zip(values[0::2], values[1::2]))
 
@@ -1003,18 +980,15 @@ def _search_entity(index, ctx, data_dict):
     for field_name in ('groups', 'organizations'):
         group_names.extend(facets.get(field_name, {}).keys())
 
-    groups = (session.query(model.Group.name, model.Group.title)
-              .filter(model.Group.name.in_(group_names))
-              .all()
-              if group_names else [])
-    group_titles_by_name = dict(groups)
+    group_titles_by_name = (group_map.get_titles(group_names)
+                            if group_names else {})
 
     result_dict = {
-        'count': results.hits,
-        'results': results.docs,
+        'count': results['hits'],
+        'results': results['docs'],
         'facets': facets,
         'search_facets': _restructured_facets(facets, group_titles_by_name),
-        'stats': results.stats,
+        'stats': results['stats'],
         'page': page,
         'limit': page_size,
     }
@@ -1026,60 +1000,10 @@ def _search_entity(index, ctx, data_dict):
     return _results_wrapper(result_dict)
 
 
-def _get_dashboard_search_args(index, args, permission_labels):
-    results = index.search_index(**args)
-    accessible_dashboards = []
-
-    groups_set = set(
-        map(lambda _p: _p.strip('member-'),
-            filter(lambda _p: _p.startswith('member-'), permission_labels)))
-
-    perm_label_set = set(permission_labels)
-
-    def _get_match_permission(dashboard):
-        for perm in dashboard.get('permission_labels', []):
-            if perm.startswith('match-groups-'):
-                perm = perm[len('match-groups-'):]
-                match_all = perm.split('+')
-                permissions = []
-                if match_all:
-                    for match_any in match_all:
-                        match_any = match_any.split('|')
-                        permissions.append(
-                            ['member-{}'.format(p) for p in match_any])
-                return permissions
-        return None
-
-    def _has_any_of(perms):
-        return set(perms).intersection(perm_label_set)
-
-    def _has_all(perm_sets):
-        for perms in perm_sets:
-            if not _has_any_of(perms):
-                return False
-        return True
-
-    for dashboard in results.docs:
-        dashboard_permissions = set(dashboard.get('permission_labels', []))
-        if perm_label_set.intersection(dashboard_permissions):
-            # Basic membership, explicitly shared with user/org/group
-            accessible_dashboards.append(dashboard['id'])
-            continue
-
-        permissions = _get_match_permission(dashboard)
-        if permissions and _has_all(permissions):
-            # The user must have full permission to view every dataset that
-            # provides data to the dashboard, so we can enable implict access
-            # to this dashboard.
-            accessible_dashboards.append(dashboard['id'])
-
-    fq = None
-    if not accessible_dashboards:
-        fq = 'entity_id:__NONE__'
-    else:
-        fq = '+entity_id:({})'.format(
-            ' OR '.join(accessible_dashboards)
-        )
+def _get_dashboard_search_args(args, permission_labels):
+    # Both the explicit and the implicit access to the dashboards are
+    # evaluated by Solr, so the access filter is just one more filter query.
+    fq = get_fq_dashboard_permission_labels(permission_labels)
     if 'fq' not in args:
         args['fq'] = fq
     else:
@@ -1139,6 +1063,12 @@ def _save_user_query(ctx, text, doc_type):
 def search_dashboards(context, data_dict):
     u'''Performs a search in the index for dashboards.
 
+    Only the dashboards the user has access to (shared with the user, or
+    implicitly through the access to their datasets) are returned. The
+    access is checked by the index query, so `count` is the number of all
+    accessible dashboards matching the query and `results` contains only the
+    requested `page`.
+
     :param data_dict: ``dict``, the query arguments for the search.
 
     :returns: ``list``, the documents matching the search query from the index.
@@ -1180,6 +1110,86 @@ def search_visualizations(context, data_dict):
     return _search_entity(Visualization, context, data_dict)
 
 
+@toolkit.side_effect_free
+def search_connection_pool_stats(context, data_dict):
+    u'''Returns the usage counters of the Solr connection pool in the current
+    process. Useful for sizing the pool under load.
+
+    :returns: ``dict``, the pool `size` and the number of `created`, `in_use`
+        and `idle` connections, the number of `waits` for a free connection,
+        `reconnects` and connection `errors`.
+    '''
+    check_access('search_connection_pool_stats', context, data_dict)
+
+    return connection_pool.stats()
+
+
+@toolkit.side_effect_free
+def search_cache_stats(context, data_dict):
+    u'''Returns the usage counters of the search results cache in the current
+    process.
+
+    :returns: ``dict``, the number of `local_hits`, `redis_hits`, `misses` and
+        `errors`, the overall `hit_rate` and the number of entries in the
+        in-process tier (`local_size`).
+    '''
+    check_access('search_cache_stats', context, data_dict)
+
+    return search_results_cache.stats()
+
+
+EXPORTED_DOCTYPES = {
+    'dashboard': Dashboard,
+    'research_question': ResearchQuestion,
+    'visualization': Visualization,
+    'post': Posts,
+}
+
+
+def _search_index_export(context, data_dict):
+    u'''Streams all documents of the given type that match the query, as JSON
+    lines (one JSON encoded document per line).
+
+    The documents are read from the index page by page, so the export is not
+    limited in size. This is not an action, as the generator it returns can
+    not be serialized by the API. Through HTTP it is available with the
+    streaming endpoint `/search-index/export/<type>`.
+
+    :param type: `str`, the document type - one of `dashboard`,
+        `research_question`, `visualization` or `post`.
+    :param text: `str`, the text to search for. Optional, by default all
+        documents are exported.
+    :param fq: `str` or `list`, additional Solr filter queries. Optional.
+    :param sort: `str`, the sort string. Optional.
+
+    :returns: generator of `str`, the JSON lines.
+    '''
+    check_access('search_index_export', context, data_dict)
+
+    doctype = data_dict.get('type')
+    if doctype not in EXPORTED_DOCTYPES:
+        raise ValidationError({
+            'type': _('Must be one of: %s') % ', '.join(
+                sorted(EXPORTED_DOCTYPES.keys()))
+        })
+    model = EXPORTED_DOCTYPES[doctype]
+
+    query = {
+        'q': 'text:%s' % solr_escape_str(data_dict.get('text') or '*'),
+    }
+    if data_dict.get('fq'):
+        query['fq'] = data_dict['fq']
+    if data_dict.get('sort'):
+        query['sort'] = get_sort_string(model, data_dict['sort'])
+    model.validate_solr_args(query)
+
+    def _export():
+        for doc in model.iter_search_index(**query):
+            yield json.dumps(doc, cls=DateTimeEncoder) + '\n'
+
+    return _export()
+
+
 @toolkit.side_effect_free
 def user_intent_list(context, data_dict):
     ''' List the users intents
@@ -1710,19 +1720,26 @@ def dash_search_tag(context, data_dict):
     :returns: `list`, list of ids of dashboards that have the specific tag.
     '''
     tag = data_dict.get('tags')
-    result = []
-    x = toolkit.get_action('dashboard_list')(context, {})
-    dash_list = x.get('data')
+    if not tag:
+        return []
 
-    for dash in dash_list:
-        tags = dash.get('tags')
-        if tags:
-            if isinstance(tags, str) or isinstance(tags, unicode):
-                tags = tags.split(',')
-            for element in tags:
-                if element == tag:
-                    dash_id = dash.get('id')
-                    result.append(dash_id)
+    user = context.get('auth_user_obj')
+    ignore_auth = context.get('ignore_auth')
+    sysadmin_user = user and hasattr(user, 'sysadmin') and user.sysadmin
+
+    query = {
+        'q': '*:*',
+        'fq': 'idx_tags:%s' % solr_escape_str(tag),
+    }
+    if not (sysadmin_user or ignore_auth):
+        permission_labels = get_user_permission_labels(context)
+        query = _get_dashboard_search_args(query, permission_labels)
+
+    # Stream all matching dashboards from the index, as the dashboard_list
+    # is limited to a single page of results.
+    result = []
+    for dash in Dashboard.iter_search_index(**query):
+        result.append(dash['id'])
     return result
 
 
@@ -2301,6 +2318,10 @@ def post_search(context, data_dict):
     # Ignore permissions label, because everyone should be able to see posts.
     data_dict['ignore_permissions'] = True
 
+    if data_dict.get('with_entity', True) and 'projection' not in data_dict:
+        # The posts are loaded from the database, only the ids are needed.
+        data_dict['projection'] = 'ids'
+
     posts = _search_entity(Posts, context, data_dict)
 
     if data_dict.get('with_entity', True):
@@ -2692,30 +2713,25 @@ def _find_users(usernames=None):
 
 
 def _find_organizations_or_groups(names=None):
-    q = model.Session.query(model.Group)
-    q = q.filter(model.group_table.c.state == 'active')
-    if names:
-        q = q.filter(model.group_table.c.name.in_(names))
-
     def _org_image(org):
-        gtype = 'organization' if org.is_organization else 'group'
-        if not org.image_url:
+        gtype = 'organization' if org['is_organization'] else 'group'
+        if not org['image_url']:
             return '/base/images/placeholder-{}.png'.format(gtype)
-        return '/uploads/group/{}'.format(org.image_url)
+        return '/uploads/group/{}'.format(org['image_url'])
 
     def _org_link(org):
-        if org.is_organization:
-            return h.url_for('/organization/{}'.format(org.name))
-        return h.url_for('/group/{}'.format(org.name))
+        if org['is_organization']:
+            return h.url_for('/organization/{}'.format(org['name']))
+        return h.url_for('/group/{}'.format(org['name']))
 
     return map(lambda g: {
-        'id': g.id,
-        'label': g.title or g.name,
-        'value': g.name,
+        'id': g['id'],
+        'label': g['title'] or g['name'],
+        'value': g['name'],
         'link':  _org_link(g),
         'image': _org_image(g),
-        'type': 'organization' if g.is_organization else 'group',
-    }, q.all())
+        'type': 'organization' if g['is_organization'] else 'group',
+    }, group_map.find(names or None))
 
 
 def resolve_mentions(context, data_dict):
@@ -70,9 +70,10 @@ from ckanext.knowledgehub import helpers as plugin_helpers
 from ckanext.knowledgehub.logic.jobs import schedule_data_quality_check
 from ckanext.knowledgehub.lib.profile import user_profile_service
 from ckanext.knowledgehub.lib.util import get_as_list
+from ckanext.knowledgehub.lib.predictions import prediction_index
+from ckanext.knowledgehub.lib.cache import tag_keyword_map
 from ckanext.knowledgehub.logic.jobs import (
     schedule_update_index,
-    update_dashboard_index,
     schedule_notification_email,
     schedule_broadcast_notification_email,
 )
@@ -285,6 +286,10 @@ def research_question_update(context, data_dict):
 
     # Update index
     ResearchQuestion.update_index_doc(rq_data)
+    if rq_data.get('title') != context['research_question_title'] or \
+            rq_data.get('name') != context['research_question_name']:
+        # The related documents contain the title of the research question.
+        schedule_update_index({'research_question': [rq_data['id']]})
 
     # Update kwh data
     try:
@@ -422,6 +427,7 @@ def resource_view_update(context, data_dict):
 
     # Update index
     Visualization.update_index_doc(resource_view_data)
+    schedule_update_index({'visualization': [resource_view_data['id']]})
 
     # Update kwh data
     try:
@@ -571,6 +577,7 @@ def dashboard_update(context, data_dict):
 
     # Update index
     Dashboard.update_index_doc(dashboard_data)
+    schedule_update_index({'dashboard': [dashboard_data['id']]})
 
     # Send notification for sharing with users
     if isinstance(existing_shared_users, unicode):
@@ -814,12 +821,10 @@ def package_update(context, data_dict):
             ))
 
     try:
-        log.debug('Refreshing index for related dashboards...')
-        update_dashboard_index([result['id']])
-        log.debug('Dashboard index refreshed successfully.')
+        schedule_update_index({'dataset': [result['id'], result.get('name')]})
     except Exception as e:
-        log.warning('Failed to refresh dashboard index for package %s. '
-                    'Error: %s',
+        log.warning('Failed to schedule index update for the documents '
+                    'related to package %s. Error: %s',
                     result.get('id'),
                     str(e))
         log.exception(e)
@@ -873,6 +878,7 @@ def kwh_data_update(context, data_dict):
         update_data['description'] = data.get('description')
 
         kwh_data = KWHData.update(data_filter, update_data)
+        prediction_index.invalidate()
     else:
         data_dict = {
             'user': data.get('user'),
@@ -883,6 +889,7 @@ def kwh_data_update(context, data_dict):
         }
         kwh_data = KWHData(**data_dict)
         kwh_data.save()
+        prediction_index.mark_stale()
 
     return kwh_data.as_dict()
 
@@ -1281,6 +1288,11 @@ def tag_update(context, data_dict):
     if not tag:
         raise NotFound(_('Tag was not found'))
 
+    refs = {
+        'tag': [tag.id, tag.name],
+        'keyword': [tag.keyword_id],
+    }
+
     tag.name = data_dict.get('name', tag.name)
 
     # Force the vocabulary id update always.
@@ -1289,6 +1301,10 @@ def tag_update(context, data_dict):
     session = context['session']
     tag.save()
     session.commit()
+    tag_keyword_map.invalidate()
+
+    refs['tag'].append(tag.name)
+    schedule_update_index(refs)
 
     return _table_dictize(tag, context)
 
@@ -1313,9 +1329,17 @@ def keyword_update(context, data_dict):
     if not existing:
         raise logic.NotFound(_('Not found'))
 
+    # The documents reference the keyword and its tags either by id or by
+    # name.
+    refs = {
+        'keyword': [existing.id, existing.name],
+        'tag': [],
+    }
+
     if data_dict.get('name', '').strip():
         keyword_name = re.sub(r'\s+', '-', data_dict['name'].strip())
         existing.name = keyword_name
+        refs['keyword'].append(keyword_name)
 
     existing.modified_at = datetime.datetime.utcnow()
     existing.save()
@@ -1323,6 +1347,7 @@ def keyword_update(context, data_dict):
     for tag in Keyword.get_tags(existing.id):
         tag.keyword_id = None
         tag.save()
+        refs['tag'].extend([tag.id, tag.name])
 
     kwd_dict = _table_dictize(existing, context)
     kwd_dict['tags'] = []
@@ -1343,8 +1368,10 @@ def keyword_update(context, data_dict):
         db_tag.save()
         tag_dict = _table_dictize(db_tag, context)
         kwd_dict['tags'].append(tag_dict)
+        refs['tag'].extend([tag_dict['id'], tag_dict['name']])
 
-    schedule_update_index(kwd_dict['name'])
+    tag_keyword_map.invalidate()
+    schedule_update_index(refs)
 
     return kwd_dict
 
@@ -18,4 +18,5 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from ckanext.knowledgehub.logic.auth.permissions import (
     get_permission_labels,
     get_user_permission_labels,
+    get_user_labels,
 )
\ No newline at end of file
@@ -22,6 +22,17 @@ from ckan.logic.auth.get import (
     package_search as ckan_package_search,
 )
 from ckan.logic import chained_action
+from ckanext.knowledgehub.lib.solr import (
+    check_dashboard_access,
+    index_update_queue,
+)
+from ckanext.knowledgehub.logic.auth.permissions import (
+    get_user_permission_labels,
+)
+from logging import getLogger
+
+
+log = getLogger(__name__)
 
 
 @toolkit.auth_allow_anonymous_access
@@ -60,9 +71,32 @@ def dashboard_show(context, data_dict):
     if docs.get('count') > 0:
         return {'success': True}
 
+    # With the index update queue, a dashboard that was just created or
+    # updated may not be indexed yet, so the access is checked against the
+    # dashboard in the database.
+    if index_update_queue.is_enabled() and \
+            _check_dashboard_access_in_db(context, data_dict):
+        return {'success': True}
+
     return {'success': False}
 
 
+def _check_dashboard_access_in_db(context, data_dict):
+    # Delay the loading of the model
+    from ckanext.knowledgehub.model import Dashboard
+
+    dashboard = Dashboard.get(data_dict.get('id') or data_dict.get('name'))
+    if dashboard is None:
+        return False
+    try:
+        data = Dashboard.before_index(dict(dashboard.__dict__))
+    except Exception as e:
+        log.warning('Failed to check the access to dashboard %s. Error: %s',
+                    dashboard.id, str(e))
+        return False
+    return check_dashboard_access(data, get_user_permission_labels(context))
+
+
 def intent_list(context, data_dict):
     # sysadmins only
     return {'success': False}
@@ -78,6 +112,21 @@ def user_query_show(context, data_dict):
     return {'success': False}
 
 
+def search_connection_pool_stats(context, data_dict):
+    # sysadmins only
+    return {'success': False}
+
+
+def search_cache_stats(context, data_dict):
+    # sysadmins only
+    return {'success': False}
+
+
+def search_index_export(context, data_dict):
+    # sysadmins only
+    return {'success': False}
+
+
 def user_intent_list(context, data_dict):
     # sysadmins only
     return {'success': False}
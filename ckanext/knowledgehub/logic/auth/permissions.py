@@ -21,6 +21,8 @@ u'''Helper function to manage permission labels for multiple indexed entities.
 from ckan import model
 from ckan.model.meta import Session
 
+from ckanext.knowledgehub.lib.cache import permission_labels_cache
+
 
 _PERMISSION_LABEL_PREFIX = {
     'shared_with_users': 'user-%s',
@@ -45,22 +47,43 @@ def get_permission_labels(data_dict):
 
 
 def get_user_permission_labels(context):
-    labels = ['public']
+    return get_user_labels(context.get('auth_user_obj'))
+
+
+def get_user_labels(user):
+    u'''Returns the permission labels of the user, used both for searching
+    the datasets and the other indexed entities.
+
+    The labels derived from the memberships of the user in organizations and
+    groups are cached.
 
-    if context.get('auth_user_obj') is not None:
-        user = context['auth_user_obj']
-        labels.append('user-%s' % user.id)
-        labels.append('creator-%s' % user.id)
+    :param user: `User`, the user object, or `None` for anonymous users.
+
+    :returns: `list` of `str`, the permission labels.
+    '''
+    labels = [u'public']
+    if user is None:
+        return labels
+
+    labels.append(u'creator-%s' % user.id)
+    labels.append(u'user-%s' % user.name)
+    labels.append(u'user-%s' % user.id)
+    labels.extend(permission_labels_cache.get_or_load(
+        user.id,
+        lambda: _get_member_labels(user.id)))
+    return labels
 
-        organizations, groups = _get_all_orgs_or_groups_for_user(user.id)
 
-        for ids in [organizations, groups]:
-            if ids:
-                if len(ids) > 1:
-                    labels.append('member-%s' % '-'.join(sorted(ids)))
-                for _id in ids:
-                    labels.append('member-%s' % _id)
+def _get_member_labels(user_id):
+    labels = []
+    organizations, groups = _get_all_orgs_or_groups_for_user(user_id)
 
+    for ids in [organizations, groups]:
+        if ids:
+            if len(ids) > 1:
+                labels.append(u'member-%s' % '-'.join(sorted(ids)))
+            for _id in ids:
+                labels.append(u'member-%s' % _id)
     return labels
 
 
@@ -71,6 +94,7 @@ def _get_all_orgs_or_groups_for_user(user_id):
     q = q.filter(model.member_table.c.table_id == user_id)
     q = q.filter(model.member_table.c.table_name == 'user')
     q = q.filter(model.member_table.c.state == 'active')
+    q = q.filter(model.group_table.c.state == 'active')
 
     organizations, groups = [], []
 
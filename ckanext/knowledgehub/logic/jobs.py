@@ -29,10 +29,17 @@ from ckanext.knowledgehub.lib.quality import (
 )
 from ckanext.knowledgehub.model import (
     Dashboard,
+    IndexDependency,
+    Posts,
     ResearchQuestion,
     Visualization,
 )
-from ckanext.knowledgehub.lib.solr import escape_str, Indexed, unprefixed
+from ckanext.knowledgehub.lib.solr import (
+    escape_str,
+    Indexed,
+    unprefixed,
+    index_update_queue,
+)
 from ckanext.knowledgehub.lib.email import send_notification_email
 import ckanext.knowledgehub.helpers as kwn_helpers
 
@@ -59,126 +66,220 @@ def schedule_data_quality_check(package_id, force_recalculate=False):
     jobs.enqueue(calculate_metrics, [package_id, force_recalculate])
 
 
-class IndexRefresh(object):
-
-    def find_documents(self, query):
-        pass
-
-    def refresh_index(self, id):
-        pass
-
-
-class IndexedModelsRefreshIndex(IndexRefresh):
-
-    def __init__(self, model, getfn='get'):
-        self.model = model
-        self.getfn = getfn
-        self.logger = getLogger('ckanext.jobs.IndexedModelsRefreshIndex[%s]' %
-                                self.model)
-
-    def find_documents(self, query):
-        doc_ids = []
-        for doc in self.model.search_index(q='text:%s' % escape_str(query)):
-            if doc.get('id'):
-                doc_ids.append(doc['id'])
-        self.logger.debug('Lookup for query "%s" found %d documents',
-                          query,
-                          len(doc_ids))
-        return doc_ids
-
-    def refresh_index_for(self, id):
-        doc = getattr(self.model, self.getfn)(id)
-        if doc:
-            doc = doc.__dict__
-            self.logger.debug('Updating doc: %s', str(doc))
-            return self.model.update_index_doc(doc)
-        self.logger.debug('Document with id %s was not found.', id)
-
-    def refresh_index(self, query):
-        for id in self.find_documents(query):
-            try:
-                self.refresh_index_for(id)
-            except Exception as e:
-                self.logger.warning('Failed to refresh index for %s. '
-                                    'Error: %s', id, str(e))
-                self.logger.exception(e)
-
-    def __str__(self):
-        return 'IndexedModelsRefreshIndex<%s>' % str(self.model)
-
-    def __repr__(self):
-        return self.__str__()
+# The fields of the indexed documents that reference the related entities,
+# by the type of the related entity.
+REFERENCE_FIELDS = {
+    'tag': ['idx_tags'],
+    'keyword': ['idx_keywords'],
+    'research_question': ['idx_research_questions'],
+    'dataset': ['idx_datasets'],
+    'group': ['idx_groups', 'idx_organizations'],
+}
 
 
 class _IndexedPackage(Indexed):
     doctype = 'package'
     indexed = [unprefixed('id')]
 
+    @classmethod
+    def index_by_ids(cls, ids):
+        ckan_search.rebuild(package_ids=sorted(set(ids)), defer_commit=True)
+        ckan_search.commit()
 
-class DatasetIndexRefresh(IndexedModelsRefreshIndex):
 
-    def __init__(self):
-        super(DatasetIndexRefresh, self).__init__(_IndexedPackage)
+DEPENDENT_MODELS = [
+    Dashboard,
+    ResearchQuestion,
+    Visualization,
+    Posts,
+    _IndexedPackage,
+]
+
+
+def reindex_documents(documents):
+    u'''Reindexes the given documents. The documents of every type are
+    reindexed in bulk, with a single commit.
+
+    :param documents: ``dict``, the document type mapped to a ``list`` of ids
+        of the documents.
+    '''
+    models = dict([(model.doctype, model) for model in DEPENDENT_MODELS])
+    for doctype, ids in documents.items():
+        model = models.get(doctype)
+        if not model:
+            logger.warning('Unknown document type to reindex: %s', doctype)
+            continue
+        try:
+            logger.debug('Reindexing %d %s documents.', len(ids), doctype)
+            model.index_by_ids(ids)
+        except Exception as e:
+            logger.warning('Failed to reindex the %s documents. Error: %s',
+                           doctype, str(e))
+            logger.exception(e)
 
-    def refresh_index(self, query):
-        package_ids = self.find_documents(query)
 
-        self.logger.debug('Rebuilding index for packages: %s', package_ids)
-        if package_ids:
-            for package_id in package_ids:
-                ckan_search.rebuild(package_id=package_id)
+def _get_references_fq(refs):
+    fq = []
+    for entity_type, values in sorted(refs.items()):
+        values = sorted(set(filter(None, values or [])))
+        if not values or entity_type not in REFERENCE_FIELDS:
+            continue
+        values = ' OR '.join([escape_str(value) for value in values])
+        for field in REFERENCE_FIELDS[entity_type]:
+            fq.append('%s:(%s)' % (field, values))
+    return ' OR '.join(fq)
+
+
+def find_referencing_documents(refs):
+    u'''Finds the indexed documents that reference any of the given related
+    entities, by the exact values of the `idx_*` reference fields.
+
+    :param refs: ``dict``, the type of the related entities mapped to a
+        ``list`` of references. The types without reference fields are
+        ignored.
+
+    :returns: ``dict``, the document type mapped to a sorted ``list`` of the
+        distinct ids of the referencing documents.
+    '''
+    fq = _get_references_fq(refs)
+    if not fq:
+        return {}
+    found = {}
+    for model in DEPENDENT_MODELS:
+        if model is _IndexedPackage:
+            continue
+        ids = set()
+        for doc in model.iter_search_index(q='*:*', fq=[fq],
+                                           projection='ids'):
+            if doc.get('id'):
+                ids.add(doc['id'])
+        if ids:
+            found[model.doctype] = sorted(ids)
+    return found
+
+
+def find_dependent_documents(refs):
+    u'''Finds the documents that depend on any of the given related
+    entities.
+
+    The dependencies recorded when the documents were indexed are used (see
+    ``IndexDependency``). Until any are recorded (after an upgrade, before the
+    index is rebuilt), the documents are looked up in the index by their
+    reference fields (see ``find_referencing_documents``).
+
+    :param refs: ``dict``, the type of the related entities mapped to a
+        ``list`` of references (see ``update_index``).
+
+    :returns: ``dict``, the document type mapped to a ``list`` of ids.
+    '''
+    try:
+        if IndexDependency.has_dependencies():
+            return IndexDependency.get_dependents(refs)
+    except Exception as e:
+        logger.warning('Failed to look up the recorded index dependencies. '
+                       'Error: %s', str(e))
+        logger.exception(e)
+    logger.debug('No index dependencies are recorded. Looking up the '
+                 'documents referencing: %s', refs)
+    return find_referencing_documents(refs)
+
+
+def update_index(refs):
+    u'''Reindexes the documents that were enriched from any of the given
+    related entities when they were indexed (see
+    ``find_dependent_documents``).
+
+    :param refs: ``dict``, the type of the related entities (`dataset`,
+        `research_question`, `tag`, `keyword`, `group`, `dashboard` or
+        `visualization`) mapped to a ``list`` of references (ids or names).
+    '''
+    reindex_documents(find_dependent_documents(refs))
+
+
+def schedule_update_index(refs, defer_lookup=False):
+    u'''Looks up the documents that depend on any of the given related
+    entities, and schedules exactly those documents to be reindexed.
+
+    The dependent documents are looked up by the background job instead
+    when no dependencies are recorded yet, or when `defer_lookup` is set -
+    for callers that can not use the database session (e.g. after a commit).
+
+    :param refs: ``dict``, the type of the related entities mapped to a
+        ``list`` of references (see ``update_index``).
+    :param defer_lookup: ``bool``, look up the dependent documents in the
+        background job.
+    '''
+    try:
+        if not defer_lookup and IndexDependency.has_dependencies():
+            dependents = IndexDependency.get_dependents(refs)
+            if dependents:
+                jobs.enqueue(reindex_documents, [dependents])
+            return
+    except Exception as e:
+        logger.warning('Failed to look up the documents depending on: %s. '
+                       'Error: %s', refs, str(e))
+        logger.exception(e)
+    jobs.enqueue(update_index, [refs])
+
+
+SYNCED_MODELS = [
+    Dashboard,
+    ResearchQuestion,
+    Visualization,
+    Posts,
+]
 
 
-def update_index(query):
-    refresh_indexers = [
-        IndexedModelsRefreshIndex(Dashboard),
-        IndexedModelsRefreshIndex(Visualization),
-        IndexedModelsRefreshIndex(ResearchQuestion, getfn='get_by_id'),
-        DatasetIndexRefresh(),
-    ]
+def sync_index(doctypes=None):
+    u'''Synchronizes the index with the database for the given document
+    types. If no document types are given, the index is synchronized for all
+    extension document types.
 
-    for indexer in refresh_indexers:
+    :param doctypes: ``list`` of ``str``, optional, the document types.
+    '''
+    for model in SYNCED_MODELS:
+        if doctypes and model.doctype not in doctypes:
+            continue
         try:
-            logger.debug('Refreshing index using indexer: %s', indexer)
-            indexer.refresh_index(query)
+            logger.debug('Syncing index for: %s', model.doctype)
+            model.sync_index()
         except Exception as e:
-            logger.warning('Failed to refresh index for query: %s. '
-                           'Error: %s', query, str(e))
+            logger.warning('Failed to sync index for %s. Error: %s',
+                           model.doctype, str(e))
             logger.exception(e)
 
 
-class _DatasetRelatedDashboardsRefresh(IndexedModelsRefreshIndex):
+def schedule_sync_index(doctypes=None):
+    jobs.enqueue(sync_index, [doctypes])
 
-    def __init__(self):
-        super(_DatasetRelatedDashboardsRefresh, self).__init__(Dashboard)
 
-    def find_documents(self, query):
-        doc_ids = []
-        for doc in self.model.search_index(**query):
-            if doc.get('id'):
-                doc_ids.append(doc['id'])
-        self.logger.debug('Lookup for query "%s" found %d documents',
-                          query,
-                          len(doc_ids))
-        return doc_ids
-
-
-def update_dashboard_index(datasets):
-    if not datasets:
-        logger.debug('No datasets ids to refresh dashboards for.')
-        return
-    index_refresh = _DatasetRelatedDashboardsRefresh()
-    query = {
-        'q': 'text:*',
-        'fq': [
-            ' OR '.join(['idx_datasets:"%s"' % _id for _id in datasets])
-        ]
-    }
-    index_refresh.refresh_index(query)
-
-
-def schedule_update_index(query):
-    jobs.enqueue(update_index, [query])
+def flush_index_queue():
+    u'''Flushes the write-behind index update queue.
+
+    Waits for the coalescing window to close, then takes all pending updates
+    from the queue and indexes the entities in bulk, per document type.
+    '''
+    index_update_queue.wait()
+    updates = index_update_queue.pop()
+    models = dict([(model.doctype, model) for model in SYNCED_MODELS])
+    for doctype, ids in updates.items():
+        model = models.get(doctype)
+        if not model:
+            logger.warning('Unknown document type in the index queue: %s',
+                           doctype)
+            continue
+        try:
+            logger.debug('Flushing %d queued index updates for: %s',
+                         len(ids), doctype)
+            model.index_by_ids(ids)
+        except Exception as e:
+            logger.warning('Failed to flush index updates for %s. '
+                           'Error: %s', doctype, str(e))
+            logger.exception(e)
+
+
+def schedule_flush_index_queue():
+    jobs.enqueue(flush_index_queue)
 
 
 def schedule_notification_email(recipient, template, data):
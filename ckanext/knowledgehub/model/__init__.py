@@ -45,6 +45,7 @@ from ckanext.knowledgehub.model.likes import (
     LikesRef,
 )
 from ckanext.knowledgehub.model.request_audit import RequestAudit
+from ckanext.knowledgehub.model.index_dependency import IndexDependency
 
 __all__ = [
     'AccessRequest',
@@ -56,6 +57,7 @@ __all__ = [
     'ResearchQuestion',
     'Dashboard',
     'DataQualityMetrics',
+    'IndexDependency',
     'Keyword',
     'KWHData',
     'LikesCount',
@@ -40,10 +40,14 @@ from ckan.common import _
 from ckanext.knowledgehub.lib.solr import (
     Indexed,
     mapped,
+    mapped_date,
     unprefixed,
+    match_group_set_counts,
 )
 from ckanext.knowledgehub.logic.auth import get_permission_labels
 from ckanext.knowledgehub.lib.util import get_as_list
+from ckanext.knowledgehub.lib.loader import get_entity_loader, split_refs
+from ckanext.knowledgehub.lib.cache import tag_keyword_map
 from logging import getLogger
 
 
@@ -122,13 +126,11 @@ class Dashboard(DomainObject, Indexed):
         'source',
         'indicators',
         'research_questions',
-        'datasets',
-        'keywords',
         mapped('tags', 'tags'),
         mapped('groups', 'groups'),
         mapped('organizations', 'organizations'),
-        mapped('created_at', 'khe_created'),
-        mapped('modified_at', 'khe_modified'),
+        mapped_date('created_at', 'khe_created'),
+        mapped_date('modified_at', 'khe_modified'),
         unprefixed('idx_keywords'),
         unprefixed('idx_tags'),
         unprefixed('idx_research_questions'),
@@ -139,25 +141,26 @@ class Dashboard(DomainObject, Indexed):
         unprefixed('permission_labels'),
         unprefixed('idx_groups'),
         unprefixed('idx_organizations'),
+        unprefixed('idx_match_groups'),
+        unprefixed('match_groups_count'),
     ]
     doctype = 'dashboard'
+    watermark_columns = ['created_at', 'modified_at']
+    projections = {
+        # the fields shown in the search results
+        'card': ['id', 'name', 'title', 'description', 'type',
+                 'organizations'],
+    }
 
     @classmethod
-    def before_index(cls, data):
+    def _get_indicator_refs(cls, data):
+        '''Returns the ids of the research questions and the resource views
+        referenced by the indicators of the dashboard.
+        '''
         indicators = []
         if data.get('indicators'):
             indicators = json.loads(data['indicators'])
 
-        datasets = {}
-        organizations = {}
-        pdorganizations = {}
-        groups = {}
-        pdgroups = {}
-        research_questions = {}
-        visualizations = {}
-        tags = {}
-        keywords = {}
-
         research_question_ids = set()
         resource_view_ids = set()
         if data.get('type') == 'internal':
@@ -178,83 +181,97 @@ class Dashboard(DomainObject, Indexed):
                             'or list, however %s was received. Indicators: %s',
                             str(type(indicators)),
                             str(indicators))
+        return research_question_ids, resource_view_ids
+
+    @classmethod
+    def prefetch_related(cls, loader, items):
+        '''Queues the entities referenced by a chunk of dashboards to be
+        loaded in bulk.
+        '''
+        package_ids = set()
+        resource_view_ids = set()
+        for data in items:
+            try:
+                rq_ids, rv_ids = cls._get_indicator_refs(data)
+            except Exception as e:
+                log.debug('Failed to parse the indicators of dashboard %s. '
+                          'Error: %s', data.get('id'), str(e))
+                rq_ids, rv_ids = [], []
+            loader.prime('research_question', rq_ids)
+            if data.get('shared_with_users'):
+                loader.prime('user', split_refs(
+                    cls._get_safe_shared_with(data['shared_with_users'])))
+            package_ids.update(split_refs(data.get('datasets')))
+            resource_view_ids.update(rv_ids)
+
+        # the second level of references
+        for rv in loader.load_many('resource_view', resource_view_ids):
+            if rv:
+                package_ids.add(rv['package_id'])
+        cls._prime_package_refs(loader,
+                                loader.load_many('package', package_ids))
+
+    @classmethod
+    def _prime_package_refs(cls, loader, packages):
+        '''Queues the groups and users the packages are shared with.'''
+        for pkg in packages:
+            if not pkg:
+                continue
+            loader.prime('group',
+                         get_as_list('shared_with_organizations', pkg) +
+                         get_as_list('shared_with_groups', pkg))
+            if pkg.get('shared_with_users'):
+                loader.prime('user', split_refs(
+                    cls._get_safe_shared_with(pkg['shared_with_users'])))
+
+    @classmethod
+    def before_index(cls, data):
+        loader = get_entity_loader()
+
+        datasets = {}
+        organizations = {}
+        pdorganizations = {}
+        groups = {}
+        pdgroups = {}
+        research_questions = {}
+        visualizations = {}
+        tags = {}
+        keywords = {}
+
+        research_question_ids, resource_view_ids = \
+            cls._get_indicator_refs(data)
 
         # Load packages (when external dashboard)
-        if data.get('datasets'):
-            for dataset_id in map(lambda _id: _id.strip(),
-                                  filter(lambda _id: _id and _id.strip(),
-                                         data.get('datasets', '').split(','))):
-                pkg = cls._get_package(dataset_id)
-                if pkg:
-                    datasets[pkg['id']] = pkg
+        for pkg in loader.load_many('package',
+                                    split_refs(data.get('datasets'))):
+            if pkg:
+                datasets[pkg['id']] = pkg
 
         # Load the research questions related to this dashboard.
-        for research_question_id in research_question_ids:
-            try:
-                rq = get_action('research_question_show')({
-                    'ignore_auth': True,
-                }, {
-                    'id': research_question_id,
-                })
+        for rq in loader.load_many('research_question',
+                                   research_question_ids):
+            if rq:
                 research_questions[rq['id']] = rq
-            except Exception as e:
-                log.warning('Failed to research question %s. Error: %s',
-                            research_question_id,
-                            str(e))
-                log.exception(e)
 
         # Load resource views (visualizations). Also loads the packages.
-        for resource_view_id in resource_view_ids:
-            try:
-                rv = get_action('resource_view_show')({
-                    'ignore_auth': True,
-                }, {
-                    'id': resource_view_id,
-                })
-                visualizations[rv['id']] = rv
-                if rv['package_id'] not in datasets:
-                    pkg = cls._get_package(rv['package_id'])
-                    if pkg:
-                        datasets[pkg['id']] = pkg
-            except Exception as e:
-                log.warning('Failed to fetch resource view %s. Error: %s',
-                            resource_view_id,
-                            str(e))
-                log.exception(e)
+        resource_views = filter(None, loader.load_many('resource_view',
+                                                       resource_view_ids))
+        for rv in resource_views:
+            visualizations[rv['id']] = rv
+        for pkg in loader.load_many('package', [rv['package_id']
+                                                for rv in resource_views]):
+            if pkg and pkg['id'] not in datasets:
+                datasets[pkg['id']] = pkg
 
         # Load tags and keywords
-        if data.get('tags'):
-            for tag_id in map(lambda t: t.strip(),
-                              filter(lambda t: t and t.strip(),
-                                     data.get('tags', '').split(','))):
-                try:
-                    tag = get_action('tag_show')({
-                        'ignore_auth': True,
-                    }, {
-                        'id': tag_id,
-                    })
-                    tags[tag['id']] = tag
-
-                    keyword_id = tag.get('keyword_id')
-                    if keyword_id and keyword_id not in keywords:
-                        try:
-                            keyword = get_action('keyword_show')({
-                                'ignore_auth': True,
-                            }, {
-                                'id': keyword_id,
-                            })
-                            keywords[keyword['id']] = keyword
-                        except Exception as e:
-                            log.warning('Failed to fetch keyword %s. '
-                                        'Error: %s',
-                                        keyword_id,
-                                        str(e))
-                            log.exception(e)
-                except Exception as e:
-                    log.warning('Failed to fetch tag %s. Error: %s',
-                                tag_id,
-                                str(e))
-                    log.exception(e)
+        for tag_id in split_refs(data.get('tags')):
+            tag = tag_keyword_map.get_tag(tag_id)
+            if tag:
+                tags[tag['id']] = tag
+        for keyword in tag_keyword_map.get_tag_keywords(tags.keys()):
+            keywords[keyword['id']] = keyword
+
+        cls._prime_package_refs(loader, datasets.values())
 
         # set groups and organizations
         for _, pkg in datasets.items():
@@ -280,7 +297,7 @@ class Dashboard(DomainObject, Indexed):
                                        (exp_shared_groups, False)]:
                 for group_id in exp_groups:
                     if group_id not in all_groups:
-                        group = cls._get_group(group_id, is_org)
+                        group = cls._get_group(loader, group_id, is_org)
                         if group:
                             if is_org:
                                 organizations[group['id']] = group
@@ -295,18 +312,15 @@ class Dashboard(DomainObject, Indexed):
                         else:
                             pdgroups[pkg['id']][group['id']] = group
 
-        # Set data
-        data['datasets'] = ','.join(datasets.keys())
+        # Set data. The organizations, groups and tags are indexed as
+        # multivalued fields, so they can be faceted on.
         data['idx_datasets'] = list(datasets.keys())
         data['research_questions'] = ','.join(map(lambda (_, rq): rq['title'],
                                                   research_questions.items()))
-        data['organizations'] = ','.join(map(lambda (_, o): o['name'],
-                                             organizations.items()))
-        data['groups'] = ','.join(map(lambda (_, g): g['name'],
-                                      groups.items()))
-        data['tags'] = ','.join(map(lambda (_, t): t['name'], tags.items()))
-        data['keywords'] = ','.join(map(lambda (_, k): k['name'],
-                                        keywords.items()))
+        data['organizations'] = list(map(lambda (_, o): o['name'],
+                                         organizations.items()))
+        data['groups'] = list(map(lambda (_, g): g['name'], groups.items()))
+        data['tags'] = list(map(lambda (_, t): t['name'], tags.items()))
 
         # Set idx_ (id index) for usage in user interests
         data['idx_research_questions'] = list(research_questions.keys())
@@ -319,6 +333,7 @@ class Dashboard(DomainObject, Indexed):
             datasets,
             pdorganizations,
             pdgroups,
+            loader=loader,
         )
         if permission_labels:
             data['permission_labels'] = permission_labels
@@ -328,12 +343,44 @@ class Dashboard(DomainObject, Indexed):
 
         return data
 
+    @classmethod
+    def index_dependencies(cls, data):
+        '''Returns the related entities the indexed dashboard was enriched
+        from.
+        '''
+        return {
+            'dataset': data.get('idx_datasets'),
+            'group': ((data.get('idx_groups') or []) +
+                      (data.get('idx_organizations') or [])),
+            'research_question': data.get('idx_research_questions'),
+            'tag': data.get('idx_tags'),
+            'keyword': data.get('idx_keywords'),
+        }
+
+    @staticmethod
+    def _get_match_group_sets(group_sets):
+        '''Reduces the group sets required for the implicit access to the
+        smallest equivalent list of sets: the duplicates are removed, and so
+        are the supersets of another set - belonging to the smaller set
+        implies belonging to the superset.
+        '''
+        unique = set([frozenset(group_set) for group_set in group_sets
+                      if group_set])
+        match_group_sets = []
+        for group_set in sorted(unique, key=lambda s: (len(s), sorted(s))):
+            if any([other <= group_set for other in match_group_sets]):
+                continue
+            match_group_sets.append(group_set)
+        return [sorted(group_set) for group_set in match_group_sets]
+
     @classmethod
     def _generate_dashboard_permission_labels(cls,
                                               data,
                                               datasets,
                                               organizations,
-                                              groups):
+                                              groups,
+                                              loader=None):
+        loader = loader or get_entity_loader()
         permission_labels = []
         users = {}
         user_ids = set()
@@ -343,10 +390,7 @@ class Dashboard(DomainObject, Indexed):
 
         if data.get('shared_with_users'):
             shared_with = cls._get_safe_shared_with(data['shared_with_users'])
-            for user_id in map(lambda _id: _id.strip(),
-                               filter(lambda _id: _id and _id.strip(),
-                                      shared_with.split(','))):
-                user = cls._get_user(user_id)
+            for user in loader.load_many('user', split_refs(shared_with)):
                 if user:
                     users[user['id']] = user
         data['shared_with_users'] = ','.join(users.keys())
@@ -356,9 +400,9 @@ class Dashboard(DomainObject, Indexed):
         # organization or group)
         permission_labels += get_permission_labels(data)
 
-        # We generate a permission label that defines the access (implicit)
-        # to this dashboard. One dashboard can be accessed by a user that
-        # can also access ALL datasets that provide data to this dashboard.
+        # We index the group sets that define the access (implicit) to this
+        # dashboard. One dashboard can be accessed by a user that can also
+        # access ALL datasets that provide data to this dashboard.
         # This is implicit access.
         # One dashboard can use data from multiple datasets, each of those
         # can be accessed by the users in multiple organizations or groups.
@@ -367,22 +411,28 @@ class Dashboard(DomainObject, Indexed):
         # D1(orgA, orgB, groupC) and D2(orgD, groupE)
         # So a user can view this dashboard if he belongs to any of the: orgA,
         # orgB or groupC AND at the same time belongs to orgD or groupE.
-        # To encode this, we generate a permission label like so:
-        # member-groups-orgA|orgB|groupC+orgD|groupE
-        # once the prefix 'member-groups-' is removed, we are left with the
-        # sets of groups separated with '+'. The user must belong to all of
-        # these sets. To belong to a set it means to be part of ANY of the
-        # group or organization in that set. The group/org ids are separeted
-        # with '|' in the set.
+        # To encode this, every group in a set is indexed together with the
+        # index of the set:
+        # idx_match_groups = 0:orgA, 0:orgB, 0:groupC, 1:orgD, 1:groupE
+        # match_groups_count = 2
+        # and the searches count the sets the user belongs to (see
+        # get_fq_dashboard_permission_labels).
         any_groups = []
         for pkgid, _ in datasets.items():
             pgroups = groups.get(pkgid, {}).keys()
             porgs = organizations.get(pkgid, {}).keys()
             if pgroups + porgs:
                 any_groups.append(pgroups + porgs)
-        if any_groups:
-            combined_label = '+'.join(['|'.join(_ids) for _ids in any_groups])
-            permission_labels.append('match-groups-{}'.format(combined_label))
+        match_group_sets = cls._get_match_group_sets(any_groups)
+        # The searches evaluate as many group sets as the indexed dashboards
+        # require.
+        match_group_set_counts.record(len(match_group_sets))
+        data['idx_match_groups'] = [
+            '%d:%s' % (set_index, group_id)
+            for set_index, group_set in enumerate(match_group_sets)
+            for group_id in group_set
+        ]
+        data['match_groups_count'] = len(match_group_sets)
 
         # Check each dataset, if explicitly shared with users.
         # If there are users that have access to all datasets, then we must
@@ -394,11 +444,8 @@ class Dashboard(DomainObject, Indexed):
             if dataset.get('shared_with_users'):
                 shared_with = cls._get_safe_shared_with(
                     dataset['shared_with_users'])
-                for user_id in map(lambda u: u.strip(),
-                                   filter(lambda u: u and u.strip(),
-                                          shared_with.split(','))):
-                    # We might get the ID or the name of the user
-                    user = cls._get_user(user_id)
+                # We might get the ID or the name of the user
+                for user in loader.load_many('user', split_refs(shared_with)):
                     if user:
                         user_with_access.add(user['id'])
 
@@ -437,48 +484,13 @@ class Dashboard(DomainObject, Indexed):
         return value
 
     @classmethod
-    def _get_user(cls, user_id):
-        try:
-            return get_action('user_show')({
-                'ignore_auth': True,
-            }, {
-                'id': user_id,
-            })
-        except Exception as e:
-            log.warning('Failed to fetch user %s. Error: %s', user_id, str(e))
-            log.exception(e)
-        return None
-
-    @classmethod
-    def _get_package(cls, pkg_id):
-        try:
-            pkg = get_action('package_show')({
-                'ignore_auth': True,
-            }, {
-                'id': pkg_id,
-            })
-            return pkg
-        except Exception as e:
-            log.warning('Failed to get package %s. Error: %s',
-                        dataset_id,
-                        str(e))
-            log.exception(e)
-        return None
-
-    @classmethod
-    def _get_group(cls, group_id, is_org):
-        action = 'organization_show' if is_org else 'group_show'
-        try:
-            return get_action(action)({
-                'ignore_auth': True,
-            }, {
-                'id': group_id
-            })
-        except Exception as e:
-            log.warning('Failed to execute %s for id %s. Error: %s',
-                        action, group_id, str(e))
-            log.exception(e)
-        return None
+    def _get_group(cls, loader, group_id, is_org):
+        group = loader.load('group', group_id)
+        if group and group['is_organization'] != is_org:
+            log.warning('Expected %s to be %s.', group_id,
+                        'an organization' if is_org else 'a group')
+            return None
+        return group
 
     @classmethod
     def get(cls, reference):
@@ -0,0 +1,165 @@
+"""
+Copyright (c) 2018 Keitaro AB
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from sqlalchemy import (
+    types,
+    Column,
+    Index,
+    Table,
+    and_,
+    or_,
+    select,
+)
+from sqlalchemy.dialects.postgresql import insert
+from ckan.model.meta import (
+    metadata,
+    mapper,
+    engine,
+)
+from ckan.model.domain_object import DomainObject
+from logging import getLogger
+
+
+log = getLogger(__name__)
+
+__all__ = ['IndexDependency', 'index_dependency_table']
+
+
+index_dependency_table = Table(
+    'index_dependency',
+    metadata,
+    # the indexed document (the dependent)
+    Column('doctype', types.UnicodeText, primary_key=True),
+    Column('entity_id', types.UnicodeText, primary_key=True),
+    # the related entity the document was enriched from (the dependency)
+    Column('ref_type', types.UnicodeText, primary_key=True),
+    Column('ref', types.UnicodeText, primary_key=True),
+    Index('idx_index_dependency_ref', 'ref_type', 'ref'),
+)
+
+
+class IndexDependency(DomainObject):
+    '''Records the related entities (datasets, research questions, tags,
+    keywords, groups etc) that an indexed document was enriched from when it
+    was indexed, so the documents that depend on an entity can be found (and
+    reindexed) when that entity changes.
+
+    The related entities are recorded by the references (ids or names) used
+    in the indexed documents.
+
+    The dependencies are read and written on separate connections, so a
+    failure (e.g. a missing table) does not abort the transaction of the
+    request.
+    '''
+
+    @classmethod
+    def set_dependencies(cls, doctype, dependencies):
+        '''Replaces the recorded dependencies of the given documents.
+
+        The same document may be reindexed concurrently (e.g. by a rebuild
+        and the index queue), so the rows recorded in the meantime by the
+        other reindex are kept rather than failing on the primary key. At
+        worst, a few stale dependencies are kept until the next reindex,
+        which only causes an extra reindex.
+
+        :param doctype: `str`, the type of the documents.
+        :param dependencies: `dict`, the id of every document mapped to its
+            dependencies - a `dict` of the related entity type mapped to a
+            `list` of references.
+        '''
+        if not dependencies:
+            return
+        rows = []
+        for entity_id, refs in dependencies.items():
+            for ref_type, values in (refs or {}).items():
+                for ref in set(filter(None, values or [])):
+                    rows.append({
+                        'doctype': doctype,
+                        'entity_id': entity_id,
+                        'ref_type': ref_type,
+                        'ref': ref,
+                    })
+        table = index_dependency_table
+        with engine.begin() as conn:
+            conn.execute(table.delete().where(and_(
+                table.c.doctype == doctype,
+                table.c.entity_id.in_(list(dependencies.keys())))))
+            if rows:
+                conn.execute(insert(table).on_conflict_do_nothing(), rows)
+
+    @classmethod
+    def remove_dependencies(cls, doctype, entity_ids):
+        '''Removes the recorded dependencies of the given documents.
+
+        :param doctype: `str`, the type of the documents.
+        :param entity_ids: `list` of `str`, the ids of the documents.
+        '''
+        if not entity_ids:
+            return
+        table = index_dependency_table
+        with engine.begin() as conn:
+            conn.execute(table.delete().where(and_(
+                table.c.doctype == doctype,
+                table.c.entity_id.in_(list(entity_ids)))))
+
+    @classmethod
+    def has_dependencies(cls):
+        '''Checks whether any dependencies are recorded. There are none until
+        the documents are indexed, e.g. right after an upgrade.
+
+        :returns: `bool`, ``True`` if there is at least one dependency.
+        '''
+        table = index_dependency_table
+        with engine.connect() as conn:
+            return conn.execute(
+                select([table.c.ref]).limit(1)).first() is not None
+
+    @classmethod
+    def get_dependents(cls, refs):
+        '''Returns the documents that depend on any of the given entities.
+
+        :param refs: `dict`, the related entity type mapped to a `list` of
+            references (ids or names) to the entities.
+
+        :returns: `dict`, the document type mapped to a sorted `list` of the
+            distinct ids of the dependent documents.
+        '''
+        table = index_dependency_table
+        criteria = []
+        for ref_type, values in sorted(refs.items()):
+            values = sorted(set(filter(None, values or [])))
+            if values:
+                criteria.append(and_(table.c.ref_type == ref_type,
+                                     table.c.ref.in_(values)))
+        if not criteria:
+            return {}
+        query = select([table.c.doctype, table.c.entity_id]).where(
+            or_(*criteria)).distinct()
+        dependents = {}
+        with engine.connect() as conn:
+            for doctype, entity_id in conn.execute(query):
+                dependents.setdefault(doctype, []).append(entity_id)
+        for ids in dependents.values():
+            ids.sort()
+        return dependents
+
+
+mapper(IndexDependency, index_dependency_table)
+
+
+def setup():
+    metadata.create_all(engine)
@@ -23,8 +23,11 @@ from ckan.model.domain_object import DomainObject
 from ckanext.knowledgehub.lib.solr import (
     Indexed,
     mapped,
+    mapped_date,
     unprefixed,
 )
+from ckanext.knowledgehub.lib.loader import get_entity_loader
+from ckanext.knowledgehub.lib.cache import tag_keyword_map
 
 from sqlalchemy import types, ForeignKey, Column, Table, or_, update
 from sqlalchemy.sql.expression import func
@@ -66,7 +69,7 @@ class Posts(DomainObject, Indexed):
         mapped('id', 'entity_id'),
         'title',
         'description',
-        'created_at',
+        mapped_date('created_at', 'khe_created'),
         'created_by',
         'entity_type',
         'entity_ref',
@@ -76,15 +79,36 @@ class Posts(DomainObject, Indexed):
         unprefixed('idx_tags'),
         unprefixed('idx_research_questions'),
     ]
+    watermark_columns = ['created_at']
 
     @classmethod
     def get(cls, ref):
         return Session.query(cls).get(ref)
 
+    # the type of the entity (loaded by the entity loader) referenced by the
+    # posts of each entity type
+    related_entity_types = {
+        'dataset': 'package',
+        'dashboard': 'dashboard',
+        'research_question': 'research_question',
+        'visualization': 'resource_view',
+    }
+
+    @classmethod
+    def prefetch_related(cls, loader, items):
+        '''Queues the entities referenced by a chunk of posts to be loaded in
+        bulk.
+        '''
+        for data in items:
+            entity_type = cls.related_entity_types.get(data.get('entity_type'))
+            if entity_type and data.get('entity_ref'):
+                loader.prime(entity_type, [data['entity_ref']])
+
     @classmethod
     def before_index(cls, data):
         if 'entity_type' not in data:
             return data
+        loader = get_entity_loader()
         related_data_ids = {
             'idx_tags': [],
             'idx_keywords': [],
@@ -109,6 +133,7 @@ class Posts(DomainObject, Indexed):
             related_data_loaders[data['entity_type']](
                 data['entity_ref'],
                 related_data_ids,
+                loader,
             )
         except Exception as e:
             log.error('Failed to load related data '
@@ -120,6 +145,23 @@ class Posts(DomainObject, Indexed):
 
         return data
 
+    @classmethod
+    def index_dependencies(cls, data):
+        '''Returns the related entities the indexed post was enriched from -
+        the entity the post is about, and its research questions, tags and
+        keywords.
+        '''
+        dependencies = {
+            'research_question': data.get('idx_research_questions'),
+            'tag': data.get('idx_tags'),
+            'keyword': data.get('idx_keywords'),
+        }
+        if data.get('entity_type') and data.get('entity_ref'):
+            refs = list(dependencies.get(data['entity_type']) or [])
+            refs.append(data['entity_ref'])
+            dependencies[data['entity_type']] = refs
+        return dependencies
+
     @classmethod
     def _call_action(cls, action, data):
         try:
@@ -148,34 +190,30 @@ class Posts(DomainObject, Indexed):
 
     @classmethod
     def _load_tags_and_keywords(cls, tag_ids, related_data_ids):
-        for tag in tag_ids:
-            tag = cls._call_action('tag_show', {'id': tag})
+        for tag_id in tag_ids:
+            tag = tag_keyword_map.get_tag(tag_id)
             if not tag:
                 continue
             if tag['id'] not in related_data_ids['idx_tags']:
                 related_data_ids['idx_tags'].append(tag['id'])
-            if tag.get('keyword_id') and \
-                    tag['keyword_id'] not in related_data_ids:
+            if tag['keyword_id'] and \
+                    tag['keyword_id'] not in related_data_ids['idx_keywords']:
                 related_data_ids['idx_keywords'].append(tag['keyword_id'])
 
     @classmethod
-    def load_related_data_dataset(cls, _id, related_data_ids):
-        dataset = cls._call_action('package_show', {'id': _id})
+    def load_related_data_dataset(cls, _id, related_data_ids, loader):
+        dataset = loader.load('package', _id)
         if not dataset:
             return
-        for tag in dataset.get('tags', []):
-            if tag['id'] not in related_data_ids['idx_tags']:
-                related_data_ids['idx_tags'].append(tag['id'])
-            tag = cls._call_action('tag_show', {'id': tag['id']})
-            if tag and tag.get('keyword_id') and \
-                    tag['keyword_id'] not in related_data_ids['idx_keywords']:
-                related_data_ids['idx_keywords'].append(tag['keyword_id'])
+        cls._load_tags_and_keywords([tag['id'] for tag in dataset['tags']],
+                                    related_data_ids)
 
     @classmethod
-    def load_related_data_research_question(cls, _id, related_data_ids):
+    def load_related_data_research_question(cls, _id, related_data_ids,
+                                            loader):
         if _id not in related_data_ids['idx_research_questions']:
             related_data_ids['idx_research_questions'].append(_id)
-        rq = cls._call_action('research_question_show', {'id': _id})
+        rq = loader.load('research_question', _id)
         if not rq:
             return
 
@@ -183,27 +221,34 @@ class Posts(DomainObject, Indexed):
         cls._load_tags_and_keywords(tags, related_data_ids)
 
     @classmethod
-    def load_related_data_visualization(cls, _id, related_data_ids):
-        resource_view = cls._call_action('resource_view_show', {'id': _id})
+    def load_related_data_visualization(cls, _id, related_data_ids, loader):
+        resource_view = loader.load('resource_view', _id)
         if not resource_view:
             return
         extras = resource_view.get('__extras', {})
 
-        for rq_title in extras.get('research_questions', []):
-            rq = cls._call_action('search_research_questions', {
-                'text': rq_title,
-            })
-            if rq and rq.get('count', 0) > 0:
+        rq_titles = extras.get('research_questions', [])
+        for rq_title, rq in zip(rq_titles,
+                                loader.load_many('research_question',
+                                                 rq_titles)):
+            if not rq:
+                # no exact match, fall back to searching
+                rq = cls._call_action('search_research_questions', {
+                    'text': rq_title,
+                })
+                if not rq or rq.get('count', 0) == 0:
+                    continue
                 rq = rq['results'][0]
-                cls.load_related_data_research_question(rq['id'],
-                                                        related_data_ids)
+            cls.load_related_data_research_question(rq['id'],
+                                                    related_data_ids,
+                                                    loader)
 
         tags = cls._try_clean_list(extras, 'tags')
         cls._load_tags_and_keywords(tags, related_data_ids)
 
     @classmethod
-    def load_related_data_dashboard(cls, _id, related_data_ids):
-        dashboard = cls._call_action('dashboard_show', {'id': _id})
+    def load_related_data_dashboard(cls, _id, related_data_ids, loader):
+        dashboard = loader.load('dashboard', _id)
 
         if not dashboard:
             return
@@ -218,20 +263,21 @@ class Posts(DomainObject, Indexed):
                 if indicator.get('research_question'):
                     cls.load_related_data_research_question(
                         indicator['research_question'],
-                        related_data_ids
+                        related_data_ids,
+                        loader,
                     )
                 if indicator.get('resource_view_id'):
                     cls.load_related_data_visualization(
                         indicator['resource_view_id'],
                         related_data_ids,
+                        loader,
                     )
         datasets = cls._try_clean_list(dashboard, 'datasets')
         for dataset in datasets:
             dataset = dataset.strip()
             if not dataset:
                 continue
-            cls.load_related_data_dataset(dataset, related_data_ids)
-
+            cls.load_related_data_dataset(dataset, related_data_ids, loader)
 
 mapper(Posts, posts_table)
 
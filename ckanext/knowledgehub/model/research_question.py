@@ -18,10 +18,15 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import ckan.plugins.toolkit as toolkit
 from ckan.model.meta import metadata, mapper, Session, engine
 from ckan.model.types import make_uuid
-from ckan.logic import get_action
 from ckan.model.domain_object import DomainObject
 
-from ckanext.knowledgehub.lib.solr import Indexed, mapped, unprefixed
+from ckanext.knowledgehub.lib.solr import (
+    Indexed,
+    mapped,
+    mapped_date,
+    unprefixed,
+)
+from ckanext.knowledgehub.lib.cache import tag_keyword_map
 from ckanext.knowledgehub.model import Theme, SubThemes
 
 from sqlalchemy import types, ForeignKey, Column, Table, or_
@@ -87,16 +92,19 @@ class ResearchQuestion(DomainObject, Indexed):
         'sub_theme_name',
         'sub_theme_title',
         'image_url',
-        'tags',
-        'keywords',
         mapped('tags', 'tags'),
-        mapped('created_at', 'khe_created'),
-        mapped('modified_at', 'khe_modified'),
+        mapped_date('created_at', 'khe_created'),
+        mapped_date('modified_at', 'khe_modified'),
         unprefixed('idx_keywords'),
         unprefixed('idx_tags'),
         unprefixed('idx_research_questions'),
 
     ]
+    watermark_columns = ['created_at', 'modified_at']
+    projections = {
+        # the fields shown in the search results
+        'card': ['id', 'name', 'title', 'image_url'],
+    }
 
     @classmethod
     def get_by_id_name_or_title(cls, id_name_title):
@@ -193,32 +201,30 @@ class ResearchQuestion(DomainObject, Indexed):
         if data.get('tags'):
             data['tags'] = data.get('tags').split(',')
             data['idx_tags'] = data['tags']
-            for tag in data['tags']:
-                try:
-                    tag_obj = get_action('tag_show')(
-                        {'ignore_auth': True},
-                        {'id': tag}
-                    )
-                    if tag_obj.get('keyword_id'):
-                        keyword_obj = get_action('keyword_show')(
-                            {'ignore_auth': True},
-                            {'id': tag_obj.get('keyword_id')}
-                        )
-                        keywords.add(keyword_obj.get('name'))
-                        if keywords:
-                            data['keywords'] = ','.join(keywords)
-                except Exception as e:
-                    log.warning('Failed to fetch tag/keyword data. Error: %s',
-                                str(e))
+            try:
+                for keyword in tag_keyword_map.get_tag_keywords(data['tags']):
+                    keywords.add(keyword['name'])
+            except Exception as e:
+                log.warning('Failed to fetch tag/keyword data. Error: %s',
+                            str(e))
 
         if keywords:
-            data['keywords'] = ','.join(keywords)
             data['idx_keywords'] = list(keywords)
 
         data['idx_research_questions'] = [data['id']]
 
         return data
 
+    @staticmethod
+    def index_dependencies(data):
+        '''Returns the related entities the indexed research question was
+        enriched from.
+        '''
+        return {
+            'tag': data.get('idx_tags'),
+            'keyword': data.get('idx_keywords'),
+        }
+
     def __repr__(self):
         return '<ResearchQuestion %s>' % self.title
 
@@ -16,8 +16,7 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 from ckan.model import ResourceView, resource_view_table
-from ckan.model.meta import mapper
-from ckan.logic import get_action
+from ckan.model.meta import mapper, Session
 
 from sqlalchemy import Column, types
 
@@ -27,7 +26,8 @@ from ckanext.knowledgehub.lib.solr import (
     unprefixed,
     DontIndexException
 )
-from ckanext.knowledgehub.model.research_question import ResearchQuestion
+from ckanext.knowledgehub.lib.loader import get_entity_loader, split_refs
+from ckanext.knowledgehub.lib.cache import tag_keyword_map
 import json
 from logging import getLogger
 
@@ -45,7 +45,6 @@ class Visualization(ResourceView, Indexed):
         'view_type',
         'research_questions',
         'package_id',
-        'keywords',
         mapped('tags', 'tags'),
         mapped('organizations', 'organizations'),
         mapped('groups', 'groups'),
@@ -56,6 +55,46 @@ class Visualization(ResourceView, Indexed):
     ]
 
     doctype = 'visualization'
+    # Resource views do not keep track of when they were created or modified,
+    # so there are no watermark columns for visualizations.
+    index_filter = [resource_view_table.c.view_type.in_(['chart', 'map'])]
+
+    @staticmethod
+    def get_research_question_refs(resource_ids):
+        '''Returns the references (ids, names or titles) to the research
+        questions set in the views of the resources, loaded with a single
+        query. The data explorer (recline) views are skipped.
+
+        :param resource_ids: `list` of `str`, the ids of the resources.
+
+        :returns: `list` of `str`, the distinct references.
+        '''
+        if not resource_ids:
+            return []
+        query = Session.query(resource_view_table.c.config).filter(
+            resource_view_table.c.resource_id.in_(resource_ids),
+            resource_view_table.c.view_type != 'recline_view',
+        )
+        refs = []
+        for config, in query:
+            rqs = (config or {}).get('__extras', {}).get(
+                'research_questions', '')
+            if isinstance(rqs, str) or isinstance(rqs, unicode):
+                rqs = split_refs(rqs)
+            for rq in rqs or []:
+                if rq not in refs:
+                    refs.append(rq)
+        return refs
+
+    @staticmethod
+    def prefetch_related(loader, items):
+        '''Queues the entities referenced by a chunk of visualizations to be
+        loaded in bulk.
+        '''
+        resource_views = loader.load_many('resource_view',
+                                          [data['id'] for data in items])
+        loader.prime('package', [rv['package_id']
+                                 for rv in resource_views if rv])
 
     @staticmethod
     def before_index(data):
@@ -63,16 +102,16 @@ class Visualization(ResourceView, Indexed):
         if data.get('view_type') not in ['chart', 'map']:
             raise DontIndexException(data.get('id'))
 
+        loader = get_entity_loader()
         permission_labels = []
 
-        resource_view = get_action('resource_view_show')(
-            {'ignore_auth': True},
-            {'id': data['id']})
+        resource_view = loader.load('resource_view', data['id'])
+        if not resource_view:
+            # the resource of the view no longer exists
+            raise DontIndexException(data.get('id'))
 
         data['package_id'] = resource_view['package_id']
-        package = get_action('package_show')(
-            {'ignore_auth': True},
-            {'id': data['package_id'], 'include_tracking': True})
+        package = loader.load('package', data['package_id'])
         if package:
             data['organizations'] = (package.get('organization',
                                                  {}) or {}).get('name')
@@ -146,37 +185,20 @@ class Visualization(ResourceView, Indexed):
         
             data['idx_research_questions'] = []
 
-            for rq_title in clean_list:
-                try:
-                    rq_title = rq_title.strip(" ")
-                    rq = ResearchQuestion.get_by_id_name_or_title(rq_title)
-                    if rq:
-                        data['idx_research_questions'].append(rq.id)
-                except Exception as e:
-                    log.warning('Failed to fetch research question %s. '
-                                'Error: %s',
-                                rq_title,
-                                str(e))
-                    log.exception(e)
+            for rq in loader.load_many('research_question',
+                                       [rq_title.strip(" ")
+                                        for rq_title in clean_list]):
+                if rq:
+                    data['idx_research_questions'].append(rq['id'])
 
         keywords = set()
         if data.get('tags'):
             data['tags'] = data.get('tags').split(',')
             data['idx_tags'] = data['tags']
-            for tag in data['tags']:
-                tag_obj = get_action('tag_show')(
-                    {'ignore_auth': True},
-                    {'id': tag}
-                )
-                if tag_obj.get('keyword_id'):
-                    keyword_obj = get_action('keyword_show')(
-                        {'ignore_auth': True},
-                        {'id': tag_obj.get('keyword_id')}
-                    )
-                    keywords.add(keyword_obj.get('name'))
+            for keyword in tag_keyword_map.get_tag_keywords(data['tags']):
+                keywords.add(keyword['name'])
 
         if keywords:
-            data['keywords'] = ','.join(keywords)
             data['idx_keywords'] = list(keywords)
 
         if permission_labels:
@@ -184,6 +206,21 @@ class Visualization(ResourceView, Indexed):
 
         return data
 
+    @staticmethod
+    def index_dependencies(data):
+        '''Returns the related entities the indexed visualization was
+        enriched from.
+        '''
+        return {
+            'dataset': [data.get('package_id')],
+            'group': [label[len('member-'):]
+                      for label in data.get('permission_labels', [])
+                      if label.startswith('member-')],
+            'research_question': data.get('idx_research_questions'),
+            'tag': data.get('idx_tags'),
+            'keyword': data.get('idx_keywords'),
+        }
+
 
 mapper(Visualization, resource_view_table)
 
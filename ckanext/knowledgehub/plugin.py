@@ -17,6 +17,7 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from hdx.hdx_configuration import Configuration
 import json
+from functools import partial
 from logging import getLogger
 
 from routes.mapper import SubMapper
@@ -24,6 +25,7 @@ from routes.mapper import SubMapper
 import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
 from ckan import logic
+from ckan.model import Group, Session
 from ckan.lib.plugins import DefaultDatasetForm, DefaultPermissionLabels
 from ckan.common import config
 from ckan.lib.base import BaseController as CKANBaseController
@@ -52,8 +54,17 @@ from ckanext.knowledgehub.helpers import _register_blueprints
 from ckanext.knowledgehub.lib.search import patch_ckan_core_search
 from ckanext.knowledgehub.model.keyword import extend_tag_table
 from ckanext.knowledgehub.model.visualization import extend_resource_view_table
+from ckanext.knowledgehub.model.visualization import Visualization
+from ckanext.knowledgehub.model.index_dependency import IndexDependency
 from ckanext.knowledgehub.model.dashboard import dashboard_table_upgrade
-from ckanext.knowledgehub.lib.util import get_as_list
+from ckanext.knowledgehub.lib.util import get_as_list, after_commit
+from ckanext.knowledgehub.lib.cache import (
+    tag_keyword_map,
+    group_map,
+    permission_labels_cache,
+)
+from ckanext.knowledgehub.logic.auth import get_user_labels
+from ckanext.knowledgehub.lib.loader import get_entity_loader
 
 
 from ckanext.datastore.backend import (
@@ -110,6 +121,8 @@ class KnowledgehubPlugin(plugins.SingletonPlugin, DefaultDatasetForm,
     plugins.implements(plugins.IAuthenticator, inherit=True)
     plugins.implements(plugins.IPermissionLabels)
     plugins.implements(IDataPusher, inherit=True)
+    plugins.implements(plugins.IGroupController, inherit=True)
+    plugins.implements(plugins.IOrganizationController, inherit=True)
 
     # IConfigurer
     def update_config(self, config_):
@@ -541,19 +554,12 @@ class KnowledgehubPlugin(plugins.SingletonPlugin, DefaultDatasetForm,
                 pkg_dict['idx_tags'].append(tag.get('name'))
 
             extras_keywords = []
-            for keyword in keywords:
-                try:
-                    keyword = toolkit.get_action('keyword_show')({
-                        'ignore_auth': True,
-                    }, {
-                        'id': keyword,
-                    })
+            for keyword_id in keywords:
+                keyword = tag_keyword_map.get_keyword(keyword_id)
+                if keyword:
                     extras_keywords.append(keyword['name'])
-                except Exception as e:
-                    log.warning('Failed to get keyword %s. Error: %s',
-                                keyword,
-                                str(e))
-                    log.exception(e)
+                else:
+                    log.warning('Failed to get keyword %s.', keyword_id)
 
             pkg_dict['extras_keywords'] = ','.join(extras_keywords)
             pkg_dict['idx_keywords'] = keywords
@@ -564,46 +570,41 @@ class KnowledgehubPlugin(plugins.SingletonPlugin, DefaultDatasetForm,
 
         research_questions = set()
         if validated_data:
-            for resource in validated_data.get('resources', []):
-                try:
-                    resource_views = toolkit.get_action('resource_view_list')({
-                        'ignore_auth': True,
-                    }, {
-                        'id': resource['id']
-                    })
-                    for resource_view in resource_views:
-                        if resource_view.get('view_type') != 'recline_view':
-                            rqs = resource_view.get('__extras', {}).\
-                                get('research_questions', '')
-                            if isinstance(rqs, str) or \
-                                    isinstance(rqs, unicode):
-                                rqs = map(lambda r: r.strip(),
-                                          filter(lambda r: r and r.strip(),
-                                                 rqs.split(',')))
-                            if rqs:
-                                for rq in rqs:
-                                    try:
-                                        rq = toolkit.get_action(
-                                            'research_question_show')({
-                                                'ignore_auth': True,
-                                            }, {
-                                                'id': rq
-                                            })
-                                        research_questions.add(rq['id'])
-                                    except Exception as e:
-                                        log.debug('Failed to get research '
-                                                  'question %s. Error: %s',
-                                                  rq,
-                                                  str(e))
-                except Exception as e:
-                    log.debug('Failed to load research question. Error: %s',
-                              str(e))
-                    log.exception(e)
-
+            try:
+                # The research questions (referenced by id, name or title)
+                # in the views of all resources are resolved with two queries
+                # in total.
+                refs = Visualization.get_research_question_refs([
+                    resource['id']
+                    for resource in validated_data.get('resources', [])
+                    if resource.get('id')
+                ])
+                for rq in get_entity_loader().load_many('research_question',
+                                                        refs):
+                    if rq:
+                        research_questions.add(rq['id'])
+            except Exception as e:
+                log.debug('Failed to load research question. Error: %s',
+                          str(e))
+                log.exception(e)
+
+        pkg_dict['idx_research_questions'] = sorted(research_questions)
         research_questions = ','.join(research_questions)
         pkg_dict['research_question'] = research_questions
         pkg_dict['extras_research_question'] = research_questions
-        pkg_dict['idx_research_questions'] = research_questions
+
+        # Record the entities the dataset was enriched from, so the dataset
+        # is reindexed when any of them changes. The dataset is indexed
+        # before the change is committed, so they are recorded once (and
+        # only if) it is committed.
+        after_commit(Session(), partial(
+            IndexDependency.set_dependencies, 'package', {
+                pkg_dict['id']: {
+                    'tag': pkg_dict.get('idx_tags'),
+                    'keyword': pkg_dict.get('idx_keywords'),
+                    'research_question': pkg_dict['idx_research_questions'],
+                },
+            }))
 
         return pkg_dict
 
@@ -661,26 +662,34 @@ class KnowledgehubPlugin(plugins.SingletonPlugin, DefaultDatasetForm,
         return [u'creator-%s' % dataset_obj.creator_user_id]
 
     def get_user_dataset_labels(self, user_obj):
-        labels = [u'public']
-        if not user_obj:
-            return labels
-
-        labels.append(u'creator-%s' % user_obj.id)
-        labels.append(u'user-%s' % user_obj.name)
-        labels.append(u'user-%s' % user_obj.id)
-
-        orgs = logic.get_action(u'organization_list_for_user')(
-            {u'user': user_obj.id}, {u'permission': u'read'})
-        labels.extend(u'member-%s' % o[u'id'] for o in orgs)
-
-        groups = logic.get_action('group_list_for_user')({
-            'ignore_auth': True,
-        }, {
-            'user': user_obj.id,
-        })
-        labels.extend(u'member-%s' % g[u'id'] for g in groups)
-
-        return labels
+        return get_user_labels(user_obj or None)
+
+    # IGroupController, IOrganizationController
+    # The same hooks are called for the datasets (IPackageController), but
+    # only the changes of the groups and organizations (their state or
+    # members) change the permission labels of the users and the group
+    # titles.
+    def create(self, entity):
+        self._group_changed(entity)
+
+    def edit(self, entity):
+        self._group_changed(entity)
+
+    def delete(self, entity):
+        self._group_changed(entity)
+
+    def _group_changed(self, entity):
+        if isinstance(entity, Group):
+            from ckanext.knowledgehub.logic.jobs import schedule_update_index
+            # The hooks are called before the change is committed. The other
+            # processes would reload the old state, so the caches are
+            # invalidated once the change is committed.
+            session = Session()
+            after_commit(session, permission_labels_cache.bump_version)
+            after_commit(session, group_map.invalidate)
+            after_commit(session, partial(schedule_update_index,
+                                          {'group': [entity.id]},
+                                          defer_lookup=True))
 
     # IDataPusher
     def after_upload(self, context, resource_dict, dataset_dict):
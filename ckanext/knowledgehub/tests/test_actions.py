@@ -51,6 +51,7 @@ from ckanext.knowledgehub.logic.action import create as create_actions
 from ckanext.knowledgehub.logic.action import get as get_actions
 from ckanext.knowledgehub.logic.action import delete as delete_actions
 from ckanext.knowledgehub.logic.action import update as update_actions
+from ckanext.knowledgehub.logic.auth import get as get_auth
 from ckanext.knowledgehub import helpers as kwh_helpers
 from ckanext.knowledgehub.tests.helpers import (User,
                                                 create_dataset,
@@ -3052,6 +3053,95 @@ class TestSearchIndexActions(helpers.FunctionalTestBase):
         assert_equals(1, len(results.get('results')))
         Visualization.search_index.called_once_with(q='text:aaa', rows=500)
 
+    @monkey_patch(Dashboard, 'iter_search_index', mock.Mock())
+    def test_search_index_export(self):
+        Dashboard.iter_search_index.return_value = iter([
+            {'id': 'aaa', 'title': 'A'},
+            {'id': 'bbb', 'title': 'B'},
+        ])
+
+        lines = list(get_actions._search_index_export(get_context(), {
+            'type': 'dashboard',
+            'text': 'test',
+        }))
+
+        assert_equals(2, len(lines))
+        assert_equals({'id': 'aaa', 'title': 'A'}, json.loads(lines[0]))
+        Dashboard.iter_search_index.assert_called_once_with(q='text:"test"')
+
+    @raises(logic.ValidationError)
+    def test_search_index_export_invalid_type(self):
+        get_actions._search_index_export(get_context(), {
+            'type': 'package',
+        })
+
+    @monkey_patch(Dashboard, 'iter_search_index', mock.Mock())
+    def test_dash_search_tag(self):
+        Dashboard.iter_search_index.return_value = iter([{'id': 'aaa'}])
+
+        ids = get_actions.dash_search_tag(get_context(), {'tags': 'tag1'})
+
+        assert_equals(['aaa'], ids)
+        Dashboard.iter_search_index.assert_called_once_with(
+            q='*:*', fq='idx_tags:"tag1"')
+
+    @monkey_patch(Dashboard, 'iter_search_index', mock.Mock())
+    def test_dash_search_tag_permissions(self):
+        Dashboard.iter_search_index.return_value = iter([])
+        context = get_regular_user_context()
+        context['ignore_auth'] = False
+        user = context['auth_user_obj']
+
+        get_actions.dash_search_tag(context, {'tags': 'tag1'})
+
+        _, query = Dashboard.iter_search_index.call_args
+        fq = query['fq']
+        assert_equals('idx_tags:"tag1"', fq[0])
+        assert_equals(2, len(fq))
+        # only the dashboards visible to the user are returned
+        assert_true('creator-%s' % user.id in fq[1])
+        assert_true('public' in fq[1])
+
+    def test_search_index_export_not_an_action(self):
+        actions = kwh_helpers._get_functions(
+            'ckanext.knowledgehub.logic.action')
+        assert_true('search_index_export' not in actions)
+        assert_true('_search_index_export' not in actions)
+
+
+class TestDashboardShowAuth(helpers.FunctionalTestBase):
+
+    @monkey_patch(toolkit, 'get_action', mock.Mock())
+    @monkey_patch(get_auth.index_update_queue, 'is_enabled',
+                  mock.Mock(return_value=True))
+    @monkey_patch(get_auth, '_check_dashboard_access_in_db',
+                  mock.Mock(return_value=True))
+    def test_dashboard_show_not_indexed_yet(self):
+        toolkit.get_action.return_value = mock.Mock(
+            return_value={'count': 0})
+        context = get_regular_user_context()
+
+        result = get_auth.dashboard_show(context, {'id': 'dash-1'})
+
+        assert_equals({'success': True}, result)
+        get_auth._check_dashboard_access_in_db.assert_called_once_with(
+            context, {'id': 'dash-1'})
+
+    @monkey_patch(toolkit, 'get_action', mock.Mock())
+    @monkey_patch(get_auth.index_update_queue, 'is_enabled',
+                  mock.Mock(return_value=False))
+    @monkey_patch(get_auth, '_check_dashboard_access_in_db',
+                  mock.Mock(return_value=True))
+    def test_dashboard_show_not_indexed_no_queue(self):
+        toolkit.get_action.return_value = mock.Mock(
+            return_value={'count': 0})
+
+        result = get_auth.dashboard_show(get_regular_user_context(),
+                                         {'id': 'dash-1'})
+
+        assert_equals({'success': False}, result)
+        get_auth._check_dashboard_access_in_db.assert_not_called()
+
 
 class TestDataQualityActions(helpers.FunctionalTestBase):
 
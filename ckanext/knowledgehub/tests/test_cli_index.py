@@ -0,0 +1,100 @@
+"""
+Copyright (c) 2018 Keitaro AB
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from mock import Mock, call
+
+from ckanext.knowledgehub.lib.util import monkey_patch
+from ckanext.knowledgehub.cli import index as cli_index
+from ckanext.knowledgehub.model import Dashboard, Posts
+
+from nose.tools import (
+    assert_equals,
+    assert_true,
+)
+
+
+class _SequentialPool:
+    '''Runs the pool tasks in the calling process, in order.'''
+
+    tasks = []
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def imap_unordered(self, func, tasks):
+        for task in tasks:
+            _SequentialPool.tasks.append(task)
+            yield func(task)
+
+    def close(self):
+        pass
+
+    def join(self):
+        pass
+
+
+def _rebuild_task(task):
+    return task[0], {'indexed': 1, 'error': False, 'elapsed': 0}
+
+
+class TestRebuildIndexParallel:
+
+    @monkey_patch(cli_index, 'Pool', _SequentialPool)
+    @monkey_patch(cli_index, '_rebuild_task', _rebuild_task)
+    @monkey_patch(cli_index, 'ckan_model', Mock())
+    @monkey_patch(Dashboard, 'start_rebuild', Mock(return_value='gen-d'))
+    @monkey_patch(Dashboard, 'get_shard_bounds',
+                  Mock(return_value=[(None, 'b'), ('b', None)]))
+    @monkey_patch(Dashboard, 'finish_rebuild', Mock())
+    @monkey_patch(Posts, 'start_rebuild', Mock(return_value='gen-p'))
+    @monkey_patch(Posts, 'get_shard_bounds',
+                  Mock(return_value=[(None, None)]))
+    @monkey_patch(Posts, 'finish_rebuild', Mock())
+    def test_core_index_rebuilt_first(self):
+        _SequentialPool.tasks = []
+
+        summary = cli_index.rebuild_index_parallel(
+            ['dashboard', 'ckan', 'post'], 2)
+
+        assert_equals(_SequentialPool.tasks[0], ('ckan', None, None, None))
+        assert_equals(len(_SequentialPool.tasks), 4)
+        assert_true(all(task[1] is not None
+                        for task in _SequentialPool.tasks[1:]))
+        Dashboard.finish_rebuild.assert_called_once_with('gen-d')
+        Posts.finish_rebuild.assert_called_once_with('gen-p')
+        assert_equals(summary['dashboard']['indexed'], 2)
+
+
+class TestCkanCoreIndex:
+
+    @monkey_patch(cli_index, 'rebuild', Mock())
+    def test_rebuild_index_keeps_other_documents(self):
+        index = Mock()
+        index.iter_ids.return_value = iter(['pkg-1', 'pkg-deleted', 'pkg-2'])
+        core_index = cli_index.CkanCoreIndex(index)
+        core_index._get_package_ids = Mock(return_value={'pkg-1', 'pkg-2'})
+
+        core_index.rebuild_index()
+
+        # the site index is not cleared
+        cli_index.rebuild.assert_called_once_with(refresh=True,
+                                                  defer_commit=True)
+        index.remove_all.assert_not_called()
+        index.iter_ids.assert_called_once_with('package', 'id')
+        index.remove_ids.assert_called_once_with('package', 'id',
+                                                 ['pkg-deleted'])
+        assert_equals([call(), call()], index.commit.call_args_list)
@@ -18,6 +18,7 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """Tests for helpers.py."""
 
 import os
+import re
 import mock
 import nose.tools
 import json
@@ -1706,6 +1707,11 @@ class TestKWHHelpers(ActionsBase):
         res = kwh_helpers.get_searched_rqs("rq")
         assert_equals(len(res), 8)
 
+    def test_get_searched_dashboards(self):
+
+        res = kwh_helpers.get_searched_dashboards("dashboard")
+        assert_equals(len(res), 8)
+
     def test_get_searched_visuals(self):
 
         res = kwh_helpers.get_searched_visuals("vis")
@@ -1732,4 +1738,28 @@ class TestKWHHelpers(ActionsBase):
     def test_get_facets(self):
 
         res = kwh_helpers._get_facets()
-        assert_equals(res, [])
\ No newline at end of file
+        assert_equals(res, [])
+
+
+class TestSearchResultsProjections:
+
+    def _get_template_fields(self, template, variable):
+        path = os.path.join(os.path.dirname(kwh_helpers.__file__),
+                            'templates', template)
+        with open(path) as template_file:
+            content = template_file.read()
+        fields = set()
+        pattern = r"\b%s(?:\.get\(\s*'(\w+)'|\['(\w+)'\]|\.(\w+))" % \
+            variable
+        for match in re.finditer(pattern, content):
+            field = [group for group in match.groups() if group][0]
+            if field != 'get':
+                fields.add(field)
+        return fields
+
+    def test_dashboard_card_projection(self):
+        fields = self._get_template_fields('package/search.html',
+                                           'dashboard')
+
+        assert_true(fields)
+        assert_equals(fields - set(Dashboard.projections['card']), set())
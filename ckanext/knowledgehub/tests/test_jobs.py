@@ -15,24 +15,36 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
-from mock import Mock, MagicMock
+from mock import Mock
 
 from ckanext.knowledgehub.lib.util import monkey_patch
 from ckanext.knowledgehub.logic.jobs import (
     calculate_metrics,
     schedule_data_quality_check,
-    IndexedModelsRefreshIndex,
-    DatasetIndexRefresh,
+    _IndexedPackage,
+    reindex_documents,
+    find_referencing_documents,
     update_index,
-    update_dashboard_index,
     schedule_update_index,
+    sync_index,
+    schedule_sync_index,
+    flush_index_queue,
+    schedule_flush_index_queue,
     schedule_notification_email,
     schedule_broadcast_notification_email,
 )
 from ckanext.knowledgehub.lib.email import (
     send_notification_email
 )
+from ckanext.knowledgehub.model import (
+    Dashboard,
+    IndexDependency,
+    Posts,
+    ResearchQuestion,
+    Visualization,
+)
 from ckanext.knowledgehub.lib import quality
+from ckanext.knowledgehub.lib import solr
 import ckanext.knowledgehub.helpers as kwn_helpers
 import ckan.lib.jobs as jobs
 import ckan.lib.search as ckan_search
@@ -63,91 +75,156 @@ class TestMetrics:
 
 class TestModelIndexRefresh:
 
-    def test_find_documents(self):
-        model = MagicMock()
-        index = IndexedModelsRefreshIndex(model)
-
-        docs = [{'id': 'doc-1'}]
-
-        model.search_index.return_value = docs
-
-        result = index.find_documents('test-query')
-
-        assert_true(result is not None)
-        assert_equals(result, ['doc-1'])  # return just the ID's of the docs
-
-        model.search_index.assert_called_once_with(q='text:"test-query"')
-
-    def test_refresh_index_for(self):
-
-        class _DocModel:
-
-            @classmethod
-            def get(cls, ref):
-                pass
-
-            @classmethod
-            def update_index_doc(cls, doc):
-                pass
-
-        _DocModel.get = Mock()
-        _DocModel.update_index_doc = Mock()
-
-        dummy = _DocModel()
-        _DocModel.get.return_value = dummy
-        _DocModel.update_index_doc.return_value = dummy
-
-        index = IndexedModelsRefreshIndex(_DocModel)
-
-        result = index.refresh_index_for('doc-1')
+    @monkey_patch(ckan_search, 'rebuild', Mock())
+    @monkey_patch(ckan_search, 'commit', Mock())
+    def test_dataset_refresh_index(self):
+        _IndexedPackage.index_by_ids(['pkg-2', 'pkg-1', 'pkg-2'])
+
+        ckan_search.rebuild.assert_called_once_with(
+            package_ids=['pkg-1', 'pkg-2'], defer_commit=True)
+        ckan_search.commit.assert_called_once()
+
+    @monkey_patch(Dashboard, 'index_by_ids', Mock())
+    @monkey_patch(_IndexedPackage, 'index_by_ids', Mock())
+    @monkey_patch(ResearchQuestion, 'index_by_ids', Mock())
+    def test_reindex_documents(self):
+        reindex_documents({
+            'dashboard': ['dash-1'],
+            'package': ['pkg-1', 'pkg-2'],
+            'unknown': ['unk-1'],
+        })
 
-        assert_true(result is not None)
-        assert_equals(result, dummy)
+        Dashboard.index_by_ids.assert_called_once_with(['dash-1'])
+        _IndexedPackage.index_by_ids.assert_called_once_with(['pkg-1',
+                                                              'pkg-2'])
+        ResearchQuestion.index_by_ids.assert_not_called()
+
+    @monkey_patch(IndexDependency, 'has_dependencies',
+                  Mock(return_value=True))
+    @monkey_patch(IndexDependency, 'get_dependents', Mock())
+    @monkey_patch(Posts, 'index_by_ids', Mock())
+    def test_update_index(self):
+        IndexDependency.get_dependents.return_value = {'post': ['post-1']}
+        refs = {'research_question': ['rq-1']}
+
+        update_index(refs)
+
+        IndexDependency.get_dependents.assert_called_once_with(refs)
+        Posts.index_by_ids.assert_called_once_with(['post-1'])
+
+    @monkey_patch(IndexDependency, 'has_dependencies',
+                  Mock(return_value=False))
+    @monkey_patch(IndexDependency, 'get_dependents', Mock())
+    @monkey_patch(Dashboard, 'iter_search_index', Mock())
+    @monkey_patch(ResearchQuestion, 'iter_search_index', Mock())
+    @monkey_patch(Visualization, 'iter_search_index', Mock())
+    @monkey_patch(Posts, 'iter_search_index', Mock())
+    @monkey_patch(Dashboard, 'index_by_ids', Mock())
+    def test_update_index_no_dependencies(self):
+        Dashboard.iter_search_index.return_value = iter([{'id': 'dash-1'}])
+        ResearchQuestion.iter_search_index.return_value = iter([])
+        Visualization.iter_search_index.return_value = iter([])
+        Posts.iter_search_index.return_value = iter([])
+
+        update_index({'group': ['grp-1']})
+
+        IndexDependency.get_dependents.assert_not_called()
+        Dashboard.iter_search_index.assert_called_once_with(
+            q='*:*',
+            fq=['idx_groups:("grp-1") OR idx_organizations:("grp-1")'],
+            projection='ids')
+        Dashboard.index_by_ids.assert_called_once_with(['dash-1'])
+
+    def test_find_referencing_documents_unknown_type(self):
+        assert_equals({}, find_referencing_documents({'visualization': ['v']}))
+
+    @monkey_patch(Dashboard, 'sync_index', Mock())
+    @monkey_patch(ResearchQuestion, 'sync_index', Mock())
+    @monkey_patch(Visualization, 'sync_index', Mock())
+    @monkey_patch(Posts, 'sync_index', Mock())
+    def test_sync_index(self):
+        sync_index(['dashboard', 'post'])
+
+        Dashboard.sync_index.assert_called_once()
+        Posts.sync_index.assert_called_once()
+        ResearchQuestion.sync_index.assert_not_called()
+        Visualization.sync_index.assert_not_called()
+
+    @monkey_patch(solr.index_update_queue, 'wait', Mock())
+    @monkey_patch(solr.index_update_queue, 'pop', Mock())
+    @monkey_patch(Dashboard, 'index_by_ids', Mock())
+    @monkey_patch(Posts, 'index_by_ids', Mock())
+    def test_flush_index_queue(self):
+        solr.index_update_queue.pop.return_value = {
+            'dashboard': ['aaa', 'bbb'],
+            'post': ['ccc'],
+            'unknown': ['ddd'],
+        }
+
+        flush_index_queue()
+
+        solr.index_update_queue.wait.assert_called_once()
+        Dashboard.index_by_ids.assert_called_once_with(['aaa', 'bbb'])
+        Posts.index_by_ids.assert_called_once_with(['ccc'])
 
-        _DocModel.get.assert_called_once_with('doc-1')
-        _DocModel.update_index_doc.assert_called_once_with(dummy.__dict__)
 
-    def test_refresh_index(self):
-        model = MagicMock()
+class TestScheduleJobs:
 
-        index = IndexedModelsRefreshIndex(model)
-        index.find_documents = Mock()
-        index.refresh_index_for = Mock()
+    @monkey_patch(IndexDependency, 'has_dependencies',
+                  Mock(return_value=True))
+    @monkey_patch(IndexDependency, 'get_dependents', Mock())
+    @monkey_patch(jobs, 'enqueue', Mock())
+    def test_schedule_update_index(self):
+        IndexDependency.get_dependents.return_value = {
+            'dashboard': ['dash-1'],
+        }
 
-        index.find_documents.return_value = ['doc-1']
-        index.refresh_index_for.return_value = {'id': 'doc-1'}
+        schedule_update_index({'tag': ['tag-1']})
 
-        index.refresh_index('test-query')
+        IndexDependency.get_dependents.assert_called_once_with({
+            'tag': ['tag-1'],
+        })
+        jobs.enqueue.assert_called_once_with(reindex_documents,
+                                             [{'dashboard': ['dash-1']}])
 
-        index.find_documents.assert_called_once_with('test-query')
-        index.refresh_index_for.assert_called_once_with('doc-1')
+    @monkey_patch(IndexDependency, 'has_dependencies',
+                  Mock(return_value=True))
+    @monkey_patch(IndexDependency, 'get_dependents', Mock())
+    @monkey_patch(jobs, 'enqueue', Mock())
+    def test_schedule_update_index_no_dependents(self):
+        IndexDependency.get_dependents.return_value = {}
 
-    @monkey_patch(ckan_search, 'rebuild', Mock())
-    def test_dataset_refresh_index(self):
-        index = DatasetIndexRefresh()
-        index.find_documents = Mock()
-        index.find_documents.return_value = ['doc-1']
+        schedule_update_index({'tag': ['tag-1']})
 
-        index.refresh_index('test-query')
+        jobs.enqueue.assert_not_called()
 
-        index.find_documents.assert_called_once_with('test-query')
-        ckan_search.rebuild.assert_called_once_with(package_id='doc-1')
+    @monkey_patch(IndexDependency, 'has_dependencies',
+                  Mock(side_effect=Exception('no table')))
+    @monkey_patch(jobs, 'enqueue', Mock())
+    def test_schedule_update_index_lookup_failed(self):
+        schedule_update_index({'tag': ['tag-1']})
 
-    @monkey_patch(IndexedModelsRefreshIndex, 'refresh_index', Mock())
-    @monkey_patch(DatasetIndexRefresh, 'refresh_index', Mock())
-    def test_update_index_global(self):
-        update_index('test-query')
+        jobs.enqueue.assert_called_once_with(update_index,
+                                             [{'tag': ['tag-1']}])
 
-        assert_equals(IndexedModelsRefreshIndex.refresh_index.call_count, 3)
-        DatasetIndexRefresh.refresh_index.assert_called_once_with('test-query')
+    @monkey_patch(IndexDependency, 'has_dependencies', Mock())
+    @monkey_patch(jobs, 'enqueue', Mock())
+    def test_schedule_update_index_defer_lookup(self):
+        schedule_update_index({'group': ['grp-1']}, defer_lookup=True)
 
+        IndexDependency.has_dependencies.assert_not_called()
+        jobs.enqueue.assert_called_once_with(update_index,
+                                             [{'group': ['grp-1']}])
 
-class TestScheduleJobs:
+    @monkey_patch(jobs, 'enqueue', Mock())
+    def test_schedule_sync_index(self):
+        schedule_sync_index(['dashboard'])
+        jobs.enqueue.assert_called_once_with(sync_index, [['dashboard']])
 
     @monkey_patch(jobs, 'enqueue', Mock())
-    def test_schedule_update_index(self):
-        schedule_update_index('test-query')
-        jobs.enqueue.assert_called_once_with(update_index, ['test-query'])
+    def test_schedule_flush_index_queue(self):
+        schedule_flush_index_queue()
+        jobs.enqueue.assert_called_once_with(flush_index_queue)
 
     @monkey_patch(jobs, 'enqueue', Mock())
     def test_schedule_notification_email(self):
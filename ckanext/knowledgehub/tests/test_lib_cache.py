@@ -0,0 +1,336 @@
+"""
+Copyright (c) 2018 Keitaro AB
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from mock import Mock, MagicMock
+
+from ckanext.knowledgehub.lib.cache import (
+    LRUCache,
+    SearchResultsCache,
+    TagKeywordMap,
+    GroupMap,
+    PermissionLabelsCache,
+)
+
+from nose.tools import (
+    assert_true,
+    assert_equals,
+)
+
+
+class TestLRUCache:
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(size=2, timeout=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        assert_equals(1, cache.get('a'))
+        assert_equals(None, cache.get('b'))
+        assert_equals(3, cache.get('c'))
+        assert_equals(2, len(cache))
+
+    def test_expired_entries(self):
+        cache = LRUCache(size=2, timeout=-1)
+        cache.set('a', 1)
+
+        assert_equals(None, cache.get('a'))
+
+
+class TestSearchResultsCache:
+
+    def _get_cache(self, redis_conn):
+        cache = SearchResultsCache(redis=Mock(return_value=redis_conn),
+                                   local=LRUCache(size=10, timeout=60))
+        cache.is_enabled = Mock(return_value=True)
+        return cache
+
+    def test_cache_key_normalized(self):
+        cache = self._get_cache(MagicMock())
+
+        key1 = cache.get_cache_key('dashboard', '1', {
+            'q': 'text:test',
+            'fq': ['a:1', 'b:2'],
+        }, ['member-b', 'member-a'])
+        key2 = cache.get_cache_key('dashboard', '1', {
+            'fq': ['b:2', 'a:1'],
+            'q': 'text:test',
+        }, ['member-a', 'member-b', 'member-a'])
+        key3 = cache.get_cache_key('dashboard', '2', {
+            'fq': ['b:2', 'a:1'],
+            'q': 'text:test',
+        }, ['member-a', 'member-b'])
+
+        assert_equals(key1, key2)
+        assert_true(key1 != key3)
+
+    def test_get_or_search(self):
+        redis_conn = MagicMock()
+        redis_conn.get.return_value = None
+        redis_conn.mget.return_value = [None, None]
+        cache = self._get_cache(redis_conn)
+        search = Mock(return_value={'hits': 1, 'docs': [{'id': 'aaa'}]})
+
+        results = cache.get_or_search('dashboard', {'q': 'text:*'}, None,
+                                      search)
+        assert_equals({'hits': 1, 'docs': [{'id': 'aaa'}]}, results)
+        # the caller may modify the results
+        results['docs'].append({'id': 'bbb'})
+
+        results = cache.get_or_search('dashboard', {'q': 'text:*'}, None,
+                                      search)
+        assert_equals({'hits': 1, 'docs': [{'id': 'aaa'}]}, results)
+
+        search.assert_called_once()
+        redis_conn.setex.assert_called_once()
+        stats = cache.stats()
+        assert_equals(1, stats['local_hits'])
+        assert_equals(1, stats['misses'])
+        assert_equals(0.5, stats['hit_rate'])
+
+    def test_get_or_search_redis_failure(self):
+        redis_conn = MagicMock()
+        redis_conn.get.side_effect = Exception('redis down')
+        redis_conn.mget.side_effect = Exception('redis down')
+        cache = self._get_cache(redis_conn)
+        search = Mock(return_value={'hits': 0})
+
+        results = cache.get_or_search('dashboard', {'q': 'text:*'}, None,
+                                      search)
+
+        assert_equals({'hits': 0}, results)
+        assert_equals(1, cache.stats()['errors'])
+
+    def test_bump_generation(self):
+        redis_conn = MagicMock()
+        cache = self._get_cache(redis_conn)
+
+        cache.bump_generation('dashboard')
+
+        redis_conn.incr.assert_called_once_with(
+            'ckanext.knowledgehub.search.cache.generation:dashboard')
+        redis_conn.setex.assert_not_called()
+
+    def test_bump_generation_commit_within(self):
+        redis_conn = MagicMock()
+        cache = self._get_cache(redis_conn)
+
+        cache.bump_generation('dashboard', commit_within=1500)
+
+        redis_conn.setex.assert_called_once_with(
+            'ckanext.knowledgehub.search.cache.settling:dashboard', '1', 3)
+        redis_conn.incr.assert_called_once_with(
+            'ckanext.knowledgehub.search.cache.generation:dashboard')
+
+    def test_get_or_search_settling(self):
+        redis_conn = MagicMock()
+        redis_conn.get.return_value = None
+        redis_conn.mget.return_value = ['2', '1']
+        cache = self._get_cache(redis_conn)
+        search = Mock(return_value={'hits': 1, 'docs': [{'id': 'aaa'}]})
+
+        cache.get_or_search('dashboard', {'q': 'text:*'}, None, search)
+        cache.get_or_search('dashboard', {'q': 'text:*'}, None, search)
+
+        # the results are not cached until the index is committed
+        assert_equals(2, search.call_count)
+        redis_conn.setex.assert_not_called()
+        assert_equals(0, len(cache.get_local()))
+
+
+class TestTagKeywordMap:
+
+    def _get_map(self, redis_conn):
+        tag_keywords = TagKeywordMap(redis=Mock(return_value=redis_conn),
+                                     check_interval=0)
+        tag = {'id': 'tag1', 'name': 'first', 'keyword_id': 'kwd1'}
+        tag_keywords._load = Mock(return_value={
+            'tags': {
+                'tag1': tag,
+                'first': tag,
+                'tag2': {'id': 'tag2', 'name': 'second', 'keyword_id': None},
+            },
+            'keywords': {
+                'kwd1': {'id': 'kwd1', 'name': 'keyword'},
+            },
+        })
+        return tag_keywords
+
+    def test_get_tag_keywords(self):
+        redis_conn = MagicMock()
+        redis_conn.get.return_value = '1'
+        tag_keywords = self._get_map(redis_conn)
+
+        assert_equals('tag1', tag_keywords.get_tag('first')['id'])
+        assert_equals([{'id': 'kwd1', 'name': 'keyword'}],
+                      tag_keywords.get_tag_keywords(['tag1', 'first',
+                                                     'tag2']))
+        # loaded once, while the version is the same
+        tag_keywords._load.assert_called_once_with()
+
+    def test_reload_on_version_change(self):
+        redis_conn = MagicMock()
+        redis_conn.get.return_value = '1'
+        tag_keywords = self._get_map(redis_conn)
+
+        tag_keywords.get_keyword('kwd1')
+        redis_conn.get.return_value = '2'
+        tag_keywords.get_keyword('kwd1')
+
+        assert_equals(2, tag_keywords._load.call_count)
+
+    def test_missing_tag_looked_up(self):
+        redis_conn = MagicMock()
+        redis_conn.get.return_value = '1'
+        tag_keywords = self._get_map(redis_conn)
+        tag_keywords.get_tag('tag1')
+
+        tag_keywords._load.return_value = {
+            'tags': {
+                'tag3': {'id': 'tag3', 'name': 'third', 'keyword_id': None},
+            },
+            'keywords': {},
+        }
+
+        assert_equals('third', tag_keywords.get_tag('tag3')['name'])
+        tag_keywords._load.assert_called_with('tag3')
+        # the tag is now in the map
+        tag_keywords.get_tag('tag3')
+        assert_equals(2, tag_keywords._load.call_count)
+
+    def test_missing_tag_not_found(self):
+        redis_conn = MagicMock()
+        redis_conn.get.return_value = '1'
+        tag_keywords = self._get_map(redis_conn)
+        tag_keywords.get_tag('tag1')
+        tag_keywords._load.return_value = {'tags': {}, 'keywords': {}}
+
+        assert_equals(None, tag_keywords.get_tag('deleted'))
+        assert_equals(None, tag_keywords.get_tag('deleted'))
+
+        # the miss is cached
+        tag_keywords._load.assert_called_with('deleted')
+        assert_equals(2, tag_keywords._load.call_count)
+
+        # until it expires
+        tag_keywords._get_maps()['missing']['deleted'] = 0
+        assert_equals(None, tag_keywords.get_tag('deleted'))
+        assert_equals(3, tag_keywords._load.call_count)
+
+    def test_invalidate(self):
+        redis_conn = MagicMock()
+        redis_conn.get.return_value = '1'
+        tag_keywords = self._get_map(redis_conn)
+        tag_keywords.check_interval = 60
+        tag_keywords.get_tag('tag1')
+
+        tag_keywords.invalidate()
+        tag_keywords.get_tag('tag1')
+
+        redis_conn.incr.assert_called_once_with(TagKeywordMap.VERSION_KEY)
+        assert_equals(2, tag_keywords._load.call_count)
+
+
+class TestGroupMap:
+
+    def _get_map(self, redis_conn):
+        groups = GroupMap(redis=Mock(return_value=redis_conn),
+                          check_interval=0)
+        groups._load = Mock(return_value={
+            'grp1': {'id': 'g1', 'name': 'grp1', 'title': 'Group One',
+                     'image_url': None, 'is_organization': False},
+            'org1': {'id': 'o1', 'name': 'org1', 'title': 'Org One',
+                     'image_url': None, 'is_organization': True},
+        })
+        return groups
+
+    def test_get_titles(self):
+        redis_conn = MagicMock()
+        redis_conn.get.return_value = '1'
+        groups = self._get_map(redis_conn)
+
+        assert_equals({'grp1': 'Group One', 'org1': 'Org One'},
+                      groups.get_titles(['org1', 'grp1', 'missing']))
+        assert_equals(['o1'], [g['id'] for g in groups.find(['org1'])])
+        assert_equals(2, len(groups.find()))
+        # loaded once, while the version is the same
+        groups._load.assert_called_once_with()
+
+    def test_invalidate(self):
+        redis_conn = MagicMock()
+        redis_conn.get.return_value = '1'
+        groups = self._get_map(redis_conn)
+        groups.check_interval = 60
+        groups.find()
+
+        groups.invalidate()
+        groups.find()
+
+        redis_conn.incr.assert_called_once_with(GroupMap.VERSION_KEY)
+        assert_equals(2, groups._load.call_count)
+
+
+class TestPermissionLabelsCache:
+
+    def _get_cache(self, redis_conn):
+        return PermissionLabelsCache(redis=Mock(return_value=redis_conn),
+                                     local=LRUCache(size=10, timeout=60))
+
+    def test_get_or_load(self):
+        redis_conn = MagicMock()
+        redis_conn.get.side_effect = lambda key: (
+            '1' if key.endswith('.version') else None)
+        cache = self._get_cache(redis_conn)
+        load = Mock(return_value=['member-org1', 'member-grp1'])
+
+        labels = cache.get_or_load('user1', load)
+        labels.append('modified')
+
+        assert_equals(['member-org1', 'member-grp1'],
+                      cache.get_or_load('user1', load))
+        load.assert_called_once()
+        redis_conn.setex.assert_called_once()
+        key, _, _ = redis_conn.setex.call_args[0]
+        assert_equals(
+            'ckanext.knowledgehub.permission_labels.labels:user1:1', key)
+
+    def test_version_bumped(self):
+        versions = ['1']
+        redis_conn = MagicMock()
+        redis_conn.get.side_effect = lambda key: (
+            versions[0] if key.endswith('.version') else None)
+        cache = self._get_cache(redis_conn)
+        load = Mock(return_value=['member-org1'])
+
+        cache.get_or_load('user1', load)
+        cache.bump_version()
+        versions[0] = '2'
+        cache.get_or_load('user1', load)
+
+        redis_conn.incr.assert_called_once_with(
+            'ckanext.knowledgehub.permission_labels.version')
+        assert_equals(2, load.call_count)
+
+    def test_redis_failure(self):
+        redis_conn = MagicMock()
+        redis_conn.get.side_effect = Exception('connection refused')
+        cache = self._get_cache(redis_conn)
+        load = Mock(return_value=['member-org1'])
+
+        assert_equals(['member-org1'], cache.get_or_load('user1', load))
+        load.assert_called_once()
@@ -0,0 +1,98 @@
+"""
+Copyright (c) 2018 Keitaro AB
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from mock import Mock
+
+from ckanext.knowledgehub.lib.loader import (
+    EntityLoader,
+    get_entity_loader,
+    entity_loader_scope,
+    split_refs,
+)
+
+from nose.tools import (
+    assert_true,
+    assert_equals,
+    raises,
+)
+
+
+class TestEntityLoader:
+
+    def _get_loader(self):
+        tags = {
+            'tag1': {'id': 'tag1', 'name': 'first'},
+            'tag2': {'id': 'tag2', 'name': 'second'},
+        }
+
+        def _load_tags(refs):
+            found = {}
+            for ref in refs:
+                for tag in tags.values():
+                    if ref in (tag['id'], tag['name']):
+                        found[ref] = tag
+            return found
+
+        loader = EntityLoader()
+        loader.batch_loaders = {
+            'tag': Mock(side_effect=_load_tags),
+        }
+        return loader
+
+    def test_load_many_batches_queued_refs(self):
+        loader = self._get_loader()
+
+        loader.prime('tag', ['tag1', 'second'])
+        tags = loader.load_many('tag', ['tag1', 'missing'])
+
+        assert_equals([{'id': 'tag1', 'name': 'first'}, None], tags)
+        # all of the queued references are loaded with a single batch
+        loader.batch_loaders['tag'].assert_called_once()
+        args, _ = loader.batch_loaders['tag'].call_args
+        assert_equals(['missing', 'second', 'tag1'], sorted(args[0]))
+
+    def test_load_memoized(self):
+        loader = self._get_loader()
+
+        assert_equals('first', loader.load('tag', 'tag1')['name'])
+        assert_equals(None, loader.load('tag', 'missing'))
+        # loaded by name before, then referenced by id
+        assert_equals('tag2', loader.load('tag', 'second')['id'])
+        assert_equals('second', loader.load('tag', 'tag2')['name'])
+        assert_equals(None, loader.load('tag', 'missing'))
+        assert_equals(None, loader.load('tag', None))
+
+        assert_equals(3, loader.batch_loaders['tag'].call_count)
+
+    @raises(ValueError)
+    def test_unknown_entity_type(self):
+        self._get_loader().load('unknown', 'ref')
+
+    def test_entity_loader_scope(self):
+        assert_true(get_entity_loader() is not get_entity_loader())
+
+        with entity_loader_scope() as loader:
+            assert_true(get_entity_loader() is loader)
+            with entity_loader_scope() as nested:
+                assert_true(nested is loader)
+
+        assert_true(get_entity_loader() is not loader)
+
+    def test_split_refs(self):
+        assert_equals(['a', 'b'], split_refs(' a, ,b,'))
+        assert_equals(['a'], split_refs(['a']))
+        assert_equals([], split_refs(None))
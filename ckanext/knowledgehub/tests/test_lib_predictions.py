@@ -0,0 +1,87 @@
+"""
+Copyright (c) 2018 Keitaro AB
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from datetime import datetime
+
+from mock import Mock, MagicMock
+
+from ckanext.knowledgehub.lib.predictions import PredictionIndex
+
+from nose.tools import (
+    assert_equals,
+)
+
+
+class TestPredictionIndex:
+
+    def _get_index(self, rows, version='1'):
+        redis_conn = MagicMock()
+        redis_conn.get.return_value = version
+        index = PredictionIndex(redis=Mock(return_value=redis_conn),
+                                check_interval=0,
+                                rebuild_interval=3600)
+        index._query_rows = Mock(return_value=rows)
+        return index, redis_conn
+
+    def test_complete(self):
+        index, _ = self._get_index([
+            ('d1', 'Refugees in Syria', 'Number of refugees in Syria',
+             datetime(2020, 1, 1)),
+            ('d2', 'Refugees in Sweden', None, datetime(2020, 1, 2)),
+        ])
+
+        assert_equals(['yria', 'weden'], index.complete('refugees in s'))
+        assert_equals(['ria'], index.complete('Refugees in Sy', limit=1))
+        assert_equals([' in'], index.complete('number of refugees'))
+        assert_equals(['syria', 'sweden'],
+                      index.complete('refugees in '))
+        assert_equals([], index.complete('displacement'))
+
+    def test_refresh_new_rows(self):
+        index, _ = self._get_index([
+            ('d1', 'Refugees in Syria', None, datetime(2020, 1, 1)),
+        ])
+        assert_equals(['syria'], index.complete('refugees in '))
+
+        index._query_rows.return_value = [
+            ('d1', 'Refugees in Syria', None, datetime(2020, 1, 1)),
+            ('d2', 'Refugees in Sweden', None, datetime(2020, 1, 2)),
+            ('d3', 'Refugees in Sweden', None, datetime(2020, 1, 2)),
+        ]
+
+        assert_equals(['sweden', 'syria'], index.complete('refugees in '))
+        index._query_rows.assert_called_with(since=datetime(2020, 1, 1))
+
+    def test_rebuild_on_version_change(self):
+        index, redis_conn = self._get_index([
+            ('d1', 'Refugees in Syria', None, datetime(2020, 1, 1)),
+        ])
+        assert_equals(['syria'], index.complete('refugees in '))
+
+        redis_conn.get.return_value = '2'
+        index._query_rows.return_value = [
+            ('d2', 'Refugees in Sweden', None, datetime(2020, 1, 2)),
+        ]
+
+        assert_equals(['sweden'], index.complete('refugees in '))
+        index._query_rows.assert_called_with()
+
+    def test_invalidate(self):
+        index, redis_conn = self._get_index([])
+        index.invalidate()
+
+        redis_conn.incr.assert_called_once_with(PredictionIndex.VERSION_KEY)
@@ -110,8 +110,6 @@ class TestUserProfileService:
 
         _actions = {
             'package_show': lambda ctx, dd: _get(datasets, dd['id']),
-            'tag_show': lambda ctx, dd: _get(tags, dd['id']),
-            'keyword_show': lambda ctx, dd: _get(keywords, dd['id']),
             'dashboard_show': lambda ctx, dd: _get(dashboards, dd['id']),
         }
 
@@ -134,9 +132,15 @@ class TestUserProfileService:
         user_query_result_mock.get_last_relevant.side_effect = \
             _get_last_relevant_mock
 
+        tag_keywords = MagicMock()
+        tag_keywords.get_tag.side_effect = \
+            lambda ref: dict({'keyword_id': None}, **tags[ref])
+        tag_keywords.get_keyword.side_effect = keywords.get
+
         service = UserProfileService(redis=MagicMock(),
                                      user_profile=MagicMock(),
-                                     user_query_result=user_query_result_mock)
+                                     user_query_result=user_query_result_mock,
+                                     tag_keywords=tag_keywords)
 
         relevant = service.get_last_relevant('user-001')
         assert_true(relevant is not None)
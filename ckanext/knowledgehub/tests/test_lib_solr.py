@@ -16,24 +16,40 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 from mock import Mock, patch, MagicMock
+from sqlalchemy import Column, MetaData, Table, UnicodeText, select
+from sqlalchemy.dialects import postgresql
 
 from ckan.tests import helpers
 from ckan.plugins import toolkit
 from ckan.common import config
-from pysolr import Results
+from pysolr import Results, SolrError
 
 from ckanext.knowledgehub.lib.solr import (
     Index,
     Indexed,
+    SolrConnectionPool,
+    PooledConnection,
+    IndexUpdateQueue,
+    MatchGroupSetCounts,
+    MATCH_GROUP_SETS_KEY,
     ckan_params_to_solr_args,
     mapped,
+    mapped_date,
     unprefixed,
     to_indexed_doc,
     indexed_doc_to_data_dict,
     boost_solr_params,
     get_fq_permission_labels,
+    get_fq_dashboard_permission_labels,
+    get_max_match_group_sets,
+    check_dashboard_access,
     get_sort_string,
+    DontIndexException,
+    _merge_sorted_ids,
     )
+from ckanext.knowledgehub.lib.loader import get_entity_loader
+from ckanext.knowledgehub.lib.util import monkey_patch
+from ckanext.knowledgehub.lib import solr
 
 from nose.tools import (
     assert_true,
@@ -141,6 +157,208 @@ class TestIndex(helpers.FunctionalTestBase):
             'entity_type': 'test_doc'
         }], commit=True)
 
+    def test_add_many(self):
+        solr_conn_mock = Mock()
+        index = Index()
+        index.get_connection = Mock()
+
+        index.get_connection.return_value = solr_conn_mock
+
+        index.add_many('test_doc', [{'p1': 'v1'}, {'p1': 'v2'}])
+
+        solr_conn_mock.add.assert_called_once_with([{
+            'p1': 'v1',
+            'entity_type': 'test_doc'
+        }, {
+            'p1': 'v2',
+            'entity_type': 'test_doc'
+        }], commit=False)
+
+    def test_add_many_commit_within(self):
+        solr_conn_mock = Mock()
+        index = Index()
+        index.get_connection = Mock()
+
+        index.get_connection.return_value = solr_conn_mock
+
+        index.add_many('test_doc', [{'p1': 'v1'}], commit_within=1000)
+
+        solr_conn_mock.add.assert_called_once_with([{
+            'p1': 'v1',
+            'entity_type': 'test_doc'
+        }], commit=False, commitWithin=1000)
+
+    def test_add_many_no_docs(self):
+        solr_conn_mock = Mock()
+        index = Index()
+        index.get_connection = Mock()
+
+        index.get_connection.return_value = solr_conn_mock
+
+        index.add_many('test_doc', [])
+
+        solr_conn_mock.add.assert_not_called()
+
+    def test_commit(self):
+        solr_conn_mock = Mock()
+        index = Index()
+        index.get_connection = Mock()
+
+        index.get_connection.return_value = solr_conn_mock
+
+        index.commit()
+
+        solr_conn_mock.commit.assert_called_once()
+
+    def test_search_live_generation(self):
+        solr_conn_mock = Mock()
+        generations = Mock()
+        generations.get_live.return_value = 'gen-1'
+        index = Index(generations=generations)
+        index.get_connection = Mock()
+
+        index.get_connection.return_value = solr_conn_mock
+
+        solr_conn_mock.search.return_value = Results({
+            'response': {
+                'docs': [],
+                'numFound': 0,
+            }
+        })
+
+        index.search('test_doc', q='id:aaa')
+
+        solr_conn_mock.search.assert_called_once_with(**{
+            'q': 'id:aaa',
+            'fq': ['entity_type:test_doc', '+index_generation:gen-1'],
+            'rows': 500,
+        })
+
+    def test_search_building_first_generation(self):
+        solr_conn_mock = Mock()
+        generations = Mock()
+        generations.get_live.return_value = None
+        generations.get_building.return_value = 'gen-1'
+        index = Index(generations=generations)
+        index.get_connection = Mock()
+
+        index.get_connection.return_value = solr_conn_mock
+
+        solr_conn_mock.search.return_value = Results({
+            'response': {
+                'docs': [],
+                'numFound': 0,
+            }
+        })
+
+        index.search('test_doc', q='id:aaa')
+
+        solr_conn_mock.search.assert_called_once_with(**{
+            'q': 'id:aaa',
+            'fq': ['entity_type:test_doc', '-index_generation:gen-1'],
+            'rows': 500,
+        })
+
+    def test_get_write_generations(self):
+        generations = Mock()
+        generations.get_live.return_value = 'gen-1'
+        generations.get_building.return_value = 'gen-2'
+        index = Index(generations=generations)
+
+        assert_equals(['gen-1', 'gen-2'],
+                      index.get_write_generations('test_doc'))
+
+        generations.get_building.return_value = None
+        assert_equals(['gen-1'], index.get_write_generations('test_doc'))
+
+    def test_remove_stale(self):
+        solr_conn_mock = Mock()
+        index = Index(generations=Mock())
+        index.get_connection = Mock()
+
+        index.get_connection.return_value = solr_conn_mock
+
+        index.remove_stale('test_doc', 'gen-1')
+
+        solr_conn_mock.delete.assert_called_once_with(
+            q='entity_type:test_doc AND -index_generation:gen-1',
+            commit=True)
+
+    def test_remove_ids(self):
+        solr_conn_mock = Mock()
+        index = Index(generations=Mock())
+        index.get_connection = Mock()
+
+        index.get_connection.return_value = solr_conn_mock
+
+        index.remove_ids('test_doc', 'entity_id', ['a', 'b'])
+
+        solr_conn_mock.delete.assert_called_once_with(
+            q='entity_type:test_doc AND entity_id:("a" OR "b")',
+            commit=False)
+
+    def test_iter_ids(self):
+        index = Index(generations=Mock())
+        index.search = Mock()
+
+        first = Results({
+            'response': {
+                'docs': [{'entity_id': 'a'}, {'entity_id': 'b'}],
+                'numFound': 3,
+            },
+            'nextCursorMark': 'cursor-1',
+        })
+        second = Results({
+            'response': {
+                'docs': [{'entity_id': 'c'}],
+                'numFound': 3,
+            },
+            'nextCursorMark': 'cursor-2',
+        })
+        last = Results({
+            'response': {
+                'docs': [],
+                'numFound': 3,
+            },
+            'nextCursorMark': 'cursor-2',
+        })
+        index.search.side_effect = [first, second, last]
+
+        ids = list(index.iter_ids('test_doc', 'entity_id'))
+
+        assert_equals(['a', 'b', 'c'], ids)
+        assert_equals(3, index.search.call_count)
+        index.search.assert_called_with('test_doc',
+                                        q='*:*',
+                                        fl='entity_id',
+                                        rows=500,
+                                        sort='entity_id asc,index_id asc',
+                                        cursorMark='cursor-2')
+
+    def test_iter_search(self):
+        index = Index(generations=Mock())
+        index.search = Mock()
+        index.search.side_effect = [
+            Results({
+                'response': {'docs': [{'title': 'a'}], 'numFound': 1},
+                'nextCursorMark': 'cursor-1',
+            }),
+            Results({
+                'response': {'docs': [], 'numFound': 1},
+                'nextCursorMark': 'cursor-1',
+            }),
+        ]
+
+        docs = list(index.iter_search('test_doc', q='text:*', start=100,
+                                      rows=10000, sort='title desc'))
+
+        assert_equals([{'title': 'a'}], docs)
+        index.search.assert_called_with('test_doc',
+                                        q='text:*',
+                                        rows=500,
+                                        sort='title desc,index_id asc',
+                                        cursorMark='cursor-1')
+
     def test_remove(self):
         solr_conn_mock = Mock()
         index = Index()
@@ -168,6 +386,127 @@ class TestIndex(helpers.FunctionalTestBase):
             commit=True)
 
 
+class TestSolrConnectionPool(helpers.FunctionalTestBase):
+
+    def _get_pool(self, factory, size=2, retries=2):
+        pool = SolrConnectionPool(connection_factory=factory)
+        pool._settings = {
+            'size': size,
+            'pool_timeout': 0.01,
+            'timeout': 5,
+            'retries': retries,
+            'retry_backoff': 0,
+        }
+        return pool
+
+    def test_reuse_connections(self):
+        conn = Mock()
+        conn.search.return_value = 'results'
+        factory = Mock(return_value=conn)
+        pool = self._get_pool(factory)
+
+        assert_equals('results', pool.execute('search', q='*:*'))
+        assert_equals('results', pool.execute('search', q='*:*'))
+
+        factory.assert_called_once()
+        assert_equals(2, conn.search.call_count)
+        assert_equals(5, conn.timeout)
+
+        stats = pool.stats()
+        assert_equals(1, stats['created'])
+        assert_equals(0, stats['in_use'])
+        assert_equals(1, stats['idle'])
+
+    def test_retry_on_connection_error(self):
+        failing = Mock()
+        failing.search.side_effect = SolrError(
+            'Failed to connect to server at http://solr')
+        conn = Mock()
+        conn.search.return_value = 'results'
+        factory = Mock(side_effect=[failing, conn])
+        pool = self._get_pool(factory)
+
+        assert_equals('results', pool.execute('search', q='*:*'))
+
+        assert_equals(2, factory.call_count)
+        stats = pool.stats()
+        assert_equals(1, stats['created'])
+        assert_equals(1, stats['reconnects'])
+        assert_equals(1, stats['errors'])
+
+    @raises(SolrError)
+    def test_no_retry_on_error_response(self):
+        conn = Mock()
+        conn.search.side_effect = SolrError(
+            'Solr responded with an error (HTTP 400): bad query')
+        factory = Mock(return_value=conn)
+        pool = self._get_pool(factory)
+
+        try:
+            pool.execute('search', q='*:*')
+        finally:
+            conn.search.assert_called_once()
+            assert_equals(0, pool.stats()['reconnects'])
+
+    @raises(SolrError)
+    def test_wait_for_free_connection(self):
+        factory = Mock(return_value=Mock())
+        pool = self._get_pool(factory, size=1)
+
+        pool._acquire()
+        try:
+            pool._acquire()
+        finally:
+            assert_equals(1, pool.stats()['waits'])
+
+    def test_pooled_connection(self):
+        pool = Mock()
+        conn = PooledConnection(pool, decode_dates=False)
+
+        conn.search(q='*:*')
+        pool.execute.assert_called_once_with('search', q='*:*',
+                                             decode_dates=False)
+
+
+class TestIndexUpdateQueue(helpers.FunctionalTestBase):
+
+    def test_push(self):
+        conn = MagicMock()
+        pipe = conn.pipeline.return_value
+        pipe.execute.side_effect = [[1, True], [0, None]]
+        queue = IndexUpdateQueue(redis=Mock(return_value=conn))
+
+        assert_true(queue.push('dashboard', 'aaa'))
+        # the window is already open, no new flush is needed
+        assert_equals(False, queue.push('dashboard', 'aaa'))
+
+        pipe.sadd.assert_called_with(
+            'ckanext.knowledgehub.index.queue.pending', 'dashboard:aaa')
+        _, kwargs = pipe.set.call_args
+        assert_true(kwargs['nx'])
+
+    def test_pop(self):
+        conn = MagicMock()
+        pipe = conn.pipeline.return_value
+        pipe.execute.return_value = [
+            1,
+            set(['dashboard:bbb', 'dashboard:aaa', 'post:ccc']),
+            1,
+        ]
+        queue = IndexUpdateQueue(redis=Mock(return_value=conn))
+
+        updates = queue.pop()
+
+        assert_equals({
+            'dashboard': ['aaa', 'bbb'],
+            'post': ['ccc'],
+        }, updates)
+        pipe.delete.assert_any_call(
+            'ckanext.knowledgehub.index.queue.scheduled')
+        pipe.delete.assert_any_call(
+            'ckanext.knowledgehub.index.queue.pending')
+
+
 class TestHelperMethods(helpers.FunctionalTestBase):
 
     def test_ckan_params_to_solr_args(self):
@@ -254,6 +593,32 @@ class TestHelperMethods(helpers.FunctionalTestBase):
             'prop': 'value',
         }, data)
 
+    def test_date_fields(self):
+        from datetime import datetime
+        fields = [
+            {'field': 'id', 'as': 'id'},
+            mapped_date('created_at', 'khe_created'),
+            mapped_date('modified_at', 'khe_modified'),
+        ]
+
+        doc = to_indexed_doc({
+            'id': 'aaa',
+            'created_at': datetime(2020, 5, 1, 10, 20, 30, 123456),
+            'modified_at': '2020-05-02T08:00:00.5',
+        }, 'test_doc', fields)
+
+        assert_equals('2020-05-01T10:20:30.123Z', doc['khe_created'])
+        assert_equals('2020-05-02T08:00:00.500Z', doc['khe_modified'])
+
+        data = indexed_doc_to_data_dict({
+            'id': 'aaa',
+            'khe_created': '2020-05-01T10:20:30.123Z',
+            'khe_modified': datetime(2020, 5, 2, 8, 0),
+        }, fields)
+
+        assert_equals('2020-05-01T10:20:30.123000', data['created_at'])
+        assert_equals('2020-05-02T08:00:00', data['modified_at'])
+
     def test_boost_solr_params(self):
         params = boost_solr_params({
             'normal': {
@@ -280,6 +645,84 @@ class TestHelperMethods(helpers.FunctionalTestBase):
         assert_equals(fqlabels, '+permission_labels:("user-a" OR "creator-a" '
                                 'OR "member-b" OR "member-c")')
 
+    def test_get_fq_dashboard_permission_labels(self):
+        fq = get_fq_dashboard_permission_labels(['user-a', 'member-b'],
+                                                max_sets=2)
+        assert_equals(fq, '+(permission_labels:("user-a" OR "member-b") OR '
+                          '(match_groups_count:[1 TO *] AND '
+                          '_query_:"{!frange l=0 u=0}sub(match_groups_count,'
+                          'sum(termfreq(idx_match_groups,\'0:b\'),'
+                          'termfreq(idx_match_groups,\'1:b\')))"))')
+
+        fq = get_fq_dashboard_permission_labels(
+            ['user-a', 'member-c', 'member-b'], max_sets=1)
+        assert_true('sum(min(1,sum(termfreq(idx_match_groups,\'0:b\'),'
+                    'termfreq(idx_match_groups,\'0:c\'))))' in fq)
+
+        # no memberships, only the explicit access is checked
+        fq = get_fq_dashboard_permission_labels(['user-a'], max_sets=2)
+        assert_equals(fq, '+permission_labels:("user-a")')
+
+    def test_get_fq_dashboard_permission_labels_combined_labels(self):
+        fq = get_fq_dashboard_permission_labels(
+            ['member-b-c', 'member-b', 'member-c'], max_sets=1)
+
+        assert_true('termfreq(idx_match_groups,\'0:b\')' in fq)
+        assert_true('termfreq(idx_match_groups,\'0:c\')' in fq)
+        assert_true('0:b-c' not in fq)
+
+    def test_check_dashboard_access(self):
+        data = {
+            'permission_labels': ['creator-a', 'member-o'],
+            'idx_match_groups': ['0:b', '0:c', '1:d'],
+            'match_groups_count': 2,
+        }
+
+        # explicit access
+        assert_true(check_dashboard_access(data, ['creator-a']))
+        assert_true(check_dashboard_access(data, ['user-x', 'member-o']))
+        # implicit access, a member of a group in every group set
+        assert_true(check_dashboard_access(data, ['member-c', 'member-d']))
+        assert_true(not check_dashboard_access(data, ['member-b',
+                                                      'member-c']))
+        assert_true(not check_dashboard_access(data, ['member-b-d']))
+        assert_true(not check_dashboard_access({}, ['member-b']))
+
+    def test_match_group_set_counts(self):
+        redis_conn = MagicMock()
+        counts = MatchGroupSetCounts(redis=Mock(return_value=redis_conn))
+
+        counts.record(0)
+        redis_conn.sadd.assert_not_called()
+        counts.record(3)
+        redis_conn.sadd.assert_called_once_with(MATCH_GROUP_SETS_KEY, 3)
+
+        redis_conn.smembers.return_value = set(['3', '25', '1'])
+        assert_equals(counts.get_max(), 25)
+        redis_conn.smembers.return_value = set()
+        assert_equals(counts.get_max(), None)
+        redis_conn.smembers.side_effect = Exception('redis down')
+        assert_equals(counts.get_max(), None)
+
+    @monkey_patch(solr.match_group_set_counts, 'get_max',
+                  Mock(return_value=42))
+    def test_get_max_match_group_sets(self):
+        assert_equals(get_max_match_group_sets(), 42)
+        solr.match_group_set_counts.get_max.return_value = None
+        assert_equals(get_max_match_group_sets(), 20)
+
+    def test_merge_sorted_ids(self):
+        merged = list(_merge_sorted_ids(iter(['a', 'b', 'd', 'e']),
+                                        iter(['b', 'c', 'e', 'f'])))
+        assert_equals([
+            ('a', True, False),
+            ('b', True, True),
+            ('c', False, True),
+            ('d', True, False),
+            ('e', True, True),
+            ('f', False, True),
+        ], merged)
+
     def test_get_sort_string(self):
 
         class _TestModel(Indexed):
@@ -310,50 +753,185 @@ class TestIndexedMixin(helpers.FunctionalTestBase):
             doctype = 'test_doc'
             Session = MagicMock()
             index = MagicMock()
+            search_cache = MagicMock()
+            id = MagicMock()
 
         return IndexedDataModel
 
     def test_rebuild_index(self):
         cls = self._get_mixin_class()
 
-        state = {'call': 0}
+        query = cls.Session.query()
+        # first chunk
+        query.order_by().limit().all.return_value = [
+            model({
+                'id': 'aaa',
+                'title': 'Test Model',
+                'name': 'test-model',
+                'description': 'Test Description',
+            }),
+        ]
+        # the chunk after the last id ('aaa')
+        query.filter().order_by().limit().all.return_value = []
+
+        cls.index.new_generation.return_value = 'gen-1'
+
+        indexed = cls.rebuild_index()
+
+        assert_equals(1, indexed)
+        assert_equals(1, query.order_by().limit().all.call_count)
+        assert_equals(1, query.filter().order_by().limit().all.call_count)
+        cls.index.remove_all.assert_not_called()
+        cls.index.add_many.assert_called_once()
+        cls.index.add.assert_not_called()
+        cls.index.commit.assert_called_once()
+
+        _, docs = cls.index.add_many.call_args[0]
+        assert_equals('gen-1', docs[0].get('index_generation'))
+
+        cls.index.new_generation.assert_called_once_with('test_doc')
+        cls.index.publish_generation.assert_called_once_with('test_doc',
+                                                             'gen-1')
+        cls.index.schedule_remove_stale.assert_called_once_with('test_doc',
+                                                                'gen-1')
+        cls.index.abort_generation.assert_not_called()
+
+    def test_rebuild_index_failed(self):
+        cls = self._get_mixin_class()
 
-        def _query_db(*args, **kwargs):
-            if state['call']:
-                return []
-            state['call'] += 1
-            return [
-                model({
-                    'id': 'aaa',
-                    'title': 'Test Model',
-                    'name': 'test-model',
-                    'description': 'Test Description',
-                }),
-            ]
+        cls.Session.query().order_by().limit().all.side_effect = Exception(
+            'DB error')
+        cls.index.new_generation.return_value = 'gen-1'
 
-        cls.Session.query().offset().limit().all.side_effect = _query_db
+        try:
+            cls.rebuild_index()
+            raise AssertionError('Expected the rebuild to fail')
+        except Exception as e:
+            assert_equals('DB error', str(e))
+
+        cls.index.abort_generation.assert_called_once_with('test_doc')
+        cls.index.publish_generation.assert_not_called()
+        cls.index.schedule_remove_stale.assert_not_called()
+
+    def test_get_shard_bounds(self):
+        cls = self._get_mixin_class()
+        query = cls.Session.query()
+        query.count.return_value = 3 * 1000
+        query.order_by().offset().limit().scalar.side_effect = ['b1', 'b2']
+
+        assert_equals([(None, None)], cls.get_shard_bounds(1))
+        assert_equals([(None, 'b1'), ('b1', 'b2'), ('b2', None)],
+                      cls.get_shard_bounds(4))
+
+    def test_get_shard_bounds_small(self):
+        cls = self._get_mixin_class()
+        cls.Session.query().count.return_value = 1500
 
-        cls.rebuild_index()
+        assert_equals([(None, None)], cls.get_shard_bounds(4))
 
-        assert_equals(2, cls.Session.query().offset().limit().all.call_count)
-        cls.index.remove_all.assert_called_once_with('test_doc')
-        cls.index.add.assert_called_once()
+    def test_get_sorted_id_column_postgres(self):
+        table = Table('test_entity', MetaData(),
+                      Column('id', UnicodeText, primary_key=True))
+
+        class Entity(Indexed):
+            id = table.c.id
+
+        statement = select([table.c.id]).where(
+            Entity._get_sorted_id_column() >= 'b').order_by(
+            Entity._get_sorted_id_column())
+        sql = str(statement.compile(dialect=postgresql.dialect()))
+
+        assert_true('(test_entity.id COLLATE "C") >=' in sql, sql)
+        assert_true(sql.endswith('ORDER BY test_entity.id COLLATE "C"'), sql)
+
+    def test_iter_db_ids_postgres(self):
+        cls = self._get_mixin_class()
+        cls.id = Table('test_entity', MetaData(),
+                       Column('id', UnicodeText, primary_key=True)).c.id
+        query = cls.Session.query()
+        query.order_by().yield_per.return_value = [('aaa',), ('bbb',)]
+
+        assert_equals(['aaa', 'bbb'], list(cls._iter_db_ids()))
+
+        order = query.order_by.call_args[0][0]
+        assert_equals('test_entity.id COLLATE "C"',
+                      str(order.compile(dialect=postgresql.dialect())))
+
+    def test_rebuild_shard(self):
+        cls = self._get_mixin_class()
+        query = cls.Session.query()
+        shard_query = query.filter().filter()
+        shard_query.order_by().limit().all.return_value = [
+            model({
+                'id': 'bbb',
+                'title': 'Test B',
+                'name': 'test-b',
+            }),
+        ]
+        shard_query.filter().order_by().limit().all.return_value = []
+
+        state = cls.rebuild_shard('gen-1', 'b', 'c')
+
+        assert_equals({'indexed': 1, 'error': False}, state)
+        cls.index.add_many.assert_called_once()
+        cls.index.commit.assert_called_once()
+        cls.index.new_generation.assert_not_called()
+        cls.index.publish_generation.assert_not_called()
+
+    def test_sync_index(self):
+        cls = self._get_mixin_class()
+
+        cls._iter_modified_ids = Mock(return_value=iter(['bbb']))
+        cls._iter_db_ids = Mock(return_value=iter(['aaa', 'bbb', 'ccc']))
+        cls.index.iter_ids.return_value = iter(['bbb', 'ccc', 'ddd'])
+        cls.index.get_write_generations.return_value = ['gen-1']
+        cls._get_by_ids = Mock(return_value=[
+            model({
+                'id': 'aaa',
+                'title': 'Test A',
+                'name': 'test-a',
+            }),
+            model({
+                'id': 'bbb',
+                'title': 'Test B',
+                'name': 'test-b',
+            }),
+        ])
+
+        result = cls.sync_index()
+
+        assert_equals({'updated': 2, 'removed': 1}, result)
+        cls._iter_modified_ids.assert_called_once_with(
+            cls.index.get_watermark.return_value)
+        cls._get_by_ids.assert_called_once_with(['aaa', 'bbb'])
+        cls.index.iter_ids.assert_called_once_with('test_doc', 'khe_id')
+        cls.index.add_many.assert_called_once()
+        cls.index.remove_ids.assert_called_once_with('test_doc', 'khe_id',
+                                                     ['ddd'])
+        cls.index.commit.assert_called_once()
+        cls.index.set_watermark.assert_called_once()
 
     def test_add_to_index(self):
         cls = self._get_mixin_class()
 
-        def _add(doctype, doc):
+        def _add_many(doctype, docs, commit=False, commit_within=None):
             assert_equals('test_doc', doctype)
-            assert_true(doc)
-            assert_true(doc.get('khe_id'))
-            assert_true(doc.get('title'))
-            assert_true(doc.get('name'))
-            assert_true(doc.get('khe_description'))
-            assert_true(doc.get('site_id'))
-            assert_true(doc.get('index_id'))
-            assert_equals('test_doc', doc.get('entity_type'))
-
-        cls.index.add.side_effect = _add
+            assert_equals(2, len(docs))
+            assert_true(commit)
+            for doc in docs:
+                assert_true(doc.get('khe_id'))
+                assert_true(doc.get('title'))
+                assert_true(doc.get('name'))
+                assert_true(doc.get('khe_description'))
+                assert_true(doc.get('site_id'))
+                assert_true(doc.get('index_id'))
+                assert_equals('test_doc', doc.get('entity_type'))
+            assert_equals(['gen-1', 'gen-2'],
+                          [doc.get('index_generation') for doc in docs])
+            assert_true(docs[0]['index_id'] != docs[1]['index_id'])
+
+        cls.index.get_write_generations.return_value = ['gen-1', 'gen-2']
+        cls.index.add_many.side_effect = _add_many
 
         cls.add_to_index({
             'id': 'aaa',
@@ -362,29 +940,17 @@ class TestIndexedMixin(helpers.FunctionalTestBase):
             'description': 'Test Description',
         })
 
-        cls.index.add.assert_called_once()
+        cls.index.add_many.assert_called_once()
 
     def test_update_index_doc(self):
         cls = self._get_mixin_class()
 
-        cls.index.search.return_value = Results({
-            'response': {
-                'docs': [{
-                    'khe_id': 'aaa',
-                    'title': 'Test Model',
-                    'name': 'test-model',
-                    'khe_description': 'Test Description',
-                    'site_id': 'test',
-                    'entity_type': 'test_doc',
-                    'index_id': '1',
-                }],
-                'numFound': 1,
-            }
-        })
-
-        def _add(doctype, doc):
+        def _add_many(doctype, docs, commit=False, commit_within=None):
             assert_equals('test_doc', doctype)
-            assert_true(doc)
+            assert_equals(1, len(docs))
+            assert_true(commit)
+            assert_equals(None, commit_within)
+            doc = docs[0]
             assert_true(doc.get('khe_id'))
             assert_true(doc.get('title'))
             assert_true(doc.get('name'))
@@ -393,7 +959,8 @@ class TestIndexedMixin(helpers.FunctionalTestBase):
             assert_true(doc.get('index_id'))
             assert_equals('test_doc', doc.get('entity_type'))
 
-        cls.index.add.side_effect = _add
+        cls.index.get_write_generations.return_value = [None]
+        cls.index.add_many.side_effect = _add_many
 
         cls.update_index_doc({
             'id': 'aaa',
@@ -402,9 +969,161 @@ class TestIndexedMixin(helpers.FunctionalTestBase):
             'description': 'Test Description',
         })
 
-        cls.index.search.assert_called_once_with('test_doc', q='khe_id:aaa')
+        # The document is overwritten with a single request
+        cls.index.search.assert_not_called()
+        cls.index.remove.assert_not_called()
+        cls.index.add_many.assert_called_once()
+
+    def test_update_index_doc_commit_within(self):
+        cls = self._get_mixin_class()
+        cls.index.get_write_generations.return_value = [None]
+
+        cls.update_index_doc({
+            'id': 'aaa',
+            'title': 'Test Model',
+            'name': 'test-model',
+        }, commit_within=1000)
+
+        cls.index.add_many.assert_called_once()
+        _, kwargs = cls.index.add_many.call_args
+        assert_equals(False, kwargs['commit'])
+        assert_equals(1000, kwargs['commit_within'])
+        # the results are not cached until the document is committed
+        cls.search_cache.bump_generation.assert_called_once_with(
+            'test_doc', commit_within=1000)
+
+    def test_update_index_doc_dont_index(self):
+        cls = self._get_mixin_class()
+
+        def _before_index(data):
+            raise DontIndexException(data['id'])
+
+        cls.before_index = staticmethod(_before_index)
+
+        cls.update_index_doc({
+            'id': 'aaa',
+            'title': 'Test Model',
+        })
+
+        cls.index.add_many.assert_not_called()
         cls.index.remove.assert_called_once_with('test_doc', khe_id='aaa')
-        cls.index.add.assert_called_once()
+        cls.search_cache.bump_generation.assert_called_once_with('test_doc')
+
+    def test_update_index_doc_queued(self):
+        cls = self._get_mixin_class()
+        cls.update_queue = Mock()
+        cls.update_queue.is_enabled.return_value = True
+        cls.update_queue.push.return_value = False
+
+        cls.update_index_doc({
+            'id': 'aaa',
+            'title': 'Test Model',
+        })
+        cls.add_to_index({
+            'id': 'aaa',
+            'title': 'Test Model',
+        })
+
+        assert_equals(2, cls.update_queue.push.call_count)
+        cls.update_queue.push.assert_called_with('test_doc', 'aaa')
+        cls.index.add_many.assert_not_called()
+
+    def test_update_index_doc_queue_failure(self):
+        cls = self._get_mixin_class()
+        cls.update_queue = Mock()
+        cls.update_queue.is_enabled.return_value = True
+        cls.update_queue.push.side_effect = Exception('redis down')
+        cls.index.get_write_generations.return_value = [None]
+
+        cls.update_index_doc({
+            'id': 'aaa',
+            'title': 'Test Model',
+        })
+
+        # falls back to updating the index directly
+        cls.index.add_many.assert_called_once()
+
+    def test_index_by_ids(self):
+        cls = self._get_mixin_class()
+        cls.index.get_write_generations.return_value = [None]
+        cls._get_by_ids = Mock(return_value=[
+            model({
+                'id': 'aaa',
+                'title': 'Test A',
+                'name': 'test-a',
+            }),
+        ])
+
+        result = cls.index_by_ids(['aaa', 'bbb', 'aaa'])
+
+        assert_equals({'updated': 1, 'removed': 1}, result)
+        cls._get_by_ids.assert_called_once_with(['aaa', 'bbb'])
+        cls.index.add_many.assert_called_once()
+        cls.index.remove_ids.assert_called_once_with('test_doc', 'khe_id',
+                                                     ['bbb'])
+        cls.index.commit.assert_called_once()
+        cls.search_cache.bump_generation.assert_called_once_with('test_doc')
+
+    def test_index_by_ids_prefetch_related(self):
+        cls = self._get_mixin_class()
+        cls.index.get_write_generations.return_value = [None]
+        cls._get_by_ids = Mock(return_value=[
+            model({'id': 'aaa', 'title': 'Test A'}),
+            model({'id': 'bbb', 'title': 'Test B'}),
+        ])
+        prefetched = []
+        loaders = []
+
+        def _prefetch_related(loader, items):
+            prefetched.append([item['id'] for item in items])
+            loaders.append(loader)
+
+        def _before_index(data):
+            loaders.append(get_entity_loader())
+            return data
+
+        cls.prefetch_related = staticmethod(_prefetch_related)
+        cls.before_index = staticmethod(_before_index)
+
+        cls.index_by_ids(['aaa', 'bbb'])
+
+        # the related entities are prefetched once for the whole chunk
+        assert_equals([['aaa', 'bbb']], prefetched)
+        # and the same loader is used to enrich every document
+        assert_equals(3, len(loaders))
+        assert_true(all([loader is loaders[0] for loader in loaders]))
+        cls.index.add_many.assert_called_once()
+
+    def test_iter_search_index(self):
+        cls = self._get_mixin_class()
+        cls.index.iter_search.return_value = iter([
+            {'khe_id': 'aaa', 'title': 'Test A'},
+            {'khe_id': 'bbb', 'title': 'Test B'},
+        ])
+
+        docs = list(cls.iter_search_index(q='text:test', projection='ids'))
+
+        assert_equals(['aaa', 'bbb'], [doc['id'] for doc in docs])
+        cls.index.iter_search.assert_called_once_with('test_doc',
+                                                      q='text:test',
+                                                      fl='khe_id')
+
+    def test_get_projection_fl(self):
+        cls = self._get_mixin_class()
+        cls.projections = {
+            'card': ['id', 'title', 'name'],
+        }
+
+        assert_equals('khe_description,khe_id,khe_property,name,title',
+                      cls.get_projection_fl())
+        assert_equals('khe_id', cls.get_projection_fl('ids'))
+        assert_equals('khe_id,name,title', cls.get_projection_fl('card'))
+        assert_equals('khe_id,score', cls.get_projection_fl(['id', 'score']))
+
+    @raises(toolkit.ValidationError)
+    def test_get_projection_fl_unknown(self):
+        cls = self._get_mixin_class()
+        cls.get_projection_fl('unknown')
 
     @raises(toolkit.ValidationError)
     def test_validate_solr_args(self):
@@ -464,7 +1183,8 @@ class TestIndexedMixin(helpers.FunctionalTestBase):
             fq={'f1': 'v1'},
             rows=10,
             start=3,
-            sort='test_sort')
+            sort='test_sort',
+            fl='khe_description,khe_id,khe_property,name,title')
 
     def test_delete_from_index(self):
         cls = self._get_mixin_class()
@@ -476,3 +1196,30 @@ class TestIndexedMixin(helpers.FunctionalTestBase):
         cls = self._get_mixin_class()
         cls.delete_from_index('aaa')
         cls.index.remove.assert_called_once_with('test_doc', khe_id='aaa')
+
+    def test_record_dependencies(self):
+        cls = self._get_mixin_class()
+        cls.dependency_store = Mock()
+        cls.index_dependencies = staticmethod(lambda data: {
+            'tag': [data['property']],
+        })
+
+        cls._record_dependencies([{'id': 'aaa', 'property': 'tag-1'},
+                                  {'id': 'bbb', 'property': 'tag-2'}])
+        cls.delete_from_index('aaa')
+
+        cls.dependency_store.set_dependencies.assert_called_once_with(
+            'test_doc', {
+                'aaa': {'tag': ['tag-1']},
+                'bbb': {'tag': ['tag-2']},
+            })
+        cls.dependency_store.remove_dependencies.assert_called_once_with(
+            'test_doc', ['aaa'])
+
+    def test_record_dependencies_not_supported(self):
+        cls = self._get_mixin_class()
+        cls.dependency_store = Mock()
+
+        cls._record_dependencies([{'id': 'aaa'}])
+
+        cls.dependency_store.set_dependencies.assert_not_called()
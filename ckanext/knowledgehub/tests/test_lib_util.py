@@ -15,8 +15,10 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+from mock import Mock
 from nose.tools import assert_equals, assert_true
-from ckanext.knowledgehub.lib.util import monkey_patch
+from sqlalchemy.orm import Session
+from ckanext.knowledgehub.lib.util import monkey_patch, after_commit
 from unittest import TestCase
 
 
@@ -47,3 +49,29 @@ class TestMonkeyPatch(TestCase):
         assert_true(not hasattr(obj, 'some_prop'))
         test_patch_non_existing_prop()
         assert_true(not hasattr(obj, 'some_prop'))
+
+
+class TestAfterCommit(TestCase):
+
+    def test_called_after_commit(self):
+        session = Session()
+        callback = Mock()
+
+        after_commit(session, callback)
+        callback.assert_not_called()
+
+        session.commit()
+        callback.assert_called_once()
+
+        session.commit()
+        callback.assert_called_once()
+
+    def test_discarded_on_rollback(self):
+        session = Session()
+        callback = Mock()
+
+        after_commit(session, callback)
+        session.rollback()
+        session.commit()
+
+        callback.assert_not_called()
@@ -0,0 +1,100 @@
+"""
+Copyright (c) 2018 Keitaro AB
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from mock import MagicMock
+from sqlalchemy import create_engine
+from sqlalchemy.dialects import postgresql
+
+from ckanext.knowledgehub.lib.util import monkey_patch
+from ckanext.knowledgehub.model import index_dependency
+from ckanext.knowledgehub.model.index_dependency import (
+    IndexDependency,
+    index_dependency_table,
+)
+
+from nose.tools import (
+    assert_equals,
+    assert_false,
+    assert_true,
+)
+
+
+class TestIndexDependency:
+
+    def setup(self):
+        self.engine = create_engine('sqlite://')
+        index_dependency_table.create(self.engine)
+        self.default_engine = index_dependency.engine
+        index_dependency.engine = self.engine
+
+    def teardown(self):
+        index_dependency.engine = self.default_engine
+
+    def _insert(self, *rows):
+        self.engine.execute(index_dependency_table.insert(), [{
+            'doctype': doctype,
+            'entity_id': entity_id,
+            'ref_type': ref_type,
+            'ref': ref,
+        } for doctype, entity_id, ref_type, ref in rows])
+
+    def test_has_dependencies(self):
+        assert_false(IndexDependency.has_dependencies())
+
+        self._insert(('dashboard', 'dash-1', 'tag', 'tag-1'))
+
+        assert_true(IndexDependency.has_dependencies())
+
+    def test_get_dependents(self):
+        self._insert(('dashboard', 'dash-2', 'tag', 'tag-1'),
+                     ('dashboard', 'dash-1', 'tag', 'tag-1'),
+                     ('dashboard', 'dash-1', 'keyword', 'kwd-1'),
+                     ('package', 'pkg-1', 'keyword', 'kwd-1'),
+                     ('package', 'pkg-2', 'tag', 'tag-2'))
+
+        dependents = IndexDependency.get_dependents({
+            'tag': ['tag-1'],
+            'keyword': ['kwd-1', None],
+        })
+
+        assert_equals({
+            'dashboard': ['dash-1', 'dash-2'],
+            'package': ['pkg-1'],
+        }, dependents)
+        assert_equals({}, IndexDependency.get_dependents({'tag': []}))
+
+    @monkey_patch(index_dependency, 'engine', MagicMock())
+    def test_set_dependencies_concurrent(self):
+        conn = index_dependency.engine.begin.return_value.__enter__()
+
+        IndexDependency.set_dependencies('dashboard', {
+            'dash-1': {'tag': ['tag-1', 'tag-1', None]},
+        })
+
+        assert_equals(2, conn.execute.call_count)
+        delete = conn.execute.call_args_list[0][0][0]
+        insert, rows = conn.execute.call_args_list[1][0]
+        assert_true(str(delete).startswith('DELETE FROM index_dependency'))
+        # the rows recorded by a concurrent reindex are kept
+        sql = str(insert.compile(dialect=postgresql.dialect()))
+        assert_true(sql.endswith('ON CONFLICT DO NOTHING'), sql)
+        assert_equals([{
+            'doctype': 'dashboard',
+            'entity_id': 'dash-1',
+            'ref_type': 'tag',
+            'ref': 'tag-1',
+        }], rows)
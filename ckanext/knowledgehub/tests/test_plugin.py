@@ -14,9 +14,72 @@ GNU Affero General Public License for more details.
 You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
-
 """Tests for plugin.py."""
+import json
+
+from mock import Mock
+
 import ckanext.knowledgehub.plugin as plugin
+from ckanext.knowledgehub.lib.util import monkey_patch
+
+from nose.tools import assert_equals
+
 
 def test_plugin():
-    pass
\ No newline at end of file
+    pass
+
+
+class TestBeforeIndex:
+
+    @monkey_patch(plugin.IndexDependency, 'set_dependencies', Mock())
+    @monkey_patch(plugin, 'after_commit', Mock())
+    @monkey_patch(plugin.Visualization, 'get_research_question_refs', Mock())
+    @monkey_patch(plugin, 'get_entity_loader', Mock())
+    @monkey_patch(plugin, 'tag_keyword_map', Mock())
+    def test_before_index(self):
+        plugin.Visualization.get_research_question_refs.return_value = [
+            'rq-1',
+            'Research Question Title',
+            'missing',
+        ]
+        loader = plugin.get_entity_loader.return_value
+        loader.load_many.return_value = [{'id': 'rq-1'}, {'id': 'rq-2'}, None]
+        plugin.tag_keyword_map.get_keyword.return_value = {
+            'id': 'kwd-1',
+            'name': 'keyword',
+        }
+
+        pkg_dict = plugin.KnowledgehubPlugin().before_index({
+            'id': 'pkg-1',
+            'validated_data_dict': json.dumps({
+                'tags': [{'name': 'tag-1', 'keyword_id': 'kwd-1'}],
+                'resources': [{'id': 'res-1'}, {'id': 'res-2'}],
+            }),
+        })
+
+        plugin.Visualization.get_research_question_refs.\
+            assert_called_once_with(['res-1', 'res-2'])
+        loader.load_many.assert_called_once_with('research_question', [
+            'rq-1',
+            'Research Question Title',
+            'missing',
+        ])
+        assert_equals(['rq-1', 'rq-2'], pkg_dict['idx_research_questions'])
+        assert_equals(['rq-1', 'rq-2'],
+                      sorted(pkg_dict['research_question'].split(',')))
+        assert_equals(['tag-1'], pkg_dict['idx_tags'])
+        assert_equals('keyword', pkg_dict['extras_keywords'])
+
+        # the dependencies are recorded once the dataset is committed
+        plugin.after_commit.assert_called_once()
+        plugin.IndexDependency.set_dependencies.assert_not_called()
+        _, callback = plugin.after_commit.call_args[0]
+        callback()
+        plugin.IndexDependency.set_dependencies.assert_called_once_with(
+            'package', {
+                'pkg-1': {
+                    'tag': ['tag-1'],
+                    'keyword': ['kwd-1'],
+                    'research_question': ['rq-1', 'rq-2'],
+                },
+            })
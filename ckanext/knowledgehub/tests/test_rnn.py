@@ -17,9 +17,13 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 """Tests for rnn/worker.py."""
 
+import json
 import os
+import shutil
+import tempfile
 import nose.tools
 import mock
+import numpy as np
 
 from ckan import plugins
 from ckan.tests import helpers
@@ -39,12 +43,18 @@ from ckanext.knowledgehub.model.kwh_data import (
 from ckanext.knowledgehub.logic.action import create as create_actions
 from ckanext.knowledgehub.lib.rnn import PredictiveSearchModel
 from ckanext.knowledgehub.lib.rnn import PredictiveSearchWorker
+from ckanext.knowledgehub.lib.rnn.model import (
+    LoadedModel,
+    PredictiveModelHolder,
+)
+from ckanext.knowledgehub.lib.rnn.worker import OneHotSequence
 from ckanext.knowledgehub.tests.helpers import get_context
 from ckanext.knowledgehub.lib.util import monkey_patch
 from hdx.hdx_configuration import Configuration
 
 assert_equals = nose.tools.assert_equals
 assert_raises = nose.tools.assert_raises
+assert_true = nose.tools.assert_true
 assert_not_equals = nose.tools.assert_not_equals
 
 
@@ -97,6 +107,11 @@ class TestPredictiveSearchWorker(ActionsBase):
 
         assert_equals(os.path.isfile(worker.weights_path), True)
         assert_equals(os.path.isfile(worker.network_path), True)
+        with open(worker.vocabulary_path) as vocabulary_file:
+            vocabulary = json.load(vocabulary_file)
+        assert_equals(vocabulary['chars'], worker.unique_chars)
+        assert_equals(vocabulary['sequence_length'],
+                      int(worker.sequence_length))
 
 
 class TestPredictiveSearchModel(ActionsBase):
@@ -129,3 +144,165 @@ class TestPredictiveSearchModel(ActionsBase):
         predicts = model.predict(text)
 
         assert_equals(len(predicts), 3)
+
+
+class TestPredictiveModelHolder:
+
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        self.config = mock.Mock()
+        self.config.network_path = os.path.join(self.dir, 'network.json')
+        self.config.weights_path = os.path.join(self.dir, 'weights.h5')
+        self.config.vocabulary_path = os.path.join(self.dir,
+                                                   'vocabulary.json')
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def _touch(self, mtime):
+        for path in [self.config.network_path,
+                     self.config.weights_path,
+                     self.config.vocabulary_path]:
+            open(path, 'w').close()
+            os.utime(path, (mtime, mtime))
+
+    def test_get_no_model(self):
+        holder = PredictiveModelHolder()
+        holder._load = mock.Mock()
+
+        assert_equals(holder.get(self.config), None)
+        holder._load.assert_not_called()
+
+    def test_get_reload_on_change(self):
+        holder = PredictiveModelHolder()
+        holder._load = mock.Mock(side_effect=lambda config: mock.Mock(
+            version=holder._get_version(config)))
+        self._touch(1000)
+
+        first = holder.get(self.config)
+        assert_equals(holder.get(self.config), first)
+        assert_equals(holder._load.call_count, 1)
+
+        self._touch(2000)
+        second = holder.get(self.config)
+
+        assert_not_equals(second, first)
+        assert_equals(second.version, (2000, 2000, 2000))
+        assert_equals(holder._load.call_count, 2)
+
+    def _loaded_model(self, version):
+        return LoadedModel(version, mock.Mock(), mock.Mock(), mock.Mock(),
+                           {'sequence_length': 6, 'chars': 'abc '})
+
+    def test_get_close_replaced_model(self):
+        holder = PredictiveModelHolder()
+        holder._load = mock.Mock(side_effect=lambda config: self._loaded_model(
+            holder._get_version(config)))
+        self._touch(1000)
+
+        first = holder.get(self.config)
+        session = first.session
+        self._touch(2000)
+        holder.get(self.config)
+
+        assert_equals(first.closed, True)
+        assert_equals(session.close.call_count, 1)
+
+    def test_acquire_close_after_release(self):
+        holder = PredictiveModelHolder()
+        holder._load = mock.Mock(side_effect=lambda config: self._loaded_model(
+            holder._get_version(config)))
+        self._touch(1000)
+
+        first = holder.acquire(self.config)
+        session = first.session
+        self._touch(2000)
+        second = holder.acquire(self.config)
+
+        # The replaced model is still used by a prediction.
+        assert_not_equals(second, first)
+        assert_equals(first.closed, False)
+        session.close.assert_not_called()
+
+        first.release()
+
+        assert_equals(first.closed, True)
+        assert_equals(session.close.call_count, 1)
+        assert_equals(first.acquire(), False)
+
+        second.release()
+        assert_equals(second.closed, False)
+
+
+class TestPredictCompletions:
+
+    def _get_model(self, words):
+        model = PredictiveSearchModel()
+        model.sequence_length = 6
+        model.beam_width = 3
+        model.unique_chars = sorted(set('abcdefghijklmnopqrstuvwxyz '))
+        model.char_indices = dict((c, i)
+                                  for i, c in enumerate(model.unique_chars))
+        model.indices_char = dict((i, c)
+                                  for i, c in enumerate(model.unique_chars))
+
+        def _predict(x, batch_size=None, verbose=0):
+            # Predicts the next character of the words with the given
+            # probabilities, based on the last (partial) word of the input.
+            preds = []
+            for row in x:
+                text = ''.join([model.unique_chars[char.argmax()]
+                                for char in row if char.max() > 0])
+                last_word = text.split(' ')[-1]
+                pred = np.full(len(model.unique_chars), 1e-4)
+                for word, probability in words.items():
+                    word += ' '
+                    if word.startswith(last_word) and \
+                            len(last_word) < len(word):
+                        pred[model.char_indices[word[len(last_word)]]] += \
+                            probability
+                preds.append(pred / pred.sum())
+            return np.array(preds)
+
+        model.model = mock.Mock()
+        model.model.predict.side_effect = _predict
+        return model
+
+    def test_predict_completions(self):
+        model = self._get_model({
+            'syria': 0.5,
+            'sydney': 0.3,
+            'system': 0.2,
+        })
+
+        completions = model.predict_completions('in sy', top_n=2)
+
+        assert_equals(['ria', 'dney'], [c for c, _ in completions])
+        assert_true(completions[0][1] > completions[1][1])
+        # one batched forward pass per step
+        assert_equals(5, model.model.predict.call_count)
+
+
+class TestOneHotSequence:
+
+    def test_get_batch(self):
+        # 'abcab' encoded with the chars ['a', 'b', 'c']
+        encoded = np.array([0, 1, 2, 0, 1])
+        sequence = OneHotSequence(encoded, [0, 1], 3, 3, batch_size=1)
+
+        assert_equals(len(sequence), 2)
+
+        x, y = sequence[1]
+        assert_equals(x.shape, (1, 3, 3))
+        assert_equals(x[0].argmax(axis=1).tolist(), [1, 2, 0])
+        assert_equals(x.sum(), 3)
+        assert_equals(y.tolist(), [[False, True, False]])
+
+    def test_shuffle(self):
+        encoded = np.arange(20) % 3
+        sequence = OneHotSequence(encoded, range(10), 5, 3, batch_size=4,
+                                  shuffle=True)
+        sequence.on_epoch_end()
+
+        assert_equals(len(sequence), 3)
+        assert_equals(sorted(sequence.offsets.tolist()), range(10))
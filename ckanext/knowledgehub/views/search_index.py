@@ -0,0 +1,69 @@
+# encoding: utf-8
+
+"""
+Copyright (c) 2018 Keitaro AB
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import logging
+
+from flask import Blueprint, Response, stream_with_context
+import ckan.lib.base as base
+import ckan.logic as logic
+import ckan.model as model
+from ckan.common import _, g, request
+
+from ckanext.knowledgehub.logic.action.get import _search_index_export
+
+
+log = logging.getLogger(__name__)
+
+
+search_index = Blueprint(
+    u'search_index',
+    __name__,
+    url_prefix=u'/search-index'
+)
+
+
+def _get_context():
+    return dict(model=model, user=g.user,
+                auth_user_obj=g.userobj,
+                session=model.Session)
+
+
+def export(doctype):
+    u'''Streams all matching documents of the given type as JSON lines.
+    '''
+    try:
+        lines = _search_index_export(_get_context(), {
+            'type': doctype,
+            'text': request.args.get('q', '').strip(),
+            'fq': request.args.getlist('fq'),
+            'sort': request.args.get('sort', '').strip(),
+        })
+    except logic.NotAuthorized:
+        base.abort(403, _('Not authorized to export the search index.'))
+        return
+    except logic.ValidationError as e:
+        base.abort(400, str(e.error_dict))
+        return
+
+    return Response(stream_with_context(lines),
+                    mimetype='application/x-ndjson')
+
+
+search_index.add_url_rule(u'/export/<doctype>', view_func=export)